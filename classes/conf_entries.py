@@ -236,6 +236,8 @@ class Listen:
 
 class Spamfilter:
     entry_num = 0
+    # Bumped whenever a spamfilter is added or removed, so compiled matchers know to rebuild.
+    generation = 0
 
     def __init__(self, match_type, action, duration, match, target, reason, conf_file, conf=1):
         self.match_type = match_type
@@ -249,12 +251,31 @@ class Spamfilter:
         self.set_by = None
         self.entry_num = Spamfilter.entry_num
         self.conf_file = conf_file
+        # Set when a guarded regex exceeded its time budget.
+        self.disabled = 0
+        # Statistics, shown by /SPAMFILTER stats.
+        self.evaluations = 0
+        self.hits = 0
+        self.actions = 0
+        self.last_hit = 0
+        self.eval_time = 0.0
+        self.max_eval_time = 0.0
         Spamfilter.entry_num += 1
+        Spamfilter.generation += 1
         IRCD.configuration.spamfilters.append(self)
 
     def active_time(self):
         return int(time.time()) - self.set_time
 
+    def record_evaluation(self, elapsed: float):
+        self.evaluations += 1
+        self.eval_time += elapsed
+        self.max_eval_time = max(self.max_eval_time, elapsed)
+
+    def record_hit(self):
+        self.hits += 1
+        self.last_hit = int(time.time())
+
     def __repr__(self):
         return f"<Spamfilter '{self.match} -> {self.reason}'>"
 
@@ -99,6 +99,7 @@ class ConfigBuild:
 
         IRCD.configuration = Configuration()
         IRCD.configuration.our_ports = our_ports
+        IRCD.except_generation += 1
 
         if reloadmods:
             """ Only remove non-core commands. """
@@ -182,6 +183,7 @@ class ConfigBuild:
             MessageTag.table = last_mtags
             logging.error(f"Rehashing failed; previous configuration restored.")
             IRCD.configuration = last_conf
+            IRCD.except_generation += 1
             return 0
 
         new_listen = IRCD.configuration.listen
@@ -50,6 +50,8 @@ def make_server(client: Client):
     client.server = Server()
     if client.uplink == IRCD.me:
         client.direction = client
+    if client.local:
+        IRCD.server_links.append(client)
     return client
 
 
@@ -62,6 +64,7 @@ def make_user(client: Client):
     client.user = User()
     if client.local:
         client.id = IRCD.get_first_available_uid(client)
+        IRCD.uid_table[client.id] = client
         client.assign_host()
         client.local.nospoof = ''.join(random.choice(string.digits + string.ascii_uppercase) for _ in range(8))
         client.send([], f"PING :{client.local.nospoof}")
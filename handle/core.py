@@ -12,24 +12,29 @@ import random
 import string
 import time
 import socket
+import sqlite3
 import sys
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
 
 import select
 
 from enum import Enum
+from functools import partial
 from random import randrange
 from sys import version
-from threading import Thread, Timer, Event
+from threading import Thread, Timer, Event, current_thread, main_thread
 from time import time
 from datetime import datetime, timezone
 from dataclasses import dataclass, field
 from typing import ClassVar, Callable
+from weakref import WeakKeyDictionary
 
 import OpenSSL
 
-from handle.functions import is_match, IPtoBase64
-from handle.logger import logging, IRCDLogger
+from handle.functions import is_match, compile_globs, IPtoBase64
+from handle.logger import logging, IRCDLogger, JsonEventLog
+from handle.resolver import Resolver
 
 gc.enable()
 
@@ -97,6 +102,12 @@ class Client:
     exitted: int = 0
     webirc: int = 0
     websocket: int = 0
+    # Bumped whenever something a ban or exception mask can match on changes.
+    identity_version: int = 0
+    # Exception type -> (IRCD.except_generation, identity_version, verdict)
+    except_cache: dict = field(default_factory=dict)
+    # Channels this client is on, in join order. Maintained by Channel.create_member() and remove_client().
+    joined: dict = field(default_factory=dict)
     remember = {
         "cloakhost": '',
         "ident": '',
@@ -125,7 +136,7 @@ class Client:
 
     @property
     def channels(self):
-        return [channel for channel in Channel.table if any(client is self for client in channel.member_by_client)]
+        return list(self.joined)
 
     @property
     def fullmask(self):
@@ -260,9 +271,11 @@ class Client:
 
                     self.user.username = set_ident
                     self.user.cloakhost = set_host
+                    self.identity_changed()
 
                 case "gecos":
                     self.info = info
+                    self.identity_changed()
                     if self.local:
                         IRCD.server_notice(self, f"*** Your realname is now \"{self.info}\"")
                         if self.has_capability("setname"):
@@ -324,7 +337,7 @@ class Client:
         if self.registered and not self.ulined and (self.local or (not self.uplink.server.squit and self.uplink.server.synced)):
             msg = f"*** Client exiting: {self.name} ({self.user.username}@{self.user.realhost}) [{self.ip}] ({reason})"
             event = "LOCAL_USER_QUIT" if self.local else "REMOTE_USER_QUIT"
-            IRCD.log(self, "info", "quit", event, msg, sync=0)
+            IRCD.log(self, "info", "quit", event, msg, sync=0, reason=reason)
             """
             Don't broadcast this user QUIT to other servers if its server is quitting or if the user has been killed.
             """
@@ -342,9 +355,8 @@ class Client:
         data = f":{self.name}!{self.user.username}@{self.user.cloakhost} QUIT :{reason}"
         IRCD.send_to_local_common_chans(self, self.mtags, client_cap=None, data=data)
 
-        for channel in list(Channel.table):
-            if channel.find_member(self):
-                channel.remove_client(self)
+        for channel in list(self.joined):
+            channel.remove_client(self)
 
     def server_exit(self, reason):
         if not self.server:
@@ -367,7 +379,6 @@ class Client:
         else:
             if self.local and not self.local.incoming and not self.server.link.auto_connect:
                 IRCD.log(IRCD.me, "error", "link", "LINK_OUT_FAIL", f"Unable to connect to {self.name}: {reason}", sync=0)
-            IRCD.do_delayed_process()
 
         if self.server.authed:
             logging.debug(f"[server_exit()] Broadcasting to all other servers that server {self.name} has quit")
@@ -375,10 +386,10 @@ class Client:
             IRCD.send_to_servers(self, [], data)
 
         self.server.squit = 1
-        for remote_client in [c for c in Client.table if c.uplink == self]:
-            if remote_client.server:
-                logging.debug(f"Exiting server {remote_client.name} because it was uplinked to {self.name}")
-            remote_client.exit(netsplit_reason)
+        for remote_server in [c for c in IRCD.global_servers() if c.uplink == self]:
+            logging.debug(f"Exiting server {remote_server.name} because it was uplinked to {self.name}")
+            remote_server.exit(netsplit_reason)
+        Client.mass_exit(list(IRCD.server_users.pop(self, {})), netsplit_reason)
 
         if self in IRCD.send_after_eos:
             del IRCD.send_after_eos[self]
@@ -390,6 +401,61 @@ class Client:
 
         IRCD.run_hook(Hook.SERVER_DISCONNECT, self)
 
+    @staticmethod
+    def mass_exit(clients: list, reason: str) -> None:
+        """
+        Exits remote users of a splitting server all at once.
+        Indexes and channels are updated in one pass, and each local user receives the QUITs
+        of the departing users it could see, inside the netsplit batch.
+        """
+        clients = [c for c in clients if c.user and not c.local and not c.exitted]
+        if not clients:
+            return
+        departing = dict.fromkeys(clients)
+
+        Client.table[:] = [c for c in Client.table if c not in departing]
+        for client in clients:
+            if client.id and IRCD.uid_table.get(client.id) is client:
+                del IRCD.uid_table[client.id]
+
+        # Local user -> departing users whose QUIT it should see, in exit order.
+        recipients = {}
+        members_by_channel = {}
+        for client in clients:
+            for channel in client.joined:
+                members_by_channel.setdefault(channel, []).append(client)
+
+        for channel, members in members_by_channel.items():
+            for local_client in [c for c in channel.member_by_client if c.local and c not in departing]:
+                seen = set(channel.seen_dict.get(local_client, []))
+                visible = recipients.setdefault(local_client, {})
+                for client in members:
+                    if client not in visible and client in seen and channel.user_can_see_member(local_client, client):
+                        visible[client] = None
+
+        for local_client, visible in recipients.items():
+            if not visible:
+                continue
+            mtags = []
+            Batch.check_batch_event(mtags=mtags, started_by=clients[0].direction, target_client=local_client, event="netsplit")
+            for client in visible:
+                local_client.send(mtags, f":{client.name}!{client.user.username}@{client.user.cloakhost} QUIT :{reason}")
+
+        for channel, members in members_by_channel.items():
+            channel.remove_clients(members)
+
+        for client in clients:
+            if client.registered:
+                IRCD.global_user_count -= 1
+            IRCD.global_client_count -= 1
+            client.exitted = 1
+
+        for client in clients:
+            if client.registered:
+                IRCD.run_hook(Hook.REMOTE_QUIT, client, reason)
+
+        gc.collect()
+
     def kill(self, reason: str, killed_by=None) -> None:
         if not self.user:
             return logging.error(f"Cannot use kill() on server! Reason given: {reason}")
@@ -406,7 +472,7 @@ class Client:
         quitreason = f"Killed by {path} ({reason})"
         msg = f"*** Received kill msg for {self.name} ({self.user.username}@{self.user.realhost}) Path {path} ({reason})"
         event = "LOCAL_KILL" if self.local else "GLOBAL_KILL"
-        IRCD.log(self, "info", "kill", event, msg, sync=0)
+        IRCD.log(self, "info", "kill", event, msg, sync=0, reason=reason, killed_by=path)
 
         if self.local:
             fullmask = killed_by.fullmask if killed_by != IRCD.me else IRCD.me.name
@@ -417,9 +483,6 @@ class Client:
         IRCD.send_to_servers(killed_by, mtags=[], data=f":{killed_by.id} KILL {self.id} :{reason}")
 
     def exit(self, reason: str, sock_error: bool = 0, sockclose: int = 1) -> None:
-        if IRCD.current_link_sync == self:
-            IRCD.current_link_sync = None
-
         if self not in Client.table:
             self.close_socket()
             return
@@ -427,6 +490,15 @@ class Client:
         if self in Client.table:
             Client.table.remove(self)
 
+        if self.id and IRCD.uid_table.get(self.id) is self:
+            del IRCD.uid_table[self.id]
+
+        if self in IRCD.server_links:
+            IRCD.server_links.remove(self)
+
+        if self.user and (users := IRCD.server_users.get(self.uplink)):
+            users.pop(self, None)
+
         if self.server:
             self.server_exit(reason)
 
@@ -512,10 +584,22 @@ class Client:
         name = name.replace(' ', '_')
         value = value.replace(' ', '_')
         ModData.add_to_client(self, name, value, sync)
+        self.identity_changed()
 
     def del_md(self, name: str):
         name = name.replace(' ', '_')
         ModData.remove_from_client(self, name)
+        self.identity_changed()
+
+    def identity_changed(self):
+        """
+        Call this whenever something a ban or exception mask can match on changes,
+        such as host, ident, nickname, account, certfp or operclass.
+        This invalidates cached exception and channel list verdicts for this client.
+        """
+        self.identity_version += 1
+        for channel in self.joined:
+            channel.names_version += 1
 
     def get_md_value(self, name: str):
         name = name.replace(' ', '_')
@@ -539,9 +623,17 @@ class Client:
             return
         self.local.flood_penalty += penalty
 
+    def sendq_room(self) -> int:
+        """ Returns how many bytes can still be queued before this client reaches its sendq limit. """
+        if not self.local:
+            return 0
+        sendq = self.class_.sendq if self.class_ else 65536
+        return sendq - self.local.sendq_size
+
     def check_flood(self):
         if self.is_flood_safe():
             self.local.sendq_buffer = []
+            self.local.sendq_size = 0
             return
 
         if self.local and self.user:
@@ -565,7 +657,7 @@ class Client:
                 if self.registered:
                     msg = f"*** Flood -- {self.name} ({self.user.username}@{self.user.realhost}) has reached " \
                           f"their max {'RecvQ' if flood_type == 'recvq' else 'SendQ'} ({flood_amount}) while the limit is {flood_limit}"
-                    IRCD.log(self, "warn", "flood", f"FLOOD_{flood_type.upper()}", msg, sync=1)
+                    IRCD.log(self, "warn", "flood", f"FLOOD_{flood_type.upper()}", msg, sync=1, amount=flood_amount, limit=flood_limit)
 
                 self.exit("Excess Flood")
             else:
@@ -575,7 +667,7 @@ class Client:
                     if self.registered:
                         msg = f"*** Buffer Flood -- {self.name} ({self.user.username}@{self.user.realhost}) has reached " \
                               f"their max buffer length ({cmd_len}) while the limit is {max_cmds}"
-                        IRCD.log(self, "warn", "flood", f"FLOOD_BUFFER_EXCEEDED", msg, sync=1)
+                        IRCD.log(self, "warn", "flood", f"FLOOD_BUFFER_EXCEEDED", msg, sync=1, amount=cmd_len, limit=max_cmds)
                     self.exit("Excess Flood")
                 return
 
@@ -587,7 +679,7 @@ class Client:
                 if self.registered:
                     msg = f"*** Flood -- {self.name} ({self.user.username}@{self.user.realhost}) has reached " \
                           f"their max flood penalty ({self.local.flood_penalty}) while the limit is {flood_penalty_treshhold}"
-                    IRCD.log(self, "warn", "flood", f"FLOOD_PENALTY_LIMIT", msg, sync=1)
+                    IRCD.log(self, "warn", "flood", f"FLOOD_PENALTY_LIMIT", msg, sync=1, amount=self.local.flood_penalty, limit=flood_penalty_treshhold)
                 self.exit("Excess Flood")
 
     def assign_host(self):
@@ -600,34 +692,27 @@ class Client:
             self.exit(ban.reason)
             return
 
-        if IRCD.get_setting("resolvehost"):
-            realhost = IRCD.hostcache.get(self.ip, None)
-            cache = 0
-            if realhost:
-                realhost = realhost[1]
-                cache = 1
-            try:
-                if not realhost:
-                    realhost = socket.gethostbyaddr(self.ip)[0]
-                    IRCD.hostcache[self.ip] = int(time()), realhost
-                if realhost == "localhost" and not ipaddress.IPv4Address(self.ip).is_private:
-                    # https://ipinfo.io/AS7552/27.71.152.0/21
-                    # All those IP addresses seem to resolve to localhost.
-                    realhost = self.ip
-
-                IRCD.server_notice(self, f"*** Found your hostname: {realhost}{' [cached]' if cache else ''}")
-            except:
-                realhost = self.ip
-                IRCD.server_notice(self, f"*** Couldn't resolve your hostname, using IP address instead")
-
-        else:
+        # The IP address is used until the lookup finishes, registration waits for it.
+        self.set_realhost(self.ip)
+        if not IRCD.get_setting("resolvehost"):
             IRCD.server_notice(self, f"*** Host resolution disabled, using IP address instead")
-            realhost = self.ip
+        else:
+            IRCD.server_notice(self, f"*** Looking up your hostname...")
+            HostCache.lookup(self)
 
+    def set_realhost(self, realhost: str):
         self.user.realhost = realhost
         self.user.cloakhost = IRCD.get_cloak(self)
         self.remember["cloakhost"] = self.user.cloakhost
 
+    def found_host(self, realhost, cached=0):
+        """ Called with the result of the hostname lookup. `realhost` is the IP address if it did not resolve. """
+        if realhost != self.ip:
+            self.set_realhost(realhost)
+            IRCD.server_notice(self, f"*** Found your hostname: {realhost}{' [cached]' if cached else ''}")
+        else:
+            IRCD.server_notice(self, f"*** Couldn't resolve your hostname, using IP address instead")
+
     def add_user_modes(self, modes):
         if not self.local:
             logging.error(f"Attempted to call add_user_modes() on non-local user: {self.name} {modes}")
@@ -752,7 +837,7 @@ class Client:
         self.sendnumeric(Numeric.RPL_HOSTHIDDEN, self.user.cloakhost)
 
         msg = f"*** Client connecting: {self.name} ({self.user.username}@{self.user.realhost}) [{self.ip}] {self.get_ext_info()}"
-        IRCD.log(self, "info", "connect", "LOCAL_USER_CONNECT", msg, sync=0)
+        IRCD.log(self, "info", "connect", "LOCAL_USER_CONNECT", msg, sync=0, info=self.info)
 
         Command.do(self, "LUSERS")
         Command.do(self, "MOTD")
@@ -800,18 +885,15 @@ class Client:
 
         try:
             for line in list(self.local.recvbuffer):
+                if self in ReplyStream.busy:
+                    # Later commands wait until the streamed reply has been sent completely, so replies stay in order.
+                    break
                 time_to_execute, recv = line
                 if self.user and time_to_execute - time() > 0 and 'o' not in self.user.modes:
                     continue
 
                 cmd = recv.split()[0].upper()
 
-                if (self.server and IRCD.current_link_sync and IRCD.current_link_sync != self
-                        and cmd != "SQUIT" and self not in IRCD.process_after_eos):
-                    IRCD.process_after_eos.append(self)
-                    logging.debug(f"Currently syncing to {IRCD.current_link_sync.name}, processing {self.name} recvbuffer after.")
-                    continue
-
                 self.local.recvbuffer.remove(line)
 
                 if not (recv := recv.strip()):
@@ -903,6 +985,9 @@ class Client:
             if not data.strip():
                 return
 
+        if (stream := ReplyStream.current) and stream.client is self and stream.tags:
+            mtags = stream.tags + mtags
+
         if mtags := MessageTag.filter_tags(destination=self, mtags=mtags):
             data = f"@" + ';'.join([t.string for t in mtags]) + ' ' + data
 
@@ -920,12 +1005,23 @@ class Client:
             delay = len(data) / 10
             sendq_buffer_time = time() + delay
             self.local.sendq_buffer.append([sendq_buffer_time, data])
+            self.local.sendq_size += len(data) + 2
             self.check_flood()
 
         if self.websocket and IRCD.websocketbridge:
             IRCD.websocketbridge.send_to_client(self, data)
             return
 
+    def queue_line(self, line: str):
+        """ Appends an already formatted line, ending with CRLF, to the send buffer of this local connection. """
+        if not self.local or not self.local.socket:
+            return
+        if not self.local.handshake:
+            return self.direct_send(line)
+        if IRCD.use_poll:
+            IRCD.poller.modify(self.local.socket, select.POLLOUT)
+        self.local.sendbuffer += line
+
     def direct_send(self, data):
         """ Directly sends data to a socket. """
 
@@ -986,6 +1082,8 @@ class LocalClient:
     temp_recvbuffer: str = ''
     backbuffer: [] = field(repr=False, default_factory=list)
     sendq_buffer: [] = field(repr=False, default_factory=list)
+    # Bytes in sendq_buffer, including line endings.
+    sendq_size: int = 0
     auto_connect: int = 0
     handshake: int = 0
 
@@ -1013,6 +1111,8 @@ class Server:
     recv_mtags = []
     synced: int = 0
     authed: int = 0
+    # Set when our burst to this (local) server has been sent.
+    burst_sent: int = 0
     squit: int = 0
     registered: int = 1
     link = None
@@ -1357,10 +1457,59 @@ class Snomask:
         Snomask.table.append(snomask)
 
 
+class ListMatcher:
+    """
+    Compiled form of a channel list such as +b, +e or +I.
+    Masks are classified once into exact masks, wildcard masks and extbans,
+    and verdicts are cached per client until the list or the client's identity changes.
+    """
+
+    def __init__(self, channel, masks: list):
+        self.channel = channel
+        self.exact = set()
+        self.extbans = []
+        wildcard = []
+        for mask in masks:
+            if mask.startswith(Extban.symbol) and (extban := Extban.find(mask.split(':')[0])):
+                self.extbans.append((extban, mask))
+            elif '*' in mask or '?' in mask:
+                wildcard.append(mask)
+            else:
+                self.exact.add(mask)
+
+        self.wildcard = compile_globs(wildcard) if wildcard else None
+        self.verdicts = WeakKeyDictionary()
+
+    def evaluate(self, client) -> int:
+        targets = IRCD.client_match_targets(client)
+        if self.exact and not self.exact.isdisjoint(targets):
+            return 1
+        if self.wildcard and any(self.wildcard.fullmatch(target) for target in targets):
+            return 1
+
+        for extban, mask in self.extbans:
+            try:
+                if extban.is_match(client, self.channel, mask):
+                    return 1
+            except Exception as ex:
+                # A broken extban must not hide the ones after it.
+                logging.exception(ex)
+        return 0
+
+    def match(self, client) -> int:
+        if (cached := self.verdicts.get(client)) and cached[0] == client.identity_version:
+            return cached[1]
+        verdict = self.evaluate(client)
+        self.verdicts[client] = client.identity_version, verdict
+        return verdict
+
+
 @dataclass(eq=False)
 class Channel:
     # channel.membermodes.client
     table: ClassVar[list] = []
+    # Member count -> channels with that many members. Used by LIST to skip channels on size.
+    by_membercount: ClassVar[dict] = {}
     name: str = ''
     # This list will hold ChannelMember objects.
     members: list = field(default_factory=list)
@@ -1377,6 +1526,11 @@ class Channel:
     local_creationtime: int = 0
     remote_creationtime: int = 0
     List: dict = field(default_factory=dict)
+    # Bumped on every list change. Compiled ListMatcher objects are keyed on it.
+    list_version: int = 0
+    matchers: dict = field(default_factory=dict)
+    # Bumped whenever the NAMES reply of this channel may change: joins, parts, prefixes, nick or host changes.
+    names_version: int = 0
 
     # This dict keeps track of which users have seen other users on the channel.
     seen_dict: dict = field(default_factory=dict)
@@ -1502,6 +1656,8 @@ class Channel:
             member.client = client
             # self.members.append(member)
             self.member_by_client[client] = member
+            client.joined[self] = None
+            self.names_version += 1
             self.seen_dict[client] = []
             return 1
 
@@ -1516,6 +1672,7 @@ class Channel:
         for mode in [m for m in modes if m not in member.modes]:
             member.modes += mode
             diff = 1
+        self.names_version += diff
         if diff and (client.local or client.uplink.server.synced):
             # If there are any members on the channel that are not aware of this user,
             # show a join here.
@@ -1528,6 +1685,7 @@ class Channel:
             return
         for mode in modes:
             member.modes = member.modes.replace(mode, '')
+        self.names_version += 1
 
     def add_param(self, mode, param):
         """ If it already exists, it will update it. """
@@ -1571,23 +1729,21 @@ class Channel:
         return 0
 
     def check_match(self, client, match_type, mask=None):
-        if match_type not in self.List:
+        """
+        Check if `client` matches any entry on the list of `match_type`.
+        If `mask` is given, only that mask is checked, as long as the list is not empty.
+        """
+
+        if not self.List.get(match_type):
             return 0
-        for b in self.List[match_type]:
-            check_mask = b.mask if not mask else mask
-            if IRCD.client_match_mask(client, check_mask):
-                return 1
+        if mask:
+            return ListMatcher(self, [mask]).evaluate(client)
 
-            for extban in Extban.table:
-                if len(check_mask.split(':')) < 2:
-                    continue
-                try:
-                    if extban.is_match(client, self, check_mask):
-                        return 1
-                except Exception as ex:
-                    logging.exception(ex)
-                    return 0
-        return 0
+        version, matcher = self.matchers.get(match_type, (-1, None))
+        if version != self.list_version:
+            matcher = ListMatcher(self, [entry.mask for entry in self.List[match_type]])
+            self.matchers[match_type] = self.list_version, matcher
+        return matcher.match(client)
 
     def is_banned(self, client, mask=None):
         if client.has_permission("channel:override:join:ban"):
@@ -1621,6 +1777,7 @@ class Channel:
             timestamp = int(time())
         ban = ListEntry(mask=mask, set_by=setter, set_time=int(timestamp))
         _list.append(ban)
+        self.list_version += 1
         return 1
 
     def remove_from_list(self, mask, _list):
@@ -1628,12 +1785,28 @@ class Channel:
         for mask in list(masks):
             if entry := next((e for e in _list if mask == e.mask), None):
                 _list.remove(entry)
+                self.list_version += 1
                 return entry.mask
 
+    def set_membercount(self, count: int, indexed: int = 1):
+        """
+        Updates `membercount` and its entry in Channel.by_membercount.
+        Empty channels that still exist, such as permanent channels, are indexed under 0.
+        """
+        if channels := Channel.by_membercount.get(self.membercount):
+            channels.pop(self, None)
+            if not channels:
+                del Channel.by_membercount[self.membercount]
+        self.membercount = count
+        if indexed:
+            Channel.by_membercount.setdefault(count, {})[self] = None
+
     def remove_client(self, client: Client):
-        self.membercount -= 1
+        self.set_membercount(self.membercount - 1)
         if member := self.find_member(client):
             self.member_by_client.pop(member.client, None)
+            client.joined.pop(self, None)
+            self.names_version += 1
         else:
             logging.debug(f"Unable to remove {client.name} (uplink={client.uplink.name}) from channel {self.name}: member not found")
 
@@ -1644,6 +1817,24 @@ class Channel:
         if self.membercount == 0:
             IRCD.destroy_channel(IRCD.me, self)
 
+    def remove_clients(self, clients: list):
+        """ Removes many members at once, such as the users of a splitting server. """
+        removed = {client: None for client in clients if self.member_by_client.pop(client, None)}
+        for client in removed:
+            client.joined.pop(self, None)
+            self.seen_dict.pop(client, None)
+        if not removed:
+            return
+
+        for seen in self.seen_dict.values():
+            if any(c in removed for c in seen):
+                seen[:] = [c for c in seen if c not in removed]
+        self.names_version += 1
+        self.set_membercount(self.membercount - len(removed))
+
+        if self.membercount <= 0:
+            IRCD.destroy_channel(IRCD.me, self)
+
     def do_part(self, client: Client, reason: str = ''):
         reason = reason[:128]
         data = f":{client.fullmask} PART {self.name}{' :' + reason if reason else ''}"
@@ -1661,7 +1852,7 @@ class Channel:
         if (client.local and client.registered) or (not client.local and client.uplink.server.synced) and not client.ulined:
             msg = f"*** {client.name} ({client.user.username}@{client.user.realhost}) has left channel {self.name}"
             event = "LOCAL_PART" if client.local else "REMOTE_PART"
-            IRCD.log(client, "info", "part", event, msg, sync=0)
+            IRCD.log(client, "info", "part", event, msg, sync=0, channel=self.name, reason=reason)
 
     def show_join_message(self, mtags, client: Client, new_user: Client) -> None:
         """ Show `new_user` join message to `client` """
@@ -1681,7 +1872,7 @@ class Channel:
             self.seen_dict[client].append(new_user)
 
     def do_join(self, mtags, client: Client):
-        self.membercount += 1
+        self.set_membercount(self.membercount + 1)
         if not self.find_member(client):
             self.create_member(client)
 
@@ -1710,7 +1901,7 @@ class Channel:
         if (client.local and client.registered) or (not client.local and client.uplink.server.synced) and not client.ulined:
             event = "LOCAL_JOIN" if client.local else "REMOTE_JOIN"
             msg = f"*** {client.name} ({client.user.username}@{client.user.realhost}) has joined channel {self.name}"
-            IRCD.log(client, "info", "join", event, msg, sync=0)
+            IRCD.log(client, "info", "join", event, msg, sync=0, channel=self.name)
 
 
 @dataclass
@@ -1832,7 +2023,8 @@ class IRCD:
     conf_file: str = ''
     isupport: ClassVar[list] = []
     throttle: ClassVar[dict] = {}
-    hostcache: ClassVar[dict] = {}
+    # Bumped when E:Lines or except blocks change, invalidating all cached exception verdicts.
+    except_generation: int = 0
     maxusers: int = 0
     maxgusers: int = 0
     local_user_count: int = 0
@@ -1844,9 +2036,16 @@ class IRCD:
     rootdir: str = ''
     confdir: str = ''
     default_tls = {"ctx": None, "keyfile": None, "certfile": None}
-    current_link_sync: Client = None
-    process_after_eos: ClassVar[list] = []
+    # Local server -> [(mtags, data), ...] held back until our burst to that server has been sent.
     send_after_eos: ClassVar[dict] = {}
+    # UID -> user client. Entries are checked on lookup, so a reused UID never returns a stale client.
+    uid_table: ClassVar[dict] = {}
+    # Directly connected servers. Maintained by make_server() and Client.exit().
+    server_links: ClassVar[list] = []
+    # Remote server -> {user: None} for the users it introduced with UID. Maintained by m_nick, Client.exit() and server_exit().
+    server_users: ClassVar[dict] = {}
+    # Results of the last client index audit, see audit_client_index() in handle/sockets.py.
+    client_audit: ClassVar[dict] = {}
     delayed_connections: ClassVar[list] = []
     versionnumber: str = "3.0"
     version: str = f"ProvisionIRCd-{versionnumber}-beta"
@@ -1858,6 +2057,8 @@ class IRCD:
     last_activity: int = 0
     uid_iter = None
     websocketbridge = None
+    # Worker pool of the spamfilter RegexGuard. Kept here, so it survives a module reload.
+    regex_pool = None
     executor = ThreadPoolExecutor()
     command_socket = None
     logger = IRCDLogger
@@ -1894,7 +2095,12 @@ class IRCD:
         Isupport.add("NETWORK", IRCD.me.info.replace(' ', '-'))
 
         if fork and os.name == "posix":
+            # The log writer threads do not survive a fork, so they are stopped first and started again in both processes.
+            IRCDLogger.stop()
+            JsonEventLog.stop()
             pid = os.fork()
+            IRCDLogger.start()
+            JsonEventLog.start()
             if pid:
                 logging.info(f"PID [{pid}] forking to the background")
                 IRCDLogger.fork()
@@ -1905,7 +2111,7 @@ class IRCD:
         handle_connections()
 
     @staticmethod
-    def log(client, level: str, rootevent: str, event: str, message: str, sync: int = 1):
+    def log(client, level: str, rootevent: str, event: str, message: str, sync: int = 1, **fields):
         pass
 
     @staticmethod
@@ -1930,6 +2136,20 @@ class IRCD:
             return 1
 
         what = what.lower()
+        if not client.registered:
+            return IRCD.check_except_client(what, client)
+
+        generation = IRCD.except_generation, client.identity_version
+        if (cached := client.except_cache.get(what)) and cached[:2] == generation:
+            return cached[2]
+
+        verdict = IRCD.check_except_client(what, client)
+        client.except_cache[what] = *generation, verdict
+        return verdict
+
+    @staticmethod
+    def check_except_client(what: str, client: Client) -> int:
+        """ Uncached version of is_except_client(). """
 
         """ Check /eline matches """
         for tkl in [tkl for tkl in Tkl.table if tkl.type == 'E']:
@@ -1990,11 +2210,18 @@ class IRCD:
 
     @staticmethod
     def write_data_file(json_dict: dict, filename: str) -> None:
+        """
+        Atomically replaces data/<filename> with `json_dict`.
+        For state that changes often, use DataStore instead.
+        """
         if not os.path.exists("data"):
             os.mkdir("data")
-        with open(f"data/{filename}", "w+") as f:
-            json_out = json.dumps(json_dict, indent=4)
-            f.write(json_out)
+        tmp_file = f"data/{filename}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(json.dumps(json_dict, indent=4))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, f"data/{filename}")
 
     @staticmethod
     def read_data_file(filename: str) -> dict:
@@ -2122,22 +2349,16 @@ class IRCD:
         return mtags
 
     @staticmethod
-    def do_delayed_process():
-        for server_client in list(IRCD.process_after_eos):
-            logging.debug(f"Processing delayed recvbuffer of: {server_client.name}")
-            server_client.handle_recv()
-            if server_client in IRCD.process_after_eos:
-                IRCD.process_after_eos.remove(server_client)
-        IRCD.current_link_sync = None
-
-    @staticmethod
-    def client_match_mask(client, mask):
-        targets = [
+    def client_match_targets(client):
+        return [
             f"{client.name}!{client.user.username}@{client.user.realhost}",
             f"{client.name}!{client.user.username}@{client.ip}",
             f"{client.name}!{client.user.username}@{client.user.cloakhost}"
         ]
-        return int(any(is_match(mask, target) for target in targets))
+
+    @staticmethod
+    def client_match_mask(client, mask):
+        return int(any(is_match(mask, target) for target in IRCD.client_match_targets(client)))
 
     @staticmethod
     def run_parallel_function_original(target, args=(), kwargs=None, delay=0.0):
@@ -2379,7 +2600,7 @@ class IRCD:
 
     @staticmethod
     def local_servers():
-        return [c for c in Client.table if c.local and c.server]
+        return list(IRCD.server_links)
 
     @staticmethod
     def global_servers():
@@ -2398,11 +2619,19 @@ class IRCD:
         if not find:
             return
         user, server = (find.removeprefix(':').split('@', 1) + [''])[:2]
+        if not server and (client := IRCD.find_uid(user)):
+            return client
         for client in [c for c in Client.table if c.user and c.id]:
             if user.lower() in [client.name.lower(), client.id.lower()]:
                 if not server or (server and client.uplink.name.lower() == server.lower()):
                     return client
 
+    @staticmethod
+    def find_uid(uid: str) -> Client | None:
+        """ Returns the user with UID `uid` from IRCD.uid_table, without scanning all clients. """
+        if (client := IRCD.uid_table.get(uid)) and client.id == uid and not client.exitted:
+            return client
+
     @staticmethod
     def find_channel(name: str):
         if not name:
@@ -2418,7 +2647,9 @@ class IRCD:
             p1 = IRCD.find_user(p1)
         if type(p2) == str:
             p2 = IRCD.find_user(p2)
-        return next((c for c in IRCD.get_channels() if c.find_member(p1) and c.find_member(p2)), 0)
+        if not p1 or not p2:
+            return 0
+        return next((c for c in p1.joined if c.find_member(p2)), 0)
 
     @staticmethod
     def create_channel(client, name: str):
@@ -2428,12 +2659,16 @@ class IRCD:
         channel.local_creationtime = int(time())
         channel.init_lists()
         Channel.table.append(channel)
+        channel.set_membercount(0)
         IRCD.channel_count += 1
         IRCD.run_hook(Hook.CHANNEL_CREATE, client, channel)
         return channel
 
     @staticmethod
     def destroy_channel(client, channel):
+        for member_client in channel.member_by_client:
+            member_client.joined.pop(channel, None)
+        channel.set_membercount(0, indexed=0)
         Channel.table.remove(channel)
         IRCD.channel_count -= 1
         IRCD.run_hook(Hook.CHANNEL_DESTROY, client, channel)
@@ -2520,24 +2755,31 @@ class IRCD:
     @staticmethod
     def send_to_servers(client: Client, mtags: list, data: str):
         """
+        Sends `data` to all directly connected servers, except in the direction of `client`.
+        The line is built once and the same string is queued to every link that gets the same tags.
         :param client:      The server from where this message is coming from.
         """
 
-        for to_client in [to_client for to_client in Client.table if to_client.server and to_client.local]:  # and to_client.server.synced]:
+        data = data.strip()
+        lines = {}
+        for to_client in IRCD.server_links:
             if client and client != IRCD.me and to_client == client.direction or to_client.exitted:
                 continue
 
-            if IRCD.current_link_sync == to_client:
-                """ Destination server is not done syncing. """
-                # logging.warning(f"[send_to_servers()] Trying to sync data to server {to_client.name} but we're still syncing. Sending after we receive their EOS.")
-                # logging.warning(f"This data is: {data.rstrip()}")
-                if to_client not in IRCD.send_after_eos:
-                    IRCD.send_after_eos[to_client] = []
-                delayed_data = (mtags, data)
-                IRCD.send_after_eos[to_client].append(delayed_data)
-                return
+            if not to_client.server.burst_sent:
+                """ Our burst to the destination server is not done yet. Send this after it, to keep the order. """
+                IRCD.send_after_eos.setdefault(to_client, []).append((mtags, data))
+                continue
 
-            to_client.send(mtags, data)
+            data_list = data.split(' ')
+            IRCD.run_hook(Hook.PACKET, IRCD.me, to_client.direction, to_client, data_list)
+            if not (line_data := ' '.join(data_list)).strip():
+                continue
+
+            tags = tuple(t.string for t in MessageTag.filter_tags(destination=to_client, mtags=mtags))
+            if (line := lines.get((tags, line_data))) is None:
+                line = lines[tags, line_data] = ('@' + ';'.join(tags) + ' ' if tags else '') + line_data + "\r\n"
+            to_client.queue_line(line)
 
     @staticmethod
     def send_to_local_common_chans(client, mtags, client_cap=None, data=''):
@@ -3209,6 +3451,10 @@ class Hook:
     # Arguments:    client, channel
     CHANNEL_DESTROY = hook()
 
+    # Called after a channel has been renamed.
+    # Arguments:    client, channel, old_name
+    CHANNEL_RENAME = hook()
+
     # Called before a local user sends a channel message.
     # If you do not need to modify the message, you can use CAN_SEND_TO_CHANNEL hook.
     # Arguments:    client, channel, message as list, statusmsg_prefix
@@ -3505,6 +3751,499 @@ class Batch:
         return f"<Batch '{self.label} [{self.started_by.name}]'>"
 
 
+class ReplyStream:
+    """
+    Sends a long reply in parts, such as WHO or LIST on a big network.
+    `replies` is a generator that sends one reply line per iteration.
+    It is resumed from the main loop and paused while the client's sendq is more than half full,
+    so large replies neither stall the loop nor get the client killed for excess flood.
+    Streams of the same client are sent one after another, in the order they were started,
+    and commands the client sends meanwhile wait until its streams are done, so replies never interleave.
+    If the command that started a stream was labeled, the stream becomes its labeled-response batch,
+    so replies sent after the command has returned keep the label.
+    """
+
+    table = []
+    # Clients with a stream in `table`. Their next commands are not processed until it is closed.
+    busy = set()
+    # Maximum reply lines per client per loop iteration.
+    lines_per_loop = 100
+    # Stream being resumed. Its tags are added to everything sent to its client meanwhile.
+    current = None
+
+    def __init__(self, client, replies, on_close=None):
+        self.client = client
+        self.replies = replies
+        # Called once when the stream ends, also if the generator was never started.
+        self.on_close = on_close
+        self.label = next((tag.value for tag in client.recv_mtags if tag.name == "label"), None)
+        self.batch = None
+        self.tags = []
+
+    @staticmethod
+    def start(client, replies, on_close=None):
+        stream = ReplyStream(client, replies, on_close)
+        if client in ReplyStream.busy or stream.resume():
+            ReplyStream.table.append(stream)
+            ReplyStream.busy.add(client)
+        else:
+            stream.close()
+
+    @staticmethod
+    def find_labeled(client, label):
+        return next((s for s in ReplyStream.table if s.client == client and s.label == label and not s.batch), None)
+
+    def take_label(self, lines: list):
+        """
+        Called by labeled-response when the labeled command returns before this stream has ended.
+        Sends `lines`, which the command has sent so far, in a labeled-response batch that stays open until the stream ends.
+        """
+        self.batch = Batch.create_new(started_by=self.client, batch_type="labeled-response")
+        self.batch.announce_to(self.client)
+        self.tags = [self.batch.tag]
+        for line in lines:
+            self.client.send(self.tags, line, call_hook=0)
+
+    def resume(self) -> int:
+        """ Returns 1 if there is more to send. """
+        if self.client.exitted or not self.client.local:
+            return 0
+
+        sendq = self.client.class_.sendq if self.client.class_ else 65536
+        ReplyStream.current = self
+        try:
+            for _ in range(ReplyStream.lines_per_loop):
+                if self.client.sendq_room() < sendq // 2:
+                    return 1
+                next(self.replies)
+        except StopIteration:
+            return 0
+        except Exception as ex:
+            logging.exception(ex)
+            return 0
+        finally:
+            ReplyStream.current = None
+        return 1
+
+    def close(self):
+        self.replies.close()
+        if self.batch:
+            self.batch.end()
+        if self.on_close:
+            self.on_close()
+
+    @staticmethod
+    def process():
+        served = set()
+        for stream in list(ReplyStream.table):
+            if stream.client in served:
+                continue
+            served.add(stream.client)
+            if not stream.resume():
+                ReplyStream.table.remove(stream)
+                if not any(s.client == stream.client for s in ReplyStream.table):
+                    ReplyStream.busy.discard(stream.client)
+                stream.close()
+
+
+class DataStore:
+    """
+    Persistent key/value state for modules, kept in data/ircd.db using SQLite in WAL mode.
+    Values are stored as JSON, per namespace and key.
+    Changes are queued and committed in a single transaction from the main loop,
+    so saving state never rewrites a whole file and a crash never leaves a half-written one.
+    Changes made from other threads are handed to the main loop, the database and `pending` are only used there.
+    """
+
+    path = "data/ircd.db"
+    flush_interval = 1
+    db = None
+    pid = 0
+    # (namespace, key) -> JSON value, or None to delete it on the next flush.
+    pending = {}
+    # Changes made from other threads, moved to `pending` by the main loop.
+    submitted = deque()
+    last_flush = 0
+
+    @staticmethod
+    def connect():
+        # A connection must not be shared with a forked process.
+        if DataStore.db is None or DataStore.pid != os.getpid():
+            if not os.path.exists(os.path.dirname(DataStore.path)):
+                os.mkdir(os.path.dirname(DataStore.path))
+            DataStore.db = sqlite3.connect(DataStore.path)
+            DataStore.db.execute("PRAGMA journal_mode=WAL")
+            DataStore.db.execute("PRAGMA synchronous=NORMAL")
+            DataStore.db.execute("CREATE TABLE IF NOT EXISTS store (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                                 "value TEXT NOT NULL, PRIMARY KEY (namespace, key))")
+            DataStore.pid = os.getpid()
+        return DataStore.db
+
+    @staticmethod
+    def queue(namespace: str, key: str, value) -> None:
+        if current_thread() is not main_thread():
+            DataStore.submitted.append(((namespace, key), value))
+        else:
+            DataStore.pending[(namespace, key)] = value
+
+    @staticmethod
+    def take_submitted():
+        while DataStore.submitted:
+            change, value = DataStore.submitted.popleft()
+            DataStore.pending[change] = value
+
+    @staticmethod
+    def get(namespace: str, key: str, default=None):
+        DataStore.take_submitted()
+        if (namespace, key) in DataStore.pending:
+            value = DataStore.pending[(namespace, key)]
+            return json.loads(value) if value is not None else default
+        row = DataStore.connect().execute("SELECT value FROM store WHERE namespace=? AND key=?", (namespace, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    @staticmethod
+    def put(namespace: str, key: str, value) -> None:
+        DataStore.queue(namespace, key, json.dumps(value))
+
+    @staticmethod
+    def delete(namespace: str, key: str) -> None:
+        DataStore.queue(namespace, key, None)
+
+    @staticmethod
+    def items(namespace: str) -> dict:
+        DataStore.flush()
+        rows = DataStore.connect().execute("SELECT key, value FROM store WHERE namespace=?", (namespace,))
+        return {key: json.loads(value) for key, value in rows}
+
+    @staticmethod
+    def import_data_file(namespace: str, filename: str) -> None:
+        """ Moves a JSON file written by IRCD.write_data_file() into `namespace`, once. """
+        if not os.path.exists(f"data/{filename}"):
+            return
+        for key, value in IRCD.read_data_file(filename).items():
+            DataStore.put(namespace, key, value)
+        DataStore.flush()
+        os.replace(f"data/{filename}", f"data/{filename}.imported")
+        logging.info(f"Imported data/{filename} into {DataStore.path}")
+
+    @staticmethod
+    def flush_if_due():
+        if time() - DataStore.last_flush >= DataStore.flush_interval:
+            DataStore.flush()
+
+    @staticmethod
+    def flush():
+        DataStore.last_flush = time()
+        DataStore.take_submitted()
+        if not DataStore.pending:
+            return
+        pending, DataStore.pending = DataStore.pending, {}
+        try:
+            db = DataStore.connect()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO store (namespace, key, value) VALUES (?, ?, ?)",
+                               [(namespace, key, value) for (namespace, key), value in pending.items() if value is not None])
+                db.executemany("DELETE FROM store WHERE namespace=? AND key=?",
+                               [(namespace, key) for (namespace, key), value in pending.items() if value is None])
+        except sqlite3.Error as ex:
+            logging.exception(ex)
+
+
+class HostCache:
+    """
+    Hostnames of recently connected IP addresses, found with a PTR lookup and confirmed by looking up
+    that name again and finding the same IP address. Failed lookups are cached as the IP address itself.
+    Least recently used entries are dropped beyond `max_size`, and entries expire with their DNS TTL.
+    The cache is only used from the main loop, clients from the accept threads are queued in `requests`,
+    also when their IP address is cached.
+    """
+
+    max_size = 10_000
+    max_ttl = 3600
+    # IP -> (expire time, hostname), least recently used first.
+    entries = OrderedDict()
+    # Clients that need a lookup, added from the accept threads and handled by the main loop.
+    requests = deque()
+    # IP -> clients waiting for a lookup of that IP.
+    pending = {}
+    stats = {"lookups": 0, "confirmed": 0, "failed": 0, "cache_hits": 0, "latency": 0.0}
+    last_expire = 0
+
+    @staticmethod
+    def get(ip: str):
+        if (entry := HostCache.entries.get(ip)) and entry[0] > time():
+            HostCache.entries.move_to_end(ip)
+            HostCache.stats["cache_hits"] += 1
+            return entry[1]
+
+    @staticmethod
+    def add(ip: str, host: str, ttl: int):
+        HostCache.entries[ip] = time() + min(ttl, HostCache.max_ttl), host
+        HostCache.entries.move_to_end(ip)
+        while len(HostCache.entries) > HostCache.max_size:
+            HostCache.entries.popitem(last=False)
+
+    @staticmethod
+    def lookup(client):
+        timeout = IRCD.get_setting("resolvehost-timeout")
+        IRCD.delay_client(client, int(timeout) if timeout else 3, "resolvehost")
+        HostCache.requests.append(client)
+
+    @staticmethod
+    def process():
+        while HostCache.requests:
+            client = HostCache.requests.popleft()
+            if (realhost := HostCache.get(client.ip)) is not None:
+                HostCache.deliver(client, realhost, cached=1)
+                continue
+            if waiting := HostCache.pending.get(client.ip):
+                waiting.append(client)
+                continue
+            HostCache.pending[client.ip] = [client]
+            HostCache.stats["lookups"] += 1
+            Resolver.reverse(client.ip, partial(HostCache.ptr_reply, client.ip, time()))
+
+        if time() - HostCache.last_expire >= 60:
+            HostCache.last_expire = time()
+            for ip in [ip for ip, (expire, _) in HostCache.entries.items() if expire <= HostCache.last_expire]:
+                del HostCache.entries[ip]
+
+    @staticmethod
+    def ptr_reply(ip: str, started: float, answers):
+        host = answers[0] if answers else ''
+        if not host or len(host) > 255 or '.' not in host or not all(c in IRCD.HOSTCHARS for c in host.lower()):
+            return HostCache.finish(ip, '', started, Resolver.negative_ttl)
+        Resolver.query(host, "AAAA" if ':' in ip else "A", partial(HostCache.forward_reply, ip, host, started))
+
+    @staticmethod
+    def forward_reply(ip: str, host: str, started: float, answers):
+        address = ipaddress.ip_address(ip)
+        confirmed = any(ipaddress.ip_address(answer) == address for answer in answers or [])
+        HostCache.finish(ip, host if confirmed else '', started, Resolver.max_ttl if confirmed else Resolver.negative_ttl)
+
+    @staticmethod
+    def finish(ip: str, host: str, started: float, ttl: int):
+        HostCache.stats["confirmed" if host else "failed"] += 1
+        HostCache.stats["latency"] += time() - started
+        HostCache.add(ip, host or ip, ttl)
+        for client in HostCache.pending.pop(ip, []):
+            HostCache.deliver(client, host or ip)
+
+    @staticmethod
+    def deliver(client, realhost: str, cached=0):
+        # Clients that registered after their lookup timed out keep their IP address as host.
+        if client.exitted or client.registered:
+            return
+        client.found_host(realhost, cached=cached)
+        IRCD.remove_delay_client(client, "resolvehost")
+
+
+class CidrTree:
+    """
+    Path-compressed binary radix tree keyed by address bits.
+    Each node holds the entries whose network is exactly that node's prefix,
+    so a single walk from the root collects every network containing an address.
+    """
+
+    class Node:
+        __slots__ = ("prefix", "plen", "children", "entries")
+
+        def __init__(self, prefix, plen):
+            self.prefix = prefix
+            self.plen = plen
+            self.children = [None, None]
+            self.entries = []
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        self.root = CidrTree.Node(0, 0)
+        self.size = 0
+
+    def bit(self, value: int, pos: int) -> int:
+        return (value >> (self.bits - pos - 1)) & 1
+
+    def netmask(self, plen: int) -> int:
+        return ((1 << plen) - 1) << (self.bits - plen)
+
+    def insert(self, prefix: int, plen: int, entry) -> None:
+        prefix &= self.netmask(plen)
+        node = self.root
+        while node.plen != plen:
+            bit = self.bit(prefix, node.plen)
+            if not (child := node.children[bit]):
+                node.children[bit] = node = CidrTree.Node(prefix, plen)
+                break
+
+            common = min(self.bits - (child.prefix ^ prefix).bit_length(), child.plen, plen)
+            if common == child.plen:
+                node = child
+                continue
+
+            # Split the edge: `child` and the new prefix diverge at `common`.
+            middle = CidrTree.Node(prefix & self.netmask(common), common)
+            middle.children[self.bit(child.prefix, common)] = child
+            node.children[bit] = middle
+            node = middle
+            if common != plen:
+                node.children[self.bit(prefix, common)] = node = CidrTree.Node(prefix, plen)
+            break
+
+        node.entries.append(entry)
+        self.size += 1
+
+    def remove(self, prefix: int, plen: int, entry) -> None:
+        prefix &= self.netmask(plen)
+        parent, node = None, self.root
+        while node and node.plen < plen:
+            parent, node = node, node.children[self.bit(prefix, node.plen)]
+
+        if not node or node.plen != plen or node.prefix != prefix or entry not in node.entries:
+            return
+
+        node.entries.remove(entry)
+        self.size -= 1
+        if not node.entries and parent:
+            # Collapse nodes that no longer carry entries and have at most one child.
+            if len(children := [c for c in node.children if c]) <= 1:
+                parent.children[self.bit(prefix, parent.plen)] = children[0] if children else None
+
+    def lookup(self, address: int):
+        """ Yields entries of all networks containing `address`, least specific first. """
+        node = self.root
+        while node:
+            if node.plen and (address ^ node.prefix) >> (self.bits - node.plen):
+                return
+            yield from node.entries
+            if node.plen == self.bits:
+                return
+            node = node.children[self.bit(address, node.plen)]
+
+
+class TklIndex:
+    """
+    Lookup structure for all TKLs of a single type.
+    IP and CIDR masks live in a radix tree, exact hosts and nicks in a dict,
+    extended bans are keyed by (ident, value), and only masks with real wildcards
+    are checked linearly.
+    """
+
+    def __init__(self, tkltype: str):
+        self.tkltype = tkltype
+        self.cidr = {4: CidrTree(32), 6: CidrTree(128)}
+        self.exact = {}
+        self.extended = {}
+        self.wildcard = []
+        self.size = 0
+
+    @staticmethod
+    def host_to_network(host: str):
+        """ Returns an ip_network for IP, CIDR and trailing-wildcard IPv4 hosts, otherwise None. """
+        try:
+            if '/' in host:
+                return ipaddress.ip_network(host, strict=False)
+            if '*' not in host and '?' not in host:
+                return ipaddress.ip_network(host)
+        except ValueError:
+            return None
+
+        # 1.2.3.* or 1.2.*, but not a bare * which must also match IPv6 addresses and hostnames.
+        octets = host.split('.')
+        if octets[-1] != '*' or not 2 <= len(octets) <= 4 or not all(o.isdigit() for o in octets[:-1]):
+            return None
+        try:
+            fixed = octets[:-1]
+            return ipaddress.ip_network('.'.join(fixed + ['0'] * (4 - len(fixed))) + f"/{8 * len(fixed)}")
+        except ValueError:
+            return None
+
+    def classify(self, tkl):
+        if tkl.is_extended():
+            return "extended", (tkl.ident, tkl.host.lower())
+        if tkl.network:
+            return "cidr", tkl.network
+        host = tkl.host.lower()
+        if '*' in host or '?' in host:
+            return "wildcard", host
+        return "exact", host
+
+    def add(self, tkl):
+        kind, key = self.classify(tkl)
+        entry = (tkl.ident.lower(), tkl)
+        match kind:
+            case "extended":
+                self.extended.setdefault(key, []).append(tkl)
+            case "cidr":
+                self.cidr[key.version].insert(int(key.network_address), key.prefixlen, entry)
+            case "exact":
+                self.exact.setdefault(key, []).append(entry)
+            case "wildcard":
+                self.wildcard.append((key, *entry))
+        self.size += 1
+
+    def remove(self, tkl):
+        kind, key = self.classify(tkl)
+        entry = (tkl.ident.lower(), tkl)
+        match kind:
+            case "extended":
+                if tkl in (entries := self.extended.get(key, [])):
+                    entries.remove(tkl)
+                    if not entries:
+                        del self.extended[key]
+            case "cidr":
+                self.cidr[key.version].remove(int(key.network_address), key.prefixlen, entry)
+            case "exact":
+                if entry in (entries := self.exact.get(key, [])):
+                    entries.remove(entry)
+                    if not entries:
+                        del self.exact[key]
+            case "wildcard":
+                if (key, *entry) in self.wildcard:
+                    self.wildcard.remove((key, *entry))
+        self.size -= 1
+
+    def find(self, client):
+        """ Returns the first TKL in this index matching `client`, or None. """
+        if not self.size:
+            return
+
+        if self.extended:
+            account = client.user.account.lower()
+            certfp = (client.get_md_value("certfp") or '0').lower()
+            keys = [("~account:", account), ("~certfp:", certfp)]
+            if account == '*':
+                keys.append(("~account:", '0'))
+            for key in keys:
+                if tkls := self.extended.get(key):
+                    return tkls[0]
+
+        ident = (client.user.username or '*').lower()
+        if self.cidr[4].size or self.cidr[6].size:
+            try:
+                address = ipaddress.ip_address(client.ip)
+                for tkl_ident, tkl in self.cidr[address.version].lookup(int(address)):
+                    if tkl_ident == '*' or is_match(tkl_ident, ident):
+                        return tkl
+            except ValueError:
+                pass
+
+        if self.tkltype == 'Q':
+            # Q:Lines are matched against the nickname.
+            name = client.name.lower()
+            if entries := self.exact.get(name):
+                return entries[0][1]
+            return next((tkl for host, _, tkl in self.wildcard if is_match(host, name)), None)
+
+        ip, realhost = client.ip.lower(), client.user.realhost.lower()
+        for subject in {ip, realhost}:
+            for tkl_ident, tkl in self.exact.get(subject, []):
+                if tkl_ident == '*' or is_match(tkl_ident, ident):
+                    return tkl
+
+        for host, tkl_ident, tkl in self.wildcard:
+            if (tkl_ident == '*' or is_match(tkl_ident, ident)) and (is_match(host, ip) or is_match(host, realhost)):
+                return tkl
+
+
 @dataclass
 class TklFlag:
     flag: str = ''
@@ -3519,6 +4258,18 @@ class TklFlag:
 class Tkl:
     table = []
     flags = []
+    # TklIndex per type, and (type, mask) -> Tkl for duplicate lookups.
+    index = {}
+    by_mask = {}
+
+    # Permission and exception type that make a client immune to a TKL type.
+    immune = {
+        'k': ("immune:server-ban:kline", "kline"),
+        'G': ("immune:server-ban:gline", "gline"),
+        'z': ("immune:server-ban:zline:local", "zline"),
+        'Z': ("immune:server-ban:zline:global", "gzline"),
+        's': ("immune:server-ban:shun", "shun"),
+    }
 
     ext_names = {
         "~account:": "~account:",
@@ -3537,6 +4288,9 @@ class Tkl:
         self.set_by = set_by
         self.set_time = set_time
         self.reason = reason
+        self.network = None
+        if _type != 'Q' and not self.is_extended():
+            self.network = TklIndex.host_to_network(host.lower())
 
     @staticmethod
     def add_flag(flag: str, name: str, what: str, host_format: int, is_global: int, allow_eline: int = 0, is_extended: int = 0):
@@ -3592,10 +4346,7 @@ class Tkl:
 
     @staticmethod
     def exists(tkltype, mask):
-        for tkl in Tkl.table:
-            if tkl.type == tkltype and tkl.mask == mask:
-                return tkl
-        return 0
+        return Tkl.by_mask.get((tkltype, mask), 0)
 
     @staticmethod
     def valid_extban(mask):
@@ -3625,6 +4376,8 @@ class Tkl:
             exists = 1
             if int(expire) != int(tkl.expire) or tkl.reason != reason:
                 update, tkl.expire, tkl.reason, tkl.bantypes = 1, expire, reason, bantypes
+                if flag == 'E':
+                    IRCD.except_generation += 1
 
         expire = int(expire)
         expire_string = f"{'never' if expire == 0 else datetime.fromtimestamp(expire).strftime('%a %b %d %Y %H:%M:%S %Z')}"
@@ -3632,6 +4385,10 @@ class Tkl:
         if not tkl:
             tkl = Tkl(client, flag, ident, host, bantypes, expire, set_by, set_time, reason)
             Tkl.table.append(tkl)
+            Tkl.by_mask[(flag, mask)] = tkl
+            Tkl.index.setdefault(flag, TklIndex(flag)).add(tkl)
+            if flag == 'E':
+                IRCD.except_generation += 1
             matches = Tkl.find_matches(tkl)
             if flag in "kGzZ":
                 for c in matches:
@@ -3643,7 +4400,8 @@ class Tkl:
         if (client.user and (client.uplink == IRCD.me or client.uplink.server.synced)) or \
                 (client == IRCD.me or client.server.synced) and not silent:
             msg = f"*** {'Global ' if tkl.is_global else ''}{tkl.name}{bt_string} {'active' if not update and not exists else 'updated'} for {tkl.mask} by {set_by} [{reason}] expires on: {expire_string}"
-            IRCD.log(client, "info", "tkl", "TKL_ADD", msg, sync=not tkl.is_global)
+            IRCD.log(client, "info", "tkl", "TKL_ADD", msg, sync=not tkl.is_global,
+                     type=tkl.name, mask=tkl.mask, set_by=set_by, expire=tkl.expire, reason=reason)
 
         if tkl.is_global:
             if flag == 'E':
@@ -3660,25 +4418,27 @@ class Tkl:
         if flag not in Tkl.valid_flags():
             return
 
-        for tkl in list(Tkl.table):
-            tkl_match = (tkl.ident, tkl.host) == (ident, host) or (tkl.type == 'Q' and tkl.host == host)
-            if tkl.type == flag and tkl_match:
-                Tkl.table.remove(tkl)
+        if tkl := Tkl.by_mask.pop((flag, Tkl.get_mask(flag, ident, host)), None):
+            Tkl.table.remove(tkl)
+            Tkl.index[flag].remove(tkl)
+            if flag == 'E':
+                IRCD.except_generation += 1
 
-                if client == IRCD.me or client.registered:
-                    date = f"{datetime.fromtimestamp(float(tkl.set_time)).strftime('%a %b %d %Y')} {datetime.fromtimestamp(float(tkl.set_time)).strftime('%H:%M:%S')}"
-                    msg = f"*** {'Expiring ' if tkl.expire else ''}{'Global ' if tkl.is_global else ''}{tkl.name} {tkl.mask} removed by {client.fullrealhost} (set by {tkl.set_by} on {date}) [{tkl.reason}]"
-                    sync = not tkl.is_global
-                    IRCD.log(client, "info", "tkl", "TKL_DEL", msg, sync=sync)
+            if client == IRCD.me or client.registered:
+                date = f"{datetime.fromtimestamp(float(tkl.set_time)).strftime('%a %b %d %Y')} {datetime.fromtimestamp(float(tkl.set_time)).strftime('%H:%M:%S')}"
+                msg = f"*** {'Expiring ' if tkl.expire else ''}{'Global ' if tkl.is_global else ''}{tkl.name} {tkl.mask} removed by {client.fullrealhost} (set by {tkl.set_by} on {date}) [{tkl.reason}]"
+                sync = not tkl.is_global
+                IRCD.log(client, "info", "tkl", "TKL_DEL", msg, sync=sync, type=tkl.name, mask=tkl.mask, set_by=tkl.set_by, reason=tkl.reason)
 
-                if tkl.is_global:
-                    data = f":{client.id} TKL - {flag} {tkl.ident} {tkl.host}"
-                    IRCD.send_to_servers(client, [], data)
+            if tkl.is_global:
+                data = f":{client.id} TKL - {flag} {tkl.ident} {tkl.host}"
+                IRCD.send_to_servers(client, [], data)
 
-                if tkl.type == 's':
-                    for shun_client in Tkl.find_matches(tkl):
-                        if shun_client.is_shunned():
-                            shun_client.flags.remove(Flag.CLIENT_SHUNNED)
+            if tkl.type == 's':
+                for shun_client in Tkl.find_matches(tkl):
+                    shun_client.del_flag(Flag.CLIENT_SHUNNED)
+                    # Still shunned if another shun matches.
+                    Tkl.is_match(shun_client, 's')
 
     def do_ban(self, client):
         if client.exitted:
@@ -3690,10 +4450,50 @@ class Tkl:
 
     @staticmethod
     def find_tkl_by_mask(tkltype, mask):
+        if not (index := Tkl.index.get(tkltype)) or not index.size:
+            return
+        mask = mask.lower()
+        if tkltype == 'Q':
+            if entries := index.exact.get(mask):
+                return entries[0][1]
+            return next((tkl for host, _, tkl in index.wildcard if is_match(host, mask)), None)
         for tkl in [tkl for tkl in Tkl.table if tkl.type == tkltype]:
-            if is_match(tkl.mask.lower(), mask.lower()):
+            if is_match(tkl.mask.lower(), mask):
                 return tkl
 
+    def matches(self, client) -> int:
+        """ Check this single TKL against `client`, ignoring exceptions. """
+        if self.is_extended():
+            if self.ident == "~account:":
+                return (self.host == '0' and client.user.account == '*') or client.user.account.lower() == self.host.lower()
+            if self.ident == "~certfp:":
+                fp = client.get_md_value("certfp")
+                return fp.lower() == self.host.lower() if fp else self.host == '0'
+            return 0
+
+        if self.type == 'Q':
+            return is_match(self.host.lower(), client.name.lower())
+
+        ident = (client.user.username or '*').lower()
+        if self.ident != '*' and not is_match(self.ident.lower(), ident):
+            return 0
+
+        if self.network:
+            try:
+                return ipaddress.ip_address(client.ip) in self.network
+            except ValueError:
+                return 0
+
+        host = self.host.lower()
+        return is_match(host, client.ip.lower()) or is_match(host, client.user.realhost.lower())
+
+    @staticmethod
+    def is_exempt(client, tkltype) -> int:
+        if tkltype not in Tkl.immune:
+            return 0
+        permission, what = Tkl.immune[tkltype]
+        return client.has_permission(permission) or IRCD.is_except_client(what, client)
+
     @staticmethod
     def is_match(client, tkltype):
         """
@@ -3705,52 +4505,25 @@ class Tkl:
         if not client.user or client.has_permission("immune:server-ban"):
             return
 
-        for tkl in [tkl for tkl in Tkl.table if tkl.type in tkltype]:
-            if tkl.type == 'k' and (client.has_permission("immune:server-ban:kline") or IRCD.is_except_client("kline", client)):
-                continue
-            if tkl.type == 'G' and (client.has_permission("immune:server-ban:gline") or IRCD.is_except_client("gline", client)):
-                continue
-            if tkl.type == 'z' and (client.has_permission("immune:server-ban:zline:local") or IRCD.is_except_client("zline", client)):
-                continue
-            if tkl.type == 'Z' and (client.has_permission("immune:server-ban:zline:global") or IRCD.is_except_client("gzline", client)):
-                continue
-            if tkl.type == 's' and (client.has_permission("immune:server-ban:shun") or IRCD.is_except_client("shun", client)):
+        for flag in tkltype:
+            if not (index := Tkl.index.get(flag)) or not (tkl := index.find(client)):
                 continue
-
-            if tkl.is_extended():
-                if tkl.ident == "~account:":
-                    if tkl.host == '0' and client.user.account == '*':
-                        return tkl
-                    if client.user.account.lower() == tkl.host.lower():
-                        return tkl
-                if tkl.ident == "~certfp:":
-                    if fp := client.get_md_value("certfp"):
-                        if tkl.host.lower() == fp.lower():
-                            return tkl
-                    else:
-                        if tkl.host == '0':
-                            return tkl
+            if Tkl.is_exempt(client, flag):
                 continue
-
-            if tkl.type in "GkZzs":
-                ident = '*' if not client.user.username else client.user.username
-                test_cases = [f"{ident.lower()}@{client.ip}", f"{ident.lower()}@{client.ip}"]
-                for test in test_cases:
-                    if is_match(tkl.mask.lower(), test):
-                        if tkl.type == 's' and not client.is_shunned():
-                            client.add_flag(Flag.CLIENT_SHUNNED)
-                        return tkl
-
-            elif tkl.type == 'Q':
-                if is_match(tkl.host.lower(), client.name.lower()):
-                    return tkl
+            if tkl.type == 's' and not client.is_shunned():
+                client.add_flag(Flag.CLIENT_SHUNNED)
+            return tkl
 
     @staticmethod
     def find_matches(tkl):
+        """ Returns all local users matching this single TKL. """
         matches = []
         for user_client in IRCD.local_users():
-            if Tkl.is_match(user_client, tkl.type):
-                matches.append(user_client)
+            if user_client.has_permission("immune:server-ban") or not tkl.matches(user_client):
+                continue
+            if Tkl.is_exempt(user_client, tkl.type):
+                continue
+            matches.append(user_client)
 
         return matches
 
@@ -3764,14 +4537,28 @@ class Tkl:
 class LogEntry:
     color_table = {"warn": '7', "error": '4', "info": '3'}
 
-    def __init__(self, client, level, rootevent, event, message):
+    def __init__(self, client, level, rootevent, event, message, fields=None):
         self.client = client
         self.level = level
         self.rootevent = rootevent
         self.event = event
         self.message = message
+        self.fields = fields or {}
         self.snomask = Log.event_to_snomask(rootevent, event)
 
+    def as_dict(self, client) -> dict:
+        """ Structured form of this entry for the JSON event log. `client` is the client the event is about. """
+        entry = {"time": round(time(), 3), "level": self.level, "rootevent": self.rootevent, "event": self.event, "server": self.client.name}
+        if client.user:
+            entry.update(nick=client.name, uid=client.id, ident=client.user.username, host=client.user.realhost, ip=client.ip)
+            if client.user.account != '*':
+                entry["account"] = client.user.account
+        if self.fields:
+            entry.update(self.fields)
+        else:
+            entry["message"] = self.message
+        return entry
+
 
 class Log:
     event_map = {
@@ -3796,10 +4583,70 @@ class Log:
         ("nick", "REMOTE_NICK_CHANGE"): 'N',
     }
 
+    # Snomask, log channel and SLOG delivery is limited to `rate_limit` events per second for each rootevent.
+    # Events over the limit are counted, and reported in one line by flush_suppressed(), also to other servers.
+    rate_limit = 20
+    # Rootevent -> [second, events in that second, suppressed events]
+    rate_state = {}
+    log_channel = None
+    log_channel_checked = 0
+
     @staticmethod
     def event_to_snomask(rootevent, event):
         return Log.event_map.get((rootevent, event), Log.event_map.get((rootevent, None), 's'))
 
+    @staticmethod
+    def allow(rootevent: str) -> int:
+        now = int(time())
+        state = Log.rate_state.setdefault(rootevent, [now, 0, 0])
+        if state[0] != now:
+            state[0], state[1] = now, 0
+        state[1] += 1
+        if state[1] > Log.rate_limit:
+            state[2] += 1
+            return 0
+        return 1
+
+    @staticmethod
+    def flush_suppressed():
+        """ Called from the main loop. """
+        now = int(time())
+        for rootevent, state in Log.rate_state.items():
+            if state[2] and state[0] != now:
+                message = f"{state[2]} {rootevent} event{'s' if state[2] != 1 else ''} not shown on {IRCD.me.name} because of the log rate limit"
+                state[2] = 0
+                log_entry = LogEntry(IRCD.me, "warn", rootevent, "LOG_SUPPRESSED", message)
+                Log.deliver(IRCD.me, log_entry)
+                # Suppressed events are not sent to other servers either, so they get the count too.
+                Log.log_to_remote(log_entry)
+
+    @staticmethod
+    def get_log_channel():
+        if not (name := IRCD.get_setting("logchan")):
+            return
+        channel = Log.log_channel
+        if channel and channel.membercount > 0 and channel.name.lower() == name.lower():
+            return channel
+        # Look the channel up again at most once per second.
+        if int(time()) != Log.log_channel_checked:
+            Log.log_channel_checked = int(time())
+            Log.log_channel = IRCD.find_channel(name)
+        return Log.log_channel
+
+    @staticmethod
+    def deliver(client, log_entry: LogEntry):
+        """ Shows `log_entry` to the snomask receivers and in the log channel. """
+        level, rootevent, message = log_entry.level, log_entry.rootevent, log_entry.message
+        level_colored = f"{LogEntry.color_table.get(level, '')}[{level}]" if level in LogEntry.color_table else f"[{level}]"
+        out_msg = f"{level_colored} ({rootevent}) {message}"
+
+        if log_entry.snomask:
+            IRCD.send_snomask(client, log_entry.snomask, out_msg, sendsno=0)
+
+        if log_chan := Log.get_log_channel():
+            source = log_entry.client
+            log_chan.broadcast(source, f":{source.name} PRIVMSG {log_chan.name} :{out_msg}")
+
     @staticmethod
     def log_to_remote(log_entry: LogEntry):
         if IRCD.boottime:
@@ -3808,23 +4655,24 @@ class Log:
             IRCD.send_to_servers(log_entry.client.direction, [], data)
 
     @staticmethod
-    def log(client, level: str, rootevent: str, event: str, message: str, sync: int = 1):
+    def log(client, level: str, rootevent: str, event: str, message: str, sync: int = 1, **fields):
         """
         client:     Client information for the log event
+        fields:     Structured details for the JSON event log, such as channel or reason
         """
 
         source = client if client.server else client.uplink
-        log_entry = LogEntry(source, level, rootevent, event, message)
+        log_entry = LogEntry(source, level, rootevent, event, message, fields)
 
-        level_colored = f"{LogEntry.color_table.get(level, '')}[{level}]" if level in LogEntry.color_table else f"[{level}]"
-        # out_msg = f"14{rootevent}.{event} {level_colored} {message}"
-        out_msg = f"{level_colored} ({rootevent}) {message}"
+        if path := IRCD.get_setting("eventlog-json"):
+            JsonEventLog.write(path, log_entry.as_dict(client))
+        elif JsonEventLog.path:
+            JsonEventLog.close()
 
-        if log_entry.snomask:
-            IRCD.send_snomask(client, log_entry.snomask, out_msg, sendsno=0)
+        if not Log.allow(rootevent):
+            return
 
-        if log_chan := IRCD.find_channel(IRCD.get_setting("logchan")):
-            log_chan.broadcast(source, f":{source.name} PRIVMSG {log_chan.name} :{out_msg}")
+        Log.deliver(client, log_entry)
 
         if sync:
             Log.log_to_remote(log_entry)
@@ -1,5 +1,6 @@
 import base64
 import binascii
+import re
 import string
 import socket
 from handle.logger import logging
@@ -138,3 +139,13 @@ def is_match(first, second):
         return is_match(first[1:], second[1:])
     else:
         return False
+
+
+def glob_to_regex(glob: str) -> str:
+    """ Translates a glob as used by is_match() into an equivalent regex, to be used with fullmatch(). """
+    return ''.join(".*" if c == '*' else '.' if c == '?' else re.escape(c) for c in glob)
+
+
+def compile_globs(globs) -> re.Pattern:
+    """ Compiles one or more globs into a single pattern. fullmatch() succeeds if any of the globs would match. """
+    return re.compile('|'.join(f"(?:{glob_to_regex(glob)})" for glob in globs), re.DOTALL)
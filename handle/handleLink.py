@@ -7,81 +7,10 @@ import OpenSSL
 
 from classes.errors import Error
 from handle.client import make_client, make_server
-from handle.core import IRCD, Isupport, Client, Channel, Hook, Extban
+from handle.core import IRCD, Isupport, Channel, Hook, Extban, Tkl
 from handle.logger import logging
 
 
-def sync_channels(newserver):
-    if newserver.exitted:
-        return
-
-    logging.debug(f"Syncing channels to {newserver.name}")
-
-    try:
-        for channel in [c for c in IRCD.get_channels() if c.name[0] != '&']:
-            first_sjoin = 1
-            modeparams = []
-            for mode in channel.modes:
-                if param := channel.get_param(mode):
-                    modeparams.append(param)
-
-            modeparams = f" {' '.join(modeparams)}" if modeparams else f"{' '.join(modeparams)}"
-            memberlist = []
-
-            for client in channel.clients():
-                prefix = ''
-                for cmode in [cmode for cmode in channel.get_membermodes_sorted() if channel.client_has_membermodes(client, cmode.flag)]:
-                    prefix += cmode.sjoin_prefix
-                member = prefix + client.id
-                memberlist.append(member)
-
-            if memberlist:
-                memberlist = ' '.join(memberlist)
-
-            list_entries = []
-            for mode in channel.List:
-                cmode = IRCD.get_channelmode_by_flag(mode)
-                sjoin_prefix = cmode.sjoin_prefix
-                for entry in channel.List[mode]:
-                    string = ''
-                    if "SJSBY" in newserver.local.protoctl:
-                        string = f"<{entry.set_time},{entry.set_by}>"
-
-                    if entry.mask.startswith(Extban.symbol):
-                        string += sjoin_prefix + Extban.convert_param(entry.mask, convert_to_name=0)
-                    else:
-                        string += sjoin_prefix + entry.mask
-
-                    list_entries.append(string)
-
-            if list_entries:
-                list_entries = ' '.join(list_entries)
-
-            sjoin_list = []
-
-            if memberlist:
-                sjoin_list.extend(memberlist.split())
-
-            if list_entries:
-                sjoin_list.extend(list_entries.split())
-
-            for i in range(0, len(sjoin_list), 20):
-                split_sjoin_list = sjoin_list[i:i + 20]
-                sjoin_modes = f"+{channel.modes}{modeparams} " if first_sjoin else ''
-                data = f"{channel.creationtime} {channel.name} {sjoin_modes}:{' '.join(split_sjoin_list)}"
-                newserver.send([], f":{IRCD.me.id} SJOIN {data}")
-                first_sjoin = 0
-
-            if channel.topic:
-                data = f":{IRCD.me.id} TOPIC {channel.name} {channel.topic_author} {channel.topic_time} :{channel.topic}"
-                newserver.send([], data)
-
-            IRCD.run_hook(Hook.SERVER_SJOIN_OUT, newserver, channel)
-
-    except Exception as ex:
-        logging.exception(ex)
-
-
 def broadcast_network_to_new_server(newserver):
     if newserver.exitted:
         return
@@ -123,37 +52,163 @@ def start_link_negotiation(newserver):
     IRCD.run_hook(Hook.SERVER_LINK_POST_NEGOTATION, newserver)
 
 
-def sync_users(newserver):
-    if newserver.exitted:
-        return
+class Burst:
+    """
+    Netburst to a newly linked server, produced by a generator so that it can be paused.
+    Lines are written to the send buffer of the link until it holds more than `watermark` bytes,
+    after which the burst yields to the main loop and is resumed once the buffer has been flushed.
+    Several bursts can run at once: network changes meant for a server are held back in
+    IRCD.send_after_eos while our burst to it runs, and are sent right after it.
+    """
+
+    table = []
+    watermark = 65536
+
+    def __init__(self, server):
+        self.server = server
+        self.started = time.time()
+        # Category -> bytes sent.
+        self.sent = {}
+        self.lines = self.generate()
+
+    @staticmethod
+    def start(server):
+        burst = Burst(server)
+        if burst.resume():
+            Burst.table.append(burst)
+
+    @staticmethod
+    def process():
+        for burst in list(Burst.table):
+            if not burst.resume():
+                Burst.table.remove(burst)
+
+    def resume(self) -> int:
+        """ Returns 1 if there is more to send. """
+        if self.server.exitted:
+            self.lines.close()
+            return 0
+        try:
+            while len(self.server.local.sendbuffer) < Burst.watermark:
+                next(self.lines)
+        except StopIteration:
+            self.finish()
+            return 0
+        except Exception as ex:
+            logging.exception(ex)
+            self.finish()
+            return 0
+        return 1
+
+    def finish(self):
+        """ Sends the data that was held back during the burst, in the order it was queued. """
+        newserver = self.server
+        newserver.server.burst_sent = 1
+        if held := IRCD.send_after_eos.pop(newserver, None):
+            logging.debug(f"Now sending {len(held)} previously held back lines to {newserver.name}")
+            for mtags, data in held:
+                newserver.send(mtags, data)
+
+    def max_line(self) -> int:
+        return 16384 if "BIGLINES" in self.server.local.protoctl else 510
+
+    def send(self, category: str, mtags: list, data: str):
+        self.server.send(mtags, data)
+        self.sent[category] = self.sent.get(category, 0) + len(data) + 2
+
+    def track(self, category: str, func, *args):
+        """ Runs `func`, which sends to the link directly, and counts what it added to the send buffer. """
+        before = len(self.server.local.sendbuffer)
+        func(*args)
+        self.sent[category] = self.sent.get(category, 0) + max(0, len(self.server.local.sendbuffer) - before)
+
+    def generate(self):
+        newserver = self.server
+        # Channel members are taken together with the users, changes after this are held back until the burst is done.
+        # This way every member in an SJOIN has been introduced before it, even if it joined while the burst was paused.
+        users = [c for c in IRCD.global_registered_users() if c.direction != newserver]
+        channels = [(c, [(client, member.modes) for client, member in c.member_by_client.items()]) for c in IRCD.get_channels() if c.name[0] != '&']
+
+        logging.debug(f"Syncing all global registered users to {newserver.name}")
+        synced = set()
+        for client in users:
+            if client.registered and not client.exitted:
+                self.track("users", client.sync, newserver, "sync_users()")
+                synced.add(client)
+                yield
+
+        logging.debug(f"Syncing channels to {newserver.name}")
+        membermodes = Channel.get_membermodes_sorted()
+        for channel, members in channels:
+            if channel in Channel.table:
+                members = [(client, modes) for client, modes in members if client in synced or client.direction == newserver]
+                yield from self.sjoin(channel, members, membermodes)
+
+        for tkl in [tkl for tkl in Tkl.table if tkl.type in Tkl.global_flags()]:
+            data = f":{IRCD.me.id} TKL + {tkl.type} {tkl.ident} {tkl.host} {tkl.set_by} {tkl.expire} {tkl.set_time} {tkl.bantypes}:{tkl.reason}"
+            self.send("tkl", [], data)
+            yield
+
+        cloakhash = IRCD.get_setting("cloak-key")
+        cloakhash = hashlib.md5(cloakhash.encode("utf-8")).hexdigest()
+        data = f":{IRCD.me.id} NETINFO {IRCD.maxgusers} {int(time.time())} {IRCD.versionnumber.replace('.', '')} MD5:{cloakhash} {IRCD.boottime} 0 0 :{IRCD.me.info}"
+        newserver.send([], data)
 
-    logging.debug(f"Syncing all global registered users to {newserver.name}")
-    for client in [c for c in IRCD.global_registered_users() if c.direction != newserver and c.registered]:
-        # logging.debug(f"Syncing user {client.name} (UID: {client.id}) (uplink={client.uplink.name}, direction={client.direction.name}) to {newserver.name}")
-        client.sync(server=newserver, cause="sync_users()")
+        self.track("other", IRCD.run_hook, Hook.SERVER_SYNC, newserver)
+
+        logging.debug(f"We ({IRCD.me.name}) are done syncing to {newserver.name}, sending EOS.")
+        newserver.send([], f":{IRCD.me.id} EOS")
+        for server_client in [c for c in IRCD.global_servers() if c not in [IRCD.me, newserver] and c.server.synced]:
+            newserver.send([], f":{server_client.id} EOS")
+
+        totals = ', '.join(f"{category}: {sent} bytes" for category, sent in self.sent.items()) or "nothing to send"
+        IRCD.log(IRCD.me, "info", "link", "LINK_BURST",
+                 f"Burst to {newserver.name} completed in {time.time() - self.started:.2f} seconds ({totals})", sync=0)
+
+    def sjoin(self, channel, members: list, membermodes: list):
+        """
+        Sends the SJOIN lines of `channel`, each packed with as many members and list entries as fit.
+        `members` holds (client, member modes) pairs, as they were when the burst started.
+        """
+        newserver = self.server
+        modeparams = ''.join(f" {param}" for mode in channel.modes if (param := channel.get_param(mode)))
+
+        entries = []
+        for client, modes in members:
+            entries.append(''.join(cmode.sjoin_prefix for cmode in membermodes if cmode.flag in modes) + client.id)
+
+        for mode in channel.List:
+            sjoin_prefix = IRCD.get_channelmode_by_flag(mode).sjoin_prefix
+            for entry in channel.List[mode]:
+                string = f"<{entry.set_time},{entry.set_by}>" if "SJSBY" in newserver.local.protoctl else ''
+                mask = Extban.convert_param(entry.mask, convert_to_name=0) if entry.mask.startswith(Extban.symbol) else entry.mask
+                entries.append(string + sjoin_prefix + mask)
+
+        prefix = f":{IRCD.me.id} SJOIN {channel.creationtime} {channel.name} "
+        head = f"{prefix}+{channel.modes}{modeparams} :"
+        line, count = head, 0
+        for entry in entries:
+            if count and len(line) + len(entry) + 1 > self.max_line():
+                self.send("channels", [], line)
+                yield
+                line, count = prefix + ':', 0
+            line += (' ' if count else '') + entry
+            count += 1
+        if count:
+            self.send("channels", [], line)
+
+        if channel.topic:
+            data = f":{IRCD.me.id} TOPIC {channel.name} {channel.topic_author} {channel.topic_time} :{channel.topic}"
+            self.send("channels", [], data)
+
+        self.track("channels", IRCD.run_hook, Hook.SERVER_SJOIN_OUT, newserver, channel)
+        yield
 
 
 def sync_data(newserver):
     if newserver.exitted:
         return
-
-    if Client.table:
-        sync_users(newserver)
-
-    if Channel.table:
-        sync_channels(newserver)
-
-    cloakhash = IRCD.get_setting("cloak-key")
-    cloakhash = hashlib.md5(cloakhash.encode("utf-8")).hexdigest()
-    data = f":{IRCD.me.id} NETINFO {IRCD.maxgusers} {int(time.time())} {IRCD.versionnumber.replace('.', '')} MD5:{cloakhash} {IRCD.boottime} 0 0 :{IRCD.me.info}"
-    newserver.send([], data)
-
-    IRCD.run_hook(Hook.SERVER_SYNC, newserver)
-
-    logging.debug(f"We ({IRCD.me.name}) are done syncing to {newserver.name}, sending EOS.")
-    newserver.send([], f":{IRCD.me.id} EOS")
-    for server_client in [c for c in IRCD.global_servers() if c not in [IRCD.me, newserver] and c.server.synced]:
-        newserver.send([], f":{server_client.id} EOS")
+    Burst.start(newserver)
 
 
 def deny_direct_link(client, error: int, *args):
@@ -177,7 +232,6 @@ def start_outgoing_link(link, tls=0, auto_connect=0):
             host = socket.gethostbyname(host)
 
         client = make_client(direction=None, uplink=IRCD.me)
-        IRCD.current_link_sync = client
         make_server(client)
         client.server.link = link
         client.local.socket = socket.socket()
@@ -1,6 +1,11 @@
 import logging.handlers
+import atexit
 import datetime
+import gzip
+import json
 import logging
+import queue
+import shutil
 import time
 import sys
 import os
@@ -26,6 +31,7 @@ class EnhancedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
         if self.stream is None:
             self.stream = self._open()
 
+        # LogFormatter caches the formatted record, so emit() does not format it again.
         if 0 < self.maxBytes <= self.stream.tell() + len(self.format(record) + '\n'):
             return 1
 
@@ -91,21 +97,53 @@ class EnhancedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
         self.rolloverAt = newRolloverAt
 
     def delete_old_files(self):
+        """ Removes expired backups of this log file, and the oldest backups above backupCount. """
         dir_name, base_name = os.path.split(self.baseFilename)
-        files = [os.path.join(dir_name, f) for f in os.listdir(dir_name) if os.path.isfile(os.path.join(dir_name, f))]
-
-        for fn in files:
-            if fn == self.baseFilename:
-                continue
-
-            if self.backupExpire and (time.time() - os.path.getmtime(fn)) > self.backupExpire:
+        mtimes = {}
+        with os.scandir(dir_name) as entries:
+            for entry in entries:
+                if entry.name.startswith(base_name + '.') and entry.is_file():
+                    mtimes[entry.path] = entry.stat().st_mtime
+
+        now = time.time()
+        for fn, mtime in list(mtimes.items()):
+            if self.backupExpire and now - mtime > self.backupExpire:
                 os.remove(fn)
+                del mtimes[fn]
 
-        oldest = sorted(files, key=os.path.getmtime)
+        oldest = sorted(mtimes, key=mtimes.get)
         for fn in oldest[:-self.backupCount]:
             os.remove(fn)
 
 
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a bounded queue, from which IRCDLogger.listener writes them in its own thread.
+    When the queue is full, records are dropped and counted. The count is logged once there is room again.
+    """
+
+    def __init__(self, maxsize: int = 10_000):
+        super().__init__(queue.Queue(maxsize))
+        # Only the message itself (and traceback) is merged here, the handlers add the rest.
+        self.setFormatter(logging.Formatter("%(message)s"))
+        self.dropped = 0
+        self.total_dropped = 0
+
+    def dropped_record(self):
+        message = f"Log queue was full, {self.dropped} log records have been dropped."
+        return logging.LogRecord(__name__, logging.WARNING, __file__, 0, message, None, None)
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(self.dropped_record())
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.total_dropped += 1
+
+
 if not os.path.exists("logs"):
     os.mkdir("logs")
 
@@ -119,16 +157,27 @@ BOLD_SEQ = "\033[1m"
 COLORS = dict(WARNING=YELLOW, INFO=BLUE, DEBUG=WHITE, CRITICAL=YELLOW, ERROR=RED)
 
 
+class LogListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room, so that stopping never fails on a full queue.
+        self.queue.put(self._sentinel)
+
+
 class PackagePathFilter(logging.Filter):
+    relative_paths = {}
+
     def filter(self, record):
         pathname = record.pathname
-        record.relativepath = None
-        abs_sys_paths = map(os.path.abspath, sys.path)
-        for path in sorted(abs_sys_paths, key=len, reverse=True):  # longer paths first
-            path = path if path.endswith(os.sep) else path + os.sep
-            if pathname.startswith(path):
-                record.relativepath = os.path.relpath(pathname, path)
-                break
+        if (relativepath := PackagePathFilter.relative_paths.get(pathname, 0)) == 0:
+            relativepath = None
+            abs_sys_paths = map(os.path.abspath, sys.path)
+            for path in sorted(abs_sys_paths, key=len, reverse=True):  # longer paths first
+                path = path if path.endswith(os.sep) else path + os.sep
+                if pathname.startswith(path):
+                    relativepath = os.path.relpath(pathname, path)
+                    break
+            PackagePathFilter.relative_paths[pathname] = relativepath
+        record.relativepath = relativepath
         return True
 
 
@@ -138,15 +187,96 @@ class LogFormatter(logging.Formatter):
         self.color = color
 
     def format(self, record):
-        if self.color and (levelname := record.levelname) in COLORS:
-            record.levelname = f"{COLOR_SEQ % (30 + COLORS[levelname])}{levelname}{RESET_SEQ}"
-        return super().format(record)
+        """ Formats each record only once per output style, because it is passed to several handlers. """
+        cache = record.__dict__.setdefault("formatted", {})
+        if (formatted := cache.get(self.color)) is None:
+            levelname = record.levelname
+            if self.color and levelname in COLORS:
+                record.levelname = f"{COLOR_SEQ % (30 + COLORS[levelname])}{levelname}{RESET_SEQ}"
+            formatted = cache[self.color] = super().format(record)
+            record.levelname = levelname
+        return formatted
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        if (formatted := record.__dict__.get("json")) is None:
+            formatted = record.json = json.dumps(record.msg, separators=(',', ':'), default=str)
+        return formatted
+
+
+class JsonQueueHandler(BoundedQueueHandler):
+    def prepare(self, record):
+        # Keep the event as a dict, it is serialised in the writer thread.
+        return record
+
+    def dropped_record(self):
+        event = {"time": round(time.time(), 3), "level": "warn", "rootevent": "log", "event": "LOG_DROPPED", "dropped": self.dropped}
+        return logging.LogRecord("events", logging.WARNING, __file__, 0, event, None, None)
+
+
+def gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class JsonEventLog:
+    """
+    Optional sink that writes every IRCD.log() event as one JSON object per line,
+    enabled with the `eventlog-json` setting. Rotated files are gzip compressed.
+    Events have their own bounded queue and writer thread.
+    """
+
+    path = None
+    handler = None
+    queue_handler = None
+    listener = None
+
+    @staticmethod
+    def open(path: str):
+        JsonEventLog.close()
+        handler = EnhancedRotatingFileHandler(path, when="midnight", maxBytes=1_000 * 1_000 * 100, backup_count=90, backupExpire=31_536_000)
+        handler.setFormatter(JsonFormatter())
+        handler.namer = lambda name: name + ".gz"
+        handler.rotator = gzip_rotator
+        JsonEventLog.path, JsonEventLog.handler = path, handler
+        JsonEventLog.queue_handler = JsonQueueHandler()
+        JsonEventLog.start()
+
+    @staticmethod
+    def close():
+        JsonEventLog.stop()
+        if JsonEventLog.handler:
+            JsonEventLog.handler.close()
+        JsonEventLog.path = JsonEventLog.handler = JsonEventLog.queue_handler = None
+
+    @staticmethod
+    def start():
+        if JsonEventLog.handler and not JsonEventLog.listener:
+            JsonEventLog.listener = LogListener(JsonEventLog.queue_handler.queue, JsonEventLog.handler)
+            JsonEventLog.listener.start()
+
+    @staticmethod
+    def stop():
+        if JsonEventLog.listener:
+            JsonEventLog.listener.stop()
+            JsonEventLog.listener = None
+
+    @staticmethod
+    def write(path: str, event: dict):
+        """ Queues `event` for the file at `path`. The file is (re)opened when the configured path changes. """
+        if path != JsonEventLog.path:
+            JsonEventLog.open(path)
+        JsonEventLog.queue_handler.handle(logging.LogRecord("events", logging.INFO, __file__, 0, event, None, None))
 
 
 class IRCDLogger:
     forked = 0
     file_handler = None
     stream_handler = None
+    queue_handler = None
+    listener = None
     log = None
     loghandlers = []
 
@@ -175,10 +305,27 @@ class IRCDLogger:
             logging.warning("Pausing for 5 seconds for visibility...")
             time.sleep(5)
 
+    @staticmethod
+    def start():
+        """ Starts the writer threads. A new listener is made every time, because threads do not survive a fork. """
+        IRCDLogger.listener = LogListener(IRCDLogger.queue_handler.queue, *IRCDLogger.loghandlers, respect_handler_level=True)
+        IRCDLogger.listener.start()
+
+    @staticmethod
+    def stop():
+        """ Writes out all queued records and stops the writer thread. """
+        if IRCDLogger.listener:
+            if IRCDLogger.queue_handler.dropped:
+                IRCDLogger.queue_handler.queue.put(IRCDLogger.queue_handler.dropped_record())
+                IRCDLogger.queue_handler.dropped = 0
+            IRCDLogger.listener.stop()
+            IRCDLogger.listener = None
+
     @staticmethod
     def fork():
-        logging.getLogger().removeHandler(IRCDLogger.stream_handler)
+        IRCDLogger.stop()
         IRCDLogger.loghandlers.remove(IRCDLogger.stream_handler)
+        IRCDLogger.start()
 
     @staticmethod
     def debug():
@@ -219,4 +366,11 @@ handlers.append(stream_handler)
 IRCDLogger.stream_handler = stream_handler
 
 IRCDLogger.loghandlers.extend(handlers)
-logging.basicConfig(level=logging.DEBUG, handlers=IRCDLogger.loghandlers)
+
+# Records are only put on a queue in the calling thread. Formatting and writing happens in the listener thread.
+IRCDLogger.queue_handler = BoundedQueueHandler()
+logging.basicConfig(level=logging.DEBUG, handlers=[IRCDLogger.queue_handler])
+IRCDLogger.start()
+atexit.register(IRCDLogger.stop)
+# Runs before IRCDLogger.stop, so events are written out before the text log closes.
+atexit.register(JsonEventLog.stop)
@@ -0,0 +1,292 @@
+"""
+Non-blocking DNS resolver over UDP.
+Sockets are polled from the main loop with Resolver.process(), so lookups never block the server.
+"""
+
+import ipaddress
+import secrets
+import selectors
+import socket
+import struct
+import threading
+from collections import deque
+from time import time
+
+from handle.logger import logging
+
+QTYPES = {"A": 1, "PTR": 12, "AAAA": 28}
+TYPE_SOA = 6
+RCODE_NXDOMAIN = 3
+
+
+class DnsQuery:
+    def __init__(self, name: str, qtype: str):
+        self.name = name
+        self.qtype = qtype
+        self.id = 0
+        self.tries = 0
+        self.sent = 0
+        self.nameserver = None
+        # The name as sent, with random letter case. The reply must repeat it exactly.
+        self.wire_name = name
+        # Set when a nameserver does not keep the letter case, further attempts are sent in lowercase.
+        self.plain_case = 0
+        self.sock = None
+        # Functions to call with the result, one for every caller that asked the same question.
+        self.callbacks = []
+
+
+class Resolver:
+    """
+    Identical questions in flight are merged into one query.
+    Answers and NXDOMAIN/no-data replies are cached for their TTL.
+    At most `max_inflight` queries are sent at once, the rest wait in a queue.
+
+    Callbacks receive a list of answers, an empty list if the name has no such records,
+    or None if no nameserver replied. They are always called from the main thread.
+
+    Against spoofed replies, every attempt is sent from a new socket, so it gets its own random source port (RFC 5452),
+    with a random query id and a random letter case in the name (0x20 encoding) that the reply must match.
+    """
+
+    # (ip, port) pairs. Read from /etc/resolv.conf when not configured.
+    nameservers = []
+    timeout = 2
+    attempts = 3
+    max_inflight = 100
+    max_cache = 50_000
+    min_ttl, max_ttl, negative_ttl = 30, 86400, 300
+
+    selector = None
+    inflight = {}
+    by_question = {}
+    waiting = deque()
+    # Queries made from other threads, sent by the main loop.
+    submitted = deque()
+    # (name, qtype) -> (expire time, answers)
+    cache = {}
+    last_expire = 0
+
+    @staticmethod
+    def set_nameservers(servers: list):
+        """ Sets the nameservers to use, as IP addresses or (ip, port) pairs. An empty list uses /etc/resolv.conf """
+        Resolver.nameservers = [(s, 53) if isinstance(s, str) else tuple(s) for s in servers]
+
+    @staticmethod
+    def system_nameservers() -> list:
+        servers = []
+        try:
+            with open("/etc/resolv.conf") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 2 and parts[0] == "nameserver":
+                        servers.append((parts[1].split('%')[0], 53))
+        except OSError:
+            pass
+        return servers or [("127.0.0.1", 53)]
+
+    @staticmethod
+    def get_selector():
+        if not Resolver.selector:
+            Resolver.selector = selectors.DefaultSelector()
+        return Resolver.selector
+
+    @staticmethod
+    def open_socket(query: DnsQuery):
+        """ Opens a new socket for `query`, the OS binds it to a random source port. """
+        family = socket.AF_INET6 if ':' in query.nameserver[0] else socket.AF_INET
+        query.sock = socket.socket(family, socket.SOCK_DGRAM)
+        query.sock.setblocking(False)
+        Resolver.get_selector().register(query.sock, selectors.EVENT_READ, query)
+
+    @staticmethod
+    def close_socket(query: DnsQuery):
+        if query.sock:
+            Resolver.get_selector().unregister(query.sock)
+            query.sock.close()
+            query.sock = None
+
+    @staticmethod
+    def query(name: str, qtype: str, callback) -> None:
+        if threading.current_thread() is not threading.main_thread():
+            Resolver.submitted.append((name, qtype, callback))
+            return
+
+        key = name.lower().rstrip('.'), qtype
+        if (cached := Resolver.cache.get(key)) and cached[0] > time():
+            return callback(list(cached[1]))
+
+        if query := Resolver.by_question.get(key):
+            query.callbacks.append(callback)
+            return
+
+        query = Resolver.by_question[key] = DnsQuery(*key)
+        query.callbacks.append(callback)
+        if len(Resolver.inflight) < Resolver.max_inflight:
+            Resolver.send(query)
+        else:
+            Resolver.waiting.append(query)
+
+    @staticmethod
+    def reverse(ip: str, callback) -> None:
+        """ Looks up the PTR record of an IPv4 or IPv6 address. """
+        Resolver.query(ipaddress.ip_address(ip).reverse_pointer, "PTR", callback)
+
+    @staticmethod
+    def send(query: DnsQuery):
+        nameservers = Resolver.nameservers or Resolver.system_nameservers()
+        query.nameserver = nameservers[query.tries % len(nameservers)]
+        query.tries += 1
+        Resolver.inflight.pop(query.id, None)
+        Resolver.close_socket(query)
+        while (query_id := secrets.randbelow(0xFFFF) + 1) in Resolver.inflight:
+            continue
+        query.id = query_id
+        if query.plain_case:
+            query.wire_name = query.name
+        else:
+            query.wire_name = ''.join(c.upper() if c.isalpha() and secrets.randbits(1) else c for c in query.name)
+        query.sent = time()
+        Resolver.inflight[query.id] = query
+
+        packet = struct.pack("!HHHHHH", query.id, 0x0100, 1, 0, 0, 0) + Resolver.encode_name(query.wire_name) + struct.pack("!HH", QTYPES[query.qtype], 1)
+        try:
+            Resolver.open_socket(query)
+            query.sock.sendto(packet, query.nameserver)
+        except OSError as ex:
+            logging.debug(f"DNS query for {query.name} to {query.nameserver[0]} failed: {ex}")
+
+    @staticmethod
+    def finish(query: DnsQuery, answers, ttl: int = 0):
+        Resolver.inflight.pop(query.id, None)
+        Resolver.close_socket(query)
+        Resolver.by_question.pop((query.name, query.qtype), None)
+        if answers is not None:
+            if len(Resolver.cache) >= Resolver.max_cache:
+                # Dicts keep insertion order, so this drops the oldest entry.
+                del Resolver.cache[next(iter(Resolver.cache))]
+            Resolver.cache[(query.name, query.qtype)] = time() + ttl, answers
+        for callback in query.callbacks:
+            try:
+                callback(list(answers) if answers is not None else None)
+            except Exception as ex:
+                logging.exception(ex)
+
+    @staticmethod
+    def process():
+        while Resolver.submitted:
+            Resolver.query(*Resolver.submitted.popleft())
+
+        if Resolver.inflight:
+            for key, _ in Resolver.get_selector().select(0):
+                query = key.data
+                # Stop reading once a reply has finished the query and closed its socket.
+                while query.sock is key.fileobj:
+                    try:
+                        packet, address = query.sock.recvfrom(4096)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        # ICMP unreachable, wait for the timeout and try the next nameserver.
+                        break
+                    Resolver.handle_reply(packet, address, query)
+
+        now = time()
+        for query in [q for q in Resolver.inflight.values() if now - q.sent >= Resolver.timeout]:
+            if query.tries < Resolver.attempts:
+                Resolver.send(query)
+            else:
+                Resolver.finish(query, None)
+
+        while Resolver.waiting and len(Resolver.inflight) < Resolver.max_inflight:
+            Resolver.send(Resolver.waiting.popleft())
+
+        if now - Resolver.last_expire >= 60:
+            Resolver.last_expire = now
+            Resolver.cache = {key: entry for key, entry in Resolver.cache.items() if entry[0] > now}
+
+    @staticmethod
+    def handle_reply(packet: bytes, address, query: DnsQuery):
+        try:
+            query_id, flags, qdcount, ancount, nscount, _ = struct.unpack_from("!HHHHHH", packet)
+            if query_id != query.id or Resolver.inflight.get(query_id) is not query or address[:2] != query.nameserver or not flags & 0x8000:
+                return
+            name, offset = Resolver.decode_name(packet, 12)
+            # Compared with its letter case, so a spoofed reply must also guess the case of every letter.
+            if qdcount != 1 or name != query.wire_name or struct.unpack_from("!H", packet, offset)[0] != QTYPES[query.qtype]:
+                if name.lower() == query.name and not query.plain_case:
+                    # Id and source port matched, but the nameserver changed the case: retry right away without it.
+                    query.plain_case = 1
+                    query.sent = 0
+                return
+            offset += 4
+
+            rcode = flags & 0xF
+            if rcode not in [0, RCODE_NXDOMAIN]:
+                # SERVFAIL or REFUSED: try the next nameserver.
+                query.sent = 0
+                return
+
+            answers, ttls = [], []
+            for _ in range(ancount):
+                _, offset = Resolver.decode_name(packet, offset)
+                rtype, _, ttl, rdlength = struct.unpack_from("!HHIH", packet, offset)
+                offset += 10
+                if rtype == QTYPES[query.qtype]:
+                    ttls.append(ttl)
+                    match query.qtype:
+                        case "A" | "AAAA":
+                            family = socket.AF_INET if rtype == QTYPES["A"] else socket.AF_INET6
+                            answers.append(socket.inet_ntop(family, packet[offset:offset + rdlength]))
+                        case "PTR":
+                            answers.append(Resolver.decode_name(packet, offset)[0])
+                offset += rdlength
+
+            if not answers:
+                ttl = Resolver.negative_ttl
+                for _ in range(nscount):
+                    _, offset = Resolver.decode_name(packet, offset)
+                    rtype, _, record_ttl, rdlength = struct.unpack_from("!HHIH", packet, offset)
+                    if rtype == TYPE_SOA:
+                        # The negative TTL is the lower of the SOA record TTL and its minimum field.
+                        ttl = min(record_ttl, struct.unpack_from("!I", packet, offset + 10 + rdlength - 4)[0])
+                    offset += 10 + rdlength
+                ttls.append(min(ttl, Resolver.negative_ttl))
+
+            Resolver.finish(query, answers, max(Resolver.min_ttl, min(min(ttls), Resolver.max_ttl)))
+
+        except (struct.error, IndexError, ValueError, OSError):
+            # Malformed reply, wait for another one or the timeout.
+            return
+
+    @staticmethod
+    def encode_name(name: str) -> bytes:
+        return b''.join(bytes([len(label)]) + label for label in name.encode("idna").split(b'.') if label) + b'\x00'
+
+    @staticmethod
+    def decode_name(packet: bytes, offset: int) -> tuple:
+        """ Returns the name at `offset` and the offset after it, following compression pointers. """
+        labels, end, jumps = [], None, 0
+        while 1:
+            length = packet[offset]
+            if length & 0xC0 == 0xC0:
+                if (jumps := jumps + 1) > 16:
+                    raise ValueError("DNS name compression loop")
+                if end is None:
+                    end = offset + 2
+                offset = ((length & 0x3F) << 8) | packet[offset + 1]
+                continue
+            offset += 1
+            if not length:
+                break
+            labels.append(packet[offset:offset + length].decode(errors="replace"))
+            offset += length
+        return '.'.join(labels), end if end is not None else offset
+
+    @staticmethod
+    def close():
+        for query in Resolver.inflight.values():
+            Resolver.close_socket(query)
+        if Resolver.selector:
+            Resolver.selector.close()
+            Resolver.selector = None
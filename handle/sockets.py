@@ -9,7 +9,9 @@ from OpenSSL import SSL
 from handle.client import (find_client_from_socket,
                            make_client, make_server, make_user,
                            find_listen_obj_from_socket)
-from handle.core import IRCD, Client, Hook, Numeric, Command
+from handle.core import IRCD, Client, Hook, Numeric, Command, ReplyStream, Log, DataStore, HostCache
+from handle.resolver import Resolver
+from handle.handleLink import Burst
 from handle.functions import logging, fixup_ip6
 from modules.m_connect import connect_to
 
@@ -68,19 +70,16 @@ def post_accept(conn, client, listen_obj):
     client.local.handshake = 1
 
     if "servers" in listen_obj.options:
-        if IRCD.current_link_sync and IRCD.current_link_sync != client:
-            logging.error(f"Denying new incoming link because we are already processing another link.")
-            client.exit(f"Already processing a link, try again.")
-            data = f"New server client incoming ({client.ip}:{listen_obj.port}) but we are currently already processing an incoming server."
-            if IRCD.current_link_sync and IRCD.current_link_sync.ip == client.ip \
-                    and IRCD.current_link_sync.port in [int(lis.port) for lis in IRCD.configuration.listen] \
-                    and int(time()) == IRCD.current_link_sync.creationtime:
-                data += f" Are you connecting to yourself? Make sure the outgoing IP is correct in the '{IRCD.current_link_sync.name}' link block."
-                IRCD.log(IRCD.me, "warn", "link", "LINK_IN_FAIL", data, sync=0)
-                logging.warning(data)
+        listen_ports = [int(lis.port) for lis in IRCD.configuration.listen]
+        if outgoing := next((c for c in IRCD.local_servers() if not c.server.synced and not c.local.incoming and c.ip == client.ip
+                             and c.port in listen_ports and int(time()) == c.creationtime), 0):
+            client.exit(f"Link denied, connecting to self.")
+            data = (f"New server client incoming ({client.ip}:{listen_obj.port}) from our own outgoing link to {outgoing.name}."
+                    f" Are you connecting to yourself? Make sure the outgoing IP is correct in the '{outgoing.name}' link block.")
+            IRCD.log(IRCD.me, "warn", "link", "LINK_IN_FAIL", data, sync=0)
+            logging.warning(data)
             return
         make_server(client)
-        IRCD.current_link_sync = client
 
     else:
         make_user(client)
@@ -130,14 +129,41 @@ def check_ping_timeouts():
             client.exit(f"Ping timeout: {timeout_seconds} seconds", sock_error=1)
 
 
-def check_invalid_clients():
-    for client in list(IRCD.remote_clients()):
-        if not IRCD.find_server(client.id[:3]):
-            logging.error(f"Invalid user leftover after possible netsplit: {client.name}. UID: {client.id}")
-            client.exit("Invalid user")
-            if client in Client.table:
-                Client.table.remove(client)
-                logging.warning(f"[check_invalid_clients()] Client was still in Client.table after .exit().")
+def audit_client_index():
+    """
+    Checks IRCD.server_users against the remote users once per minute.
+    Users left over from a netsplit are removed, and users missing from the index are added to it.
+    The results are shown in /stats A.
+    """
+    current_time = int(time())
+    if current_time - IRCD.client_audit.get("time", 0) < 60:
+        return
+
+    servers = {c: None for c in IRCD.global_servers()}
+    sids = {server.id for server in servers if server.id}
+    ghosts, unindexed, checked = [], 0, 0
+    for client in [c for c in IRCD.remote_clients() if c.user]:
+        checked += 1
+        if client.uplink not in servers or client.id[:3] not in sids:
+            ghosts.append(client)
+        elif client not in (users := IRCD.server_users.setdefault(client.uplink, {})):
+            users[client] = None
+            unindexed += 1
+
+    stale = [server for server in IRCD.server_users if server not in servers]
+    for server in stale:
+        ghosts.extend(c for c in IRCD.server_users.pop(server) if not c.exitted and c not in ghosts)
+
+    for client in ghosts:
+        logging.error(f"Invalid user leftover after possible netsplit: {client.name}. UID: {client.id}")
+        client.exit("Invalid user")
+        if client in Client.table:
+            Client.table.remove(client)
+            logging.warning(f"[audit_client_index()] Client was still in Client.table after .exit().")
+    if unindexed:
+        logging.warning(f"[audit_client_index()] Added {unindexed} remote user(s) that were missing from the server index.")
+
+    IRCD.client_audit = {"time": current_time, "checked": checked, "ghosts": len(ghosts), "unindexed": unindexed, "stale": len(stale)}
 
 
 def check_freeze():
@@ -149,9 +175,7 @@ def check_freeze():
 
 
 def autoconnect_links():
-    if IRCD.current_link_sync or [c for c in IRCD.global_servers() if not c.server.synced]:
-        return
-
+    # Links are synced independently, so all due links are connected at once.
     for link in [link for link in IRCD.configuration.links if (link.outgoing
                                                                and "autoconnect" in link.outgoing_options
                                                                and not IRCD.find_server(link.name)
@@ -162,19 +186,9 @@ def autoconnect_links():
             # logging.debug(f"Attempting autoconnect to: {link.name}")
             # logging.debug(f"Next attempt in {interval} seconds (if this connection fails connected).")
             connect_to(IRCD.me, link, auto_connect=1)
-            break
 
 
 def check_reg_timeouts():
-    for client in IRCD.global_servers():
-        if not client.registered:
-            break
-    else:
-        """ Loop ended normally, so all servers are registered """
-        if IRCD.current_link_sync:
-            logging.debug(f"[check_reg_timeouts()] current_link_sync for {IRCD.current_link_sync} unset.")
-        IRCD.current_link_sync = None
-
     reg_timeout = int(IRCD.get_setting("regtimeout"))
     current_time = int(time())
     for client in IRCD.unregistered_clients():
@@ -189,14 +203,6 @@ def throttle_expire():
             del IRCD.throttle[throttle]
 
 
-def hostcache_expire():
-    current_time = int(time())
-    for ip in dict(IRCD.hostcache):
-        timestamp, realhost = IRCD.hostcache[ip]
-        if current_time - timestamp >= 3600:
-            del IRCD.hostcache[ip]
-
-
 def remove_delayed_connections():
     for delayed_connection in list(IRCD.delayed_connections):
         client, expire, label = delayed_connection
@@ -318,6 +324,8 @@ def process_backbuffer():
                     tte, _ = entry
                     if current_time >= tte + 1:
                         buffer.remove(entry)
+                        if buffer is client.local.sendq_buffer:
+                            client.local.sendq_size -= len(entry[1]) + 2
 
 
 def is_valid_socket(sock):
@@ -524,22 +532,29 @@ def handle_connections():
                         client.exit("Connection closed", sock_error=1)
                     continue
 
+            HostCache.process()
+            Resolver.process()
             send_pings()
             check_reg_timeouts()
             process_backbuffer()
+            ReplyStream.process()
+            Burst.process()
             autoconnect_links()
             throttle_expire()
-            hostcache_expire()
             remove_delayed_connections()
             check_ping_timeouts()
-            check_invalid_clients()
+            audit_client_index()
             check_freeze()
+            Log.flush_suppressed()
             IRCD.run_hook(Hook.LOOP)
+            DataStore.flush_if_due()
 
         except KeyboardInterrupt:
             logging.info(f"[KeyboardInterrupt] Shutting down ProvisionIRCd.")
             IRCD.running = 0
+            DataStore.flush()
             exit()
 
+    DataStore.flush()
     print(f"Loop broke")
     exit()
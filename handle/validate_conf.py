@@ -1,3 +1,4 @@
+import ipaddress
 import os
 import re
 import socket
@@ -5,6 +6,7 @@ import socket
 from classes.conf_entries import ConnectClass, Allow, Listen, Spamfilter, Operclass, Oper, Link, Alias, Module, Except, Ban, Require, Mask
 from handle.functions import logging, valid_expire
 from handle.core import IRCD
+from handle.resolver import Resolver
 
 
 class ConfErrors:
@@ -250,6 +252,27 @@ def config_test_settings(block):
 
             IRCD.set_setting(check, value)
 
+    def check_settings_resolvehost_timeout():
+        check = "resolvehost-timeout"
+        if item := block.get_item(check):
+            value = block.get_single_value(check)
+            if not value.isdigit() or not 1 <= int(value) <= 30:
+                return conf_error(f"Invalid `{check}` value: {value}. Must be a number of seconds between 1 and 30.", block, item)
+            IRCD.set_setting(check, value)
+
+    def check_settings_dns_server():
+        check = "dns-server"
+        servers = []
+        if item := block.get_item(check):
+            for value in block.get_single_value(check).replace(',', ' ').split():
+                try:
+                    ipaddress.ip_address(value)
+                    servers.append(value)
+                except ValueError:
+                    conf_error(f"Invalid `{check}` value: {value}. Must be one or more IP addresses.", block, item)
+        # Without this setting, the nameservers from /etc/resolv.conf are used.
+        Resolver.set_nameservers(servers)
+
     check_settings_modes_on_join()
     check_settings_modes_on_connect()
     check_settings_resolvehost()
@@ -260,6 +283,8 @@ def config_test_settings(block):
     check_settings_static_part()
     check_settings_cloak_prefix()
     check_settings_cloak_key()
+    check_settings_resolvehost_timeout()
+    check_settings_dns_server()
 
     for entry in block.get_all_entries():
         if len(entry.path) != 2:
@@ -2,25 +2,28 @@
 Support for blacklist checks. Configure in dnsbl.conf
 """
 
-import socket
+from collections import deque
+from functools import partial
 from time import time
 import ipaddress
-import asyncio
 
 from dataclasses import dataclass, field
+from typing import ClassVar
 
-from handle.core import IRCD, Hook, Numeric, Snomask, Tkl
-from handle.functions import reverse_ip, valid_expire
+from handle.core import IRCD, Hook, Numeric, Snomask, Tkl, Stat
+from handle.functions import valid_expire
+from handle.resolver import Resolver
 from handle.validate_conf import conf_error
-from handle.logger import logging
-
-logging.getLogger("asyncio").setLevel(logging.WARNING)
 
 
 @dataclass
 class Blacklist:
-    cache = []
-    process = []
+    # IP -> Blacklist, for addresses that were found in a DNSBL.
+    cache = {}
+    # IP -> DnsblCheck, for addresses that are being checked.
+    process = {}
+    # Clients queued by the connection threads, checked from the main loop.
+    requests = deque()
 
     def __init__(self, name: str = '', ip: str = '', reason: str = '', set_time: int = 0, duration: int = 0):
         self.name = name
@@ -31,7 +34,33 @@ class Blacklist:
 
     @staticmethod
     def find(ip):
-        return next((b for b in Blacklist.cache if b.ip == ip), 0)
+        return Blacklist.cache.get(ip, 0)
+
+
+class DnsblCheck:
+    """ The lookups of one IP address in all DNSBLs, shared by every client connecting from it meanwhile. """
+
+    def __init__(self, ip: str):
+        self.ip = ip
+        self.clients = []
+        self.remaining = 0
+        self.matched = 0
+
+
+@dataclass
+class DnsblStats:
+    # Kept per DNS zone, so the numbers survive a rehash.
+    zones: ClassVar[dict] = {}
+
+    queries: int = 0
+    answered: int = 0
+    hits: int = 0
+    timeouts: int = 0
+    latency: float = 0.0
+
+    @staticmethod
+    def get(dns: str):
+        return DnsblStats.zones.setdefault(dns, DnsblStats())
 
 
 @dataclass
@@ -52,78 +81,115 @@ class Dnsbl:
         return f"<Dnsbl '{self.dns}'>"
 
 
-async def dnsbl_check_client(client, dnsbl):
-    if Blacklist.find(client.ip):
-        return
-
-    lookup = f"{reverse_ip(client.ip)}.{dnsbl.dns}"
-    reason = dnsbl.reason.replace("%ip", client.ip)
-
-    try:
-        result = await asyncio.wait_for(asyncio.get_event_loop().run_in_executor(None, socket.gethostbyname, lookup), timeout=5)
-        reply = result.split('.')[3]
-
-        if dnsbl.reply and reply not in dnsbl.reply:
-            return
-
-        entry = Blacklist(name=dnsbl.name, ip=client.ip, reason=reason, set_time=int(time()), duration=int(dnsbl.duration))
-        Blacklist.cache.append(entry)
+def dnsbl_match(check, dnsbl):
+    reason = dnsbl.reason.replace("%ip", check.ip)
+    Blacklist.cache[check.ip] = Blacklist(name=dnsbl.name, ip=check.ip, reason=reason, set_time=int(time()), duration=int(dnsbl.duration))
 
+    for client in [c for c in check.clients if not c.exitted]:
         msg = f"*** DNSBL match for IP {client.ip} [nick: {client.name}]: {reason}"
         IRCD.send_snomask(client, 'd', msg)
-
         if dnsbl.action == "gzline":
             client.sendnumeric(Numeric.RPL_TEXT, reason)
             client.exit(reason)
-            Tkl.add(
-                client=IRCD.me, flag='Z', ident='*', host=client.ip, bantypes='', set_by=IRCD.me.name,
-                expire=int(time()) + dnsbl.duration, set_time=int(time()), reason=reason
-            )
 
-    except (asyncio.TimeoutError, socket.gaierror):
-        pass
+    if dnsbl.action == "gzline":
+        Tkl.add(
+            client=IRCD.me, flag='Z', ident='*', host=check.ip, bantypes='', set_by=IRCD.me.name,
+            expire=int(time()) + dnsbl.duration, set_time=int(time()), reason=reason
+        )
+
+
+def dnsbl_result(check, dnsbl, started, answers):
+    stats = DnsblStats.get(dnsbl.dns)
+    check.remaining -= 1
 
-    except Exception as ex:
-        logging.exception(f"Exception during DNSBL check for {client.ip} on {dnsbl.dns}: {ex}")
+    if answers is None:
+        stats.timeouts += 1
+    else:
+        stats.answered += 1
+        stats.latency += time() - started
+        replies = [answer.split('.')[3] for answer in answers if answer.count('.') == 3]
+        if replies and not check.matched and (not dnsbl.reply or any(reply in dnsbl.reply for reply in replies)):
+            stats.hits += 1
+            check.matched = 1
+            dnsbl_match(check, dnsbl)
 
+    if check.remaining <= 0:
+        if Blacklist.process.get(check.ip) == check:
+            del Blacklist.process[check.ip]
+        for client in [c for c in check.clients if not c.exitted]:
+            IRCD.remove_delay_client(client, "blacklist")
 
-async def blacklist_check(client):
+
+def start_blacklist_check(client):
+    """ Runs in a connection thread. The lookups are started by process_blacklist_requests() from the main loop. """
     if IRCD.is_except_client("dnsbl", client) or not ipaddress.ip_address(client.ip).is_global:
         return
 
     if blacklist := Blacklist.find(client.ip):
-        for c in [c for c in IRCD.local_users() if c.ip == client.ip]:
+        for c in [client] + [c for c in IRCD.local_users() if c.ip == client.ip and c != client]:
             c.sendnumeric(Numeric.RPL_TEXT, blacklist.reason)
             c.exit(blacklist.reason)
         return Hook.DENY
 
-    if client.ip not in Blacklist.process:
-        Blacklist.process.append(client.ip)
+    if not Dnsbl.table:
+        return
+
+    IRCD.delay_client(client, 1, "blacklist")
+    Blacklist.requests.append(client)
+
+
+def process_blacklist_requests():
+    while Blacklist.requests:
+        client = Blacklist.requests.popleft()
+        if client.exitted:
+            continue
+
+        if not Dnsbl.table:
+            # Removed by a rehash meanwhile.
+            IRCD.remove_delay_client(client, "blacklist")
+            continue
+
+        if check := Blacklist.process.get(client.ip):
+            # Already being checked, wait for the same lookups.
+            check.clients.append(client)
+            continue
+
+        check = Blacklist.process[client.ip] = DnsblCheck(client.ip)
+        check.clients.append(client)
+        check.remaining = len(Dnsbl.table)
         client.sendnumeric(Numeric.RPL_TEXT, "* Please wait while your connection is being checked against DNSBL.")
-        IRCD.delay_client(client, 1, "blacklist")
-        tasks = [dnsbl_check_client(client, dnsbl) for dnsbl in Dnsbl.table]
-        await asyncio.gather(*tasks)
-        IRCD.remove_delay_client(client)
+
+        # 4.3.2.1 for IPv4, nibbles for IPv6.
+        reverse = ipaddress.ip_address(client.ip).reverse_pointer.rsplit('.', 2)[0]
+        for dnsbl in list(Dnsbl.table):
+            DnsblStats.get(dnsbl.dns).queries += 1
+            Resolver.query(f"{reverse}.{dnsbl.dns}", "A", partial(dnsbl_result, check, dnsbl, time()))
 
 
 def blacklist_expire():
-    for bl in [bl for bl in list(Blacklist.cache) if bl.duration and int(time() > bl.duration + bl.set_time)]:
-        Blacklist.cache.remove(bl)
+    now = int(time())
+    for ip in [ip for ip, bl in Blacklist.cache.items() if bl.duration and now > bl.duration + bl.set_time]:
+        del Blacklist.cache[ip]
 
 
-def start_blacklist_check(client):
-    try:
-        loop = asyncio.get_running_loop()
-        task = loop.create_task(blacklist_check(client))
-    except RuntimeError:
-        """ No event loop running. Create one. """
-        asyncio.run(blacklist_check(client))
+def stats_dnsbl(client):
+    for dnsbl in Dnsbl.table:
+        stats = DnsblStats.get(dnsbl.dns)
+        latency = f"{stats.latency / stats.answered * 1000:.0f}ms" if stats.answered else "n/a"
+        hit_rate = f"{stats.hits / stats.answered * 100:.1f}%" if stats.answered else "n/a"
+        IRCD.server_notice(client, f"{dnsbl.dns}: {stats.queries} queries, {stats.hits} hits ({hit_rate}), "
+                                   f"{stats.timeouts} timeouts, average latency {latency}")
+    IRCD.server_notice(client, f"Pending: {len(Blacklist.process)} IPs, {len(Resolver.inflight)} DNS queries in flight, "
+                               f"{len(Resolver.waiting)} queued, {len(Resolver.cache)} cached answers, {len(Blacklist.cache)} blacklisted IPs")
 
 
 def init(module):
     Hook.add(Hook.NEW_CONNECTION, start_blacklist_check, priority=999)
+    Hook.add(Hook.LOOP, process_blacklist_requests)
     Hook.add(Hook.LOOP, blacklist_expire)
     Snomask.add(module, 'd', 1, "View DNSBL hits")
+    Stat.add(module, stats_dnsbl, 'D', "View DNSBL statistics")
 
 
 def post_load(module):
@@ -131,6 +197,8 @@ def post_load(module):
         conf_error(f"Missing configuration block dnsbl {{ }}")
         return
 
+    # Blocks are read again on every rehash.
+    Dnsbl.table = []
     for block in blocks:
         if not block.value:
             conf_error(f"DNSBL is missing a name", block)
@@ -169,4 +237,4 @@ def post_load(module):
                 dnsbl_reply.append(reply_value)
 
         if dnsbl_dns and dnsbl_action and dnsbl_duration:
-            Dnsbl(dns=dnsbl_dns, action=dnsbl_action, reason=dnsbl_reason, reply=dnsbl_reply, duration=dnsbl_duration)
+            Dnsbl(name=dnsbl_name, dns=dnsbl_dns, action=dnsbl_action, reason=dnsbl_reason, reply=dnsbl_reply, duration=dnsbl_duration)
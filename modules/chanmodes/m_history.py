@@ -2,10 +2,17 @@
 provides chmode +H (channel message history support)
 """
 
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+from bisect import bisect_left, bisect_right
 from time import time
 from datetime import datetime, timezone
 
 from handle.core import IRCD, Channelmode, Hook, Batch, MessageTag, Numeric, Command
+from handle.logger import logging
 from handle.validate_conf import conf_error
 
 
@@ -15,36 +22,80 @@ class Configuration:
 
 
 class ChatHistory:
-    backlog = {}
+    # MemoryStorage or SQLiteStorage, see chathistory::storage.
+    storage = None
 
     reply_time = {}
 
     max_unreg = 10
     max_reg = 10
 
+    # Private message history, see chathistory::private-messages. Disabled if the limit is 0.
+    private_limit = 0
+    private_expire = 0
+
     BEFORE = 0
     AFTER = 1
     BETWEEN = 2
     AROUND = 3
     LATEST = 4
 
-    def __init__(self, sender, mtags: list, svid, utc_time: float, sendtype: str, data: str):
+    def __init__(self, sender, mtags: list, svid, utc_time: float, sendtype: str, data: str, recipient=None):
         self.sender = sender
         self.mtags = mtags
         self.svid = svid
         self.utc_time = utc_time
         self.sendtype = sendtype
         self.data = data
+        # Target the message was sent to. Only set for private messages,
+        # channel history is always shown with the current channel name.
+        self.recipient = recipient
+        self.msgid = next((t.value for t in self.mtags if t.name == "msgid"), 0)
 
-    @property
-    def msgid(self):
-        return next((t.value for t in self.mtags if t.name == "msgid"), 0)
+    @staticmethod
+    def history_key(channel) -> str:
+        return channel.name.lower()
+
+    @staticmethod
+    def participant(client):
+        """
+        Identifies one side of a private conversation by account.
+        Returns None if the client is not logged in: nicknames are reused by other users, so they cannot own history.
+        """
+        if client.user.account != '*':
+            return "a:" + client.user.account.lower()
+        return None
+
+    @staticmethod
+    def dm_key(participant_1: str, participant_2: str) -> str:
+        return "dm:" + ' '.join(sorted([participant_1, participant_2]))
+
+    @staticmethod
+    def dm_peer(key: str, participant: str, online: dict) -> str:
+        """
+        Returns the name to show for the other side of private conversation `key`:
+        their nickname if they are online, looked up in `online` (lowercase account -> nickname), otherwise their account.
+        """
+        participants = key.removeprefix("dm:").split(' ')
+        peer = participants[1] if participants[0] == participant else participants[0]
+        name = peer.split(':', 1)[1]
+        return online.get(name, name)
 
     @staticmethod
-    def add_to_buff(channel, history_obj):
-        if channel not in ChatHistory.backlog:
-            ChatHistory.backlog[channel] = []
-        ChatHistory.backlog[channel].append(history_obj)
+    def expire_minutes(key: str) -> int:
+        if key.startswith("dm:"):
+            return ChatHistory.private_expire if ChatHistory.private_limit else 0
+        if (channel := IRCD.find_channel(key)) and (param := channel.get_param('H')):
+            return int(param.split(':')[1])
+        # History restored from persistent storage for a channel that does not exist (yet),
+        # or no longer has +H: keep it no longer than the highest allowed expire time.
+        return 10080
+
+    @staticmethod
+    def add_to_buff(key: str, history_obj, limit: int = 0):
+        ChatHistory.storage.add(key, history_obj, limit)
+        if key not in HistoryExpiry.scheduled:
+            HistoryExpiry.schedule(key, history_obj.utc_time)
 
     @staticmethod
     def timestr_to_timestamp(utc_timestr: str) -> float:
@@ -55,6 +106,397 @@ class ChatHistory:
             return 0.0
 
 
+class HistoryExpiry:
+    """
+    Min-heap of (expire_at, counter, key), with one live heap entry per history key.
+    Only keys whose oldest entry is due are looked at, so idle conversations cost nothing per tick.
+    Rescheduling leaves the old heap entry behind; it is skipped when it no longer matches `scheduled`.
+    """
+
+    heap = []
+    scheduled = {}
+    # Keeps entries with the same expire time in insertion order.
+    counter = itertools.count()
+
+    @staticmethod
+    def schedule(key: str, oldest_time: float):
+        if not (expire := ChatHistory.expire_minutes(key)):
+            return
+        # Never sooner than a second from now, so busy targets are expired in batches.
+        expire_at = max(oldest_time + expire * 60, time() + 1)
+        HistoryExpiry.scheduled[key] = expire_at
+        heapq.heappush(HistoryExpiry.heap, (expire_at, next(HistoryExpiry.counter), key))
+
+    @staticmethod
+    def unschedule(key: str):
+        HistoryExpiry.scheduled.pop(key, None)
+
+    @staticmethod
+    def rebuild():
+        """ Schedules every key in storage again, for history restored from disk or expire times changed by a rehash. """
+        HistoryExpiry.heap, HistoryExpiry.scheduled = [], {}
+        for key, oldest in ChatHistory.storage.oldest_times().items():
+            HistoryExpiry.schedule(key, oldest)
+
+
+class HistoryBuffer:
+    """
+    Bounded history of a single channel or private conversation, oldest entry first.
+
+    Entries live in `entries[head:]`. Trimming only advances `head`, and the dead
+    prefix is dropped once it makes up half the list, so trimming is amortized O(1).
+    Timestamps are kept non-decreasing in a parallel list, so time references can be bisected,
+    and msgids map to an absolute sequence number, so msgid references are a dict lookup.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.times = []
+        self.head = 0
+        # Absolute sequence number of entries[0].
+        self.base = 0
+        self.by_msgid = {}
+
+    def __len__(self):
+        return len(self.entries) - self.head
+
+    def __iter__(self):
+        return iter(self.entries[self.head:])
+
+    @property
+    def start(self):
+        return self.head
+
+    @property
+    def end(self):
+        return len(self.entries)
+
+    @property
+    def oldest(self):
+        return self.entries[self.head] if len(self) else None
+
+    @property
+    def latest(self):
+        return self.entries[-1] if len(self) else None
+
+    def add(self, history_obj, limit: int = 0):
+        if self.times and history_obj.utc_time < self.times[-1]:
+            history_obj.utc_time = self.times[-1]
+        if history_obj.msgid:
+            self.by_msgid[history_obj.msgid] = self.base + len(self.entries)
+        self.entries.append(history_obj)
+        self.times.append(history_obj.utc_time)
+        while limit and len(self) > limit:
+            self.pop_oldest()
+
+    def pop_oldest(self):
+        history_obj = self.entries[self.head]
+        self.by_msgid.pop(history_obj.msgid, None)
+        self.entries[self.head] = None
+        self.head += 1
+        if self.head >= 64 and self.head * 2 >= len(self.entries):
+            del self.entries[:self.head]
+            del self.times[:self.head]
+            self.base += self.head
+            self.head = 0
+        return history_obj
+
+    def position(self, msgid) -> int:
+        """ Returns the list index of `msgid`, or -1 if it is not (or no longer) in the buffer. """
+        if (seq := self.by_msgid.get(msgid)) is None:
+            return -1
+        return seq - self.base
+
+    def before(self, timestamp: float = 0, msgid=None) -> int:
+        """ Returns the index just past the last entry strictly before the reference, or -1. """
+        if msgid:
+            return self.position(msgid)
+        return bisect_left(self.times, timestamp, self.head)
+
+    def after(self, timestamp: float = 0, msgid=None) -> int:
+        """ Returns the index of the first entry strictly after the reference, or -1. """
+        if msgid:
+            return pos + 1 if (pos := self.position(msgid)) >= 0 else -1
+        return bisect_right(self.times, timestamp, self.head)
+
+    def reference_time(self, timestamp: float = 0, msgid=None):
+        if msgid:
+            return self.times[pos] if (pos := self.position(msgid)) >= 0 else None
+        return timestamp
+
+    def slice(self, start: int, end: int, limit: int, latest: int = 0) -> list:
+        """
+        Returns up to `limit` entries from `entries[start:end]`, oldest first.
+        If `latest` is set, the entries closest to `end` are returned instead of those closest to `start`.
+        """
+
+        start, end = max(start, self.head), min(end, len(self.entries))
+        if start >= end or limit <= 0:
+            return []
+        if latest:
+            start = max(start, end - limit)
+        else:
+            end = min(end, start + limit)
+        return self.entries[start:end]
+
+
+class MemoryStorage:
+    """
+    Default storage: a HistoryBuffer per history key, kept in memory only.
+    Keys are lowercase channel names, or "dm:<participant> <participant>" for private conversations.
+    """
+
+    def __init__(self):
+        self.backlog = {}
+        # Participant -> keys of their private conversations.
+        self.participants = {}
+
+    def add(self, key: str, history_obj, limit: int):
+        if key not in self.backlog:
+            self.backlog[key] = HistoryBuffer()
+            if key.startswith("dm:"):
+                for participant in key.removeprefix("dm:").split(' '):
+                    self.participants.setdefault(participant, set()).add(key)
+        self.backlog[key].add(history_obj, limit)
+
+    def view(self, key: str):
+        """ Returns an object with the HistoryBuffer query interface, or None if there is no history. """
+        return buffer if (buffer := self.backlog.get(key)) else None
+
+    def clear(self, key: str):
+        self.backlog.pop(key, None)
+        if key.startswith("dm:"):
+            for participant in key.removeprefix("dm:").split(' '):
+                if keys := self.participants.get(participant):
+                    keys.discard(key)
+                    if not keys:
+                        del self.participants[participant]
+
+    def expire(self, key: str, cutoff: float):
+        if buffer := self.backlog.get(key):
+            # Entries are in time order, so expired entries are always at the front.
+            while buffer.oldest and buffer.oldest.utc_time <= cutoff:
+                buffer.pop_oldest()
+            if not buffer:
+                self.clear(key)
+
+    def rename(self, key: str, new_key: str):
+        self.clear(new_key)
+        if buffer := self.backlog.pop(key, None):
+            self.backlog[new_key] = buffer
+
+    def oldest_time(self, key: str):
+        return buffer.oldest.utc_time if (buffer := self.backlog.get(key)) else None
+
+    def oldest_times(self) -> dict:
+        return {key: buffer.oldest.utc_time for key, buffer in self.backlog.items() if buffer}
+
+    def latest_times(self, keys) -> dict:
+        """ Returns the time of the latest entry for each of `keys` that has history. """
+        return {key: buffer.latest.utc_time for key in keys if (buffer := self.backlog.get(key))}
+
+    def conversations(self, participant: str) -> list:
+        return list(self.participants.get(participant, ()))
+
+    def flush(self):
+        pass
+
+    def flush_if_due(self):
+        pass
+
+
+class SQLiteView:
+    """
+    HistoryBuffer query interface on top of SQLiteStorage, for a single history key.
+    Positions are row ids. These are global and may have gaps, but are increasing per key.
+    """
+
+    def __init__(self, db, target: str):
+        self.db = db
+        self.target = target
+        self.start = 0
+        self.end = self.scalar("SELECT MAX(id) FROM history WHERE target=?") + 1
+
+    def scalar(self, query: str, *args):
+        row = self.db.execute(query, (self.target, *args)).fetchone()
+        return row[0] if row and row[0] is not None else 0
+
+    def position(self, msgid) -> int:
+        return self.scalar("SELECT id FROM history WHERE target=? AND msgid=?", msgid) or -1
+
+    def before(self, timestamp: float = 0, msgid=None) -> int:
+        if msgid:
+            return self.position(msgid)
+        return self.scalar("SELECT MIN(id) FROM history WHERE target=? AND utc_time >= ?", timestamp) or self.end
+
+    def after(self, timestamp: float = 0, msgid=None) -> int:
+        if msgid:
+            return pos + 1 if (pos := self.position(msgid)) >= 0 else -1
+        return self.scalar("SELECT MAX(id) FROM history WHERE target=? AND utc_time <= ?", timestamp) + 1
+
+    def reference_time(self, timestamp: float = 0, msgid=None):
+        if msgid:
+            row = self.db.execute("SELECT utc_time FROM history WHERE target=? AND msgid=?", (self.target, msgid)).fetchone()
+            return row[0] if row else None
+        return timestamp
+
+    def slice(self, start: int, end: int, limit: int, latest: int = 0) -> list:
+        if start >= end or limit <= 0:
+            return []
+        rows = self.db.execute("SELECT sender, mtags, svid, utc_time, sendtype, data, recipient FROM history "
+                               f"WHERE target=? AND id >= ? AND id < ? ORDER BY id {'DESC' if latest else 'ASC'} LIMIT ?",
+                               (self.target, start, end, limit)).fetchall()
+        if latest:
+            rows.reverse()
+        return [ChatHistory(sender, SQLiteStorage.restore_tags(mtags), svid, utc_time, sendtype, data, recipient)
+                for sender, mtags, svid, utc_time, sendtype, data, recipient in rows]
+
+
+class SQLiteStorage:
+    """
+    Persistent storage in data/chathistory.db, using SQLite in WAL mode.
+    New entries are queued and written in a single transaction from the main loop,
+    so sending a message never waits on the disk. Reads flush the queue first.
+    This is not kept in DataStore: history is an append-only log that is read by id, time and msgid ranges,
+    which needs its own indexed table rather than one JSON value per key.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target TEXT NOT NULL,
+            msgid TEXT,
+            utc_time REAL NOT NULL,
+            sender TEXT NOT NULL,
+            svid TEXT,
+            sendtype TEXT NOT NULL,
+            data TEXT NOT NULL,
+            mtags TEXT NOT NULL,
+            recipient TEXT
+        );
+        CREATE INDEX IF NOT EXISTS history_target_id ON history (target, id);
+        CREATE INDEX IF NOT EXISTS history_target_time ON history (target, utc_time);
+        CREATE INDEX IF NOT EXISTS history_target_msgid ON history (target, msgid);
+        CREATE TABLE IF NOT EXISTS conversations (
+            participant TEXT NOT NULL,
+            target TEXT NOT NULL,
+            PRIMARY KEY (participant, target)
+        );
+    """
+
+    flush_interval = 1
+    flush_size = 500
+
+    def __init__(self, path: str):
+        if not os.path.exists(os.path.dirname(path)):
+            os.mkdir(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SQLiteStorage.schema)
+        self.pending = []
+        # Target -> line limit, applied on the next flush.
+        self.trim = {}
+        self.last_time = {}
+        self.last_flush = time()
+
+    @staticmethod
+    def restore_tags(mtags: str) -> list:
+        tags = []
+        for name, value in json.loads(mtags):
+            if tag_class := MessageTag.find_tag(name):
+                tag = tag_class(value=value)
+                tag.name = name
+                tags.append(tag)
+        return tags
+
+    def add(self, target: str, history_obj, limit: int):
+        if target not in self.last_time:
+            self.last_time[target] = self.db.execute("SELECT MAX(utc_time) FROM history WHERE target=?", (target,)).fetchone()[0] or 0
+        history_obj.utc_time = max(history_obj.utc_time, self.last_time[target])
+        self.last_time[target] = history_obj.utc_time
+
+        mtags = json.dumps([[tag.name, tag.value] for tag in history_obj.mtags])
+        self.pending.append((target, history_obj.msgid or None, history_obj.utc_time, history_obj.sender,
+                             history_obj.svid, history_obj.sendtype, history_obj.data, mtags, history_obj.recipient))
+        if limit:
+            self.trim[target] = limit
+        if len(self.pending) >= SQLiteStorage.flush_size:
+            self.flush()
+
+    def view(self, target: str):
+        self.flush()
+        if not self.db.execute("SELECT 1 FROM history WHERE target=? LIMIT 1", (target,)).fetchone():
+            return None
+        return SQLiteView(self.db, target)
+
+    def clear(self, target: str):
+        self.pending = [row for row in self.pending if row[0] != target]
+        self.trim.pop(target, None)
+        self.last_time.pop(target, None)
+        with self.db:
+            self.db.execute("DELETE FROM history WHERE target=?", (target,))
+            self.db.execute("DELETE FROM conversations WHERE target=?", (target,))
+
+    def expire(self, target: str, cutoff: float):
+        self.pending = [row for row in self.pending if row[0] != target or row[2] > cutoff]
+        with self.db:
+            self.db.execute("DELETE FROM history WHERE target=? AND utc_time <= ?", (target, cutoff))
+            if not any(row[0] == target for row in self.pending):
+                self.db.execute("DELETE FROM conversations WHERE target=? AND NOT EXISTS "
+                                "(SELECT 1 FROM history WHERE target=?)", (target, target))
+
+    def rename(self, target: str, new_target: str):
+        self.clear(new_target)
+        self.flush()
+        self.last_time.pop(target, None)
+        with self.db:
+            self.db.execute("UPDATE history SET target=? WHERE target=?", (new_target, target))
+
+    def oldest_times(self) -> dict:
+        self.flush()
+        return dict(self.db.execute("SELECT target, MIN(utc_time) FROM history GROUP BY target"))
+
+    def oldest_time(self, target: str):
+        stored = self.db.execute("SELECT MIN(utc_time) FROM history WHERE target=?", (target,)).fetchone()[0]
+        times = [t for t in [stored] + [row[2] for row in self.pending if row[0] == target] if t is not None]
+        return min(times) if times else None
+
+    def latest_times(self, targets) -> dict:
+        self.flush()
+        if not (targets := list(targets)):
+            return {}
+        rows = self.db.execute(f"SELECT target, MAX(utc_time) FROM history WHERE target IN ({','.join('?' * len(targets))}) "
+                               "GROUP BY target", targets).fetchall()
+        return dict(rows)
+
+    def conversations(self, participant: str) -> list:
+        self.flush()
+        return [row[0] for row in self.db.execute("SELECT target FROM conversations WHERE participant=?", (participant,))]
+
+    def flush_if_due(self):
+        if time() - self.last_flush >= SQLiteStorage.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time()
+        if not self.pending and not self.trim:
+            return
+        try:
+            with self.db:
+                self.db.executemany("INSERT INTO history (target, msgid, utc_time, sender, svid, sendtype, data, mtags, recipient) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self.pending)
+                conversations = {(participant, target) for target in {row[0] for row in self.pending if row[0].startswith("dm:")}
+                                 for participant in target.removeprefix("dm:").split(' ')}
+                self.db.executemany("INSERT OR IGNORE INTO conversations (participant, target) VALUES (?, ?)", conversations)
+                for target, limit in self.trim.items():
+                    self.db.execute("DELETE FROM history WHERE target=? AND id <= "
+                                    "(SELECT id FROM history WHERE target=? ORDER BY id DESC LIMIT 1 OFFSET ?)", (target, target, limit))
+        except sqlite3.Error as ex:
+            logging.exception(ex)
+        self.pending, self.trim = [], {}
+
+
 class HistoryFilter:
     def __init__(self, timestamp_1=None, timestamp_2=None, msgid_1=None, msgid_2=None, limit=0, cmd=None):
         self.timestamp_1 = timestamp_1
@@ -92,35 +534,65 @@ def history_validate_param(client, channel, action, mode, param, CHK_TYPE):
 
 
 def clear_history_channel_destroy(client, channel):
-    if channel in ChatHistory.backlog:
-        del ChatHistory.backlog[channel]
+    key = ChatHistory.history_key(channel)
+    ChatHistory.storage.clear(key)
+    HistoryExpiry.unschedule(key)
 
 
-def create_history_channel_create(client, channel):
-    ChatHistory.backlog[channel] = []
+def history_channel_rename(client, channel, old_name):
+    old_key, key = old_name.lower(), ChatHistory.history_key(channel)
+    if old_key == key:
+        return
+    ChatHistory.storage.rename(old_key, key)
+    HistoryExpiry.unschedule(old_key)
+    HistoryExpiry.unschedule(key)
+    if (oldest := ChatHistory.storage.oldest_time(key)) is not None:
+        HistoryExpiry.schedule(key, oldest)
 
 
-def add_to_historybuf(client, channel, message, sendtype):
-    limit = ChatHistory.max_unreg if 'r' not in channel.modes else ChatHistory.max_reg
-    if channel not in ChatHistory.backlog:
-        ChatHistory.backlog[channel] = []
-    while limit and len(ChatHistory.backlog[channel]) >= limit:
-        ChatHistory.backlog[channel] = ChatHistory.backlog[channel][1:]
-    utc_time = utc_time = datetime.now(timezone.utc).timestamp()
-    history_obj = ChatHistory(sender=client.fullmask, mtags=client.mtags, svid=client.user.account, utc_time=utc_time, sendtype=sendtype, data=message)
-    ChatHistory.add_to_buff(channel, history_obj)
+def add_to_historybuf(client, key: str, message, sendtype, limit: int, recipient=None):
+    utc_time = datetime.now(timezone.utc).timestamp()
+    # Copy the tags: client.mtags is cleared after the command has been processed.
+    history_obj = ChatHistory(sender=client.fullmask, mtags=list(client.mtags), svid=client.user.account, utc_time=utc_time,
+                              sendtype=sendtype, data=message, recipient=recipient)
+    ChatHistory.add_to_buff(key, history_obj, limit)
 
 
-def add_to_historybuf_privmsg(client, channel, message, prefix):
+def add_channel_history(client, channel, message, sendtype):
+    """ Used for both local and remote messages, so every server keeps history of its +H channels. """
     if 'H' not in channel.modes:
         return
-    add_to_historybuf(client, channel, message, sendtype="PRIVMSG")
+    limit = ChatHistory.max_unreg if 'r' not in channel.modes else ChatHistory.max_reg
+    add_to_historybuf(client, ChatHistory.history_key(channel), message, sendtype, limit)
+
+
+def add_to_historybuf_privmsg(client, channel, message, prefix):
+    add_channel_history(client, channel, message, sendtype="PRIVMSG")
 
 
 def add_to_historybuf_notice(client, channel, message, prefix):
-    if 'H' not in channel.modes:
+    add_channel_history(client, channel, message, sendtype="NOTICE")
+
+
+def add_private_history(client, to_client, message, sendtype):
+    """
+    Private messages are stored once per conversation, on the servers of the participants.
+    Remote hooks also fire on servers that only relay the message, so those are skipped.
+    """
+    if not ChatHistory.private_limit or not (client.local or to_client.local):
+        return
+    if not (sender := ChatHistory.participant(client)) or not (receiver := ChatHistory.participant(to_client)):
         return
-    add_to_historybuf(client, channel, message, sendtype="NOTICE")
+    key = ChatHistory.dm_key(sender, receiver)
+    add_to_historybuf(client, key, message, sendtype, ChatHistory.private_limit, recipient=to_client.name)
+
+
+def add_to_historybuf_usermsg(client, to_client, message):
+    add_private_history(client, to_client, message, sendtype="PRIVMSG")
+
+
+def add_to_historybuf_usernotice(client, to_client, message):
+    add_private_history(client, to_client, message, sendtype="NOTICE")
 
 
 def show_history_on_join(client, channel):
@@ -133,18 +605,18 @@ def show_history_on_join(client, channel):
     history_filter = HistoryFilter()
     history_filter.cmd = ChatHistory.LATEST
     history_filter.limit = 10
-    results = get_chathistory(channel, history_filter)
-    send_history(client, channel, results)
+    results = get_chathistory(ChatHistory.history_key(channel), history_filter)
+    send_history(client, channel.name, results)
 
 
-def send_history(client, channel, results: list) -> None:
+def send_history(client, target_name: str, results: list) -> None:
     if not client.has_capability("server-time"):
         return
     ChatHistory.reply_time[client] = int(time())
     batch = None
     if client.has_capability("batch"):
         batch = Batch(started_by=IRCD.me)
-        client.send([], f":{IRCD.me.name} BATCH +{batch.label} chathistory {channel.name}")
+        client.send([], f":{IRCD.me.name} BATCH +{batch.label} chathistory {target_name}")
     if results:
         for history_obj in results:
             filtered_mtags = []
@@ -154,100 +626,91 @@ def send_history(client, channel, results: list) -> None:
             for tag in MessageTag.filter_tags(history_obj.mtags, client):
                 filtered_mtags.append(tag)
             data = f"{'@' + ';'.join([t.string for t in filtered_mtags]) + ' ' if filtered_mtags else ''}" \
-                   f":{history_obj.sender} {history_obj.sendtype} {channel.name} :{history_obj.data}"
+                   f":{history_obj.sender} {history_obj.sendtype} {history_obj.recipient or target_name} :{history_obj.data}"
             client.send([], data)
 
     if batch:
         client.send([], f":{IRCD.me.name} BATCH -{batch.label}")
 
 
-def get_chathistory(channel, history_filter: HistoryFilter) -> list:
-    if channel not in ChatHistory.backlog:
+def get_chathistory(key: str, history_filter: HistoryFilter) -> list:
+    """
+    Returns the requested history entries, oldest first.
+    Message references are exclusive, as described in the IRCv3 chathistory specification.
+    """
+
+    if not (buffer := ChatHistory.storage.view(key)):
         return []
 
-    results = []
+    limit = history_filter.limit
+    time_1 = ChatHistory.timestr_to_timestamp(history_filter.timestamp_1) if history_filter.timestamp_1 else 0
+    time_2 = ChatHistory.timestr_to_timestamp(history_filter.timestamp_2) if history_filter.timestamp_2 else 0
+    has_ref_1 = history_filter.msgid_1 or history_filter.timestamp_1
+    end = buffer.end
+
     match history_filter.cmd:
-        case ChatHistory.BEFORE:
-            if history_filter.timestamp_1:
-                time_float = ChatHistory.timestr_to_timestamp(history_filter.timestamp_1)
-                for history_obj in ChatHistory.backlog[channel]:
-                    if history_obj.utc_time < time_float and len(results) < history_filter.limit:
-                        results.append(history_obj)
-            elif history_filter.msgid_1:
-                for history_obj in ChatHistory.backlog[channel]:
-                    if history_obj.msgid == history_filter.msgid_1:
-                        break
-                    if len(results) < history_filter.limit:
-                        results.append(history_obj)
-
-        case ChatHistory.AFTER:
-            if history_filter.timestamp_1:
-                time_float = ChatHistory.timestr_to_timestamp(history_filter.timestamp_1)
-                for history_obj in ChatHistory.backlog[channel]:
-                    if history_obj.utc_time > time_float and len(results) < history_filter.limit:
-                        results.append(history_obj)
-            elif history_filter.msgid_1:
-                msgid_found = 0
-                for history_obj in ChatHistory.backlog[channel]:
-                    if history_obj.msgid == history_filter.msgid_1:
-                        msgid_found = 1
-                        continue
-                    if msgid_found and len(results) < history_filter.limit:
-                        results.append(history_obj)
+        case ChatHistory.BEFORE if has_ref_1:
+            if (pos := buffer.before(time_1, history_filter.msgid_1)) >= 0:
+                return buffer.slice(buffer.start, pos, limit, latest=1)
+
+        case ChatHistory.AFTER if has_ref_1:
+            if (pos := buffer.after(time_1, history_filter.msgid_1)) >= 0:
+                return buffer.slice(pos, end, limit)
 
         case ChatHistory.LATEST:
-            if not history_filter.timestamp_1 and not history_filter.msgid_1:
-                for history_obj in ChatHistory.backlog[channel]:
-                    if len(results) < history_filter.limit:
-                        results.append(history_obj)
-
-            elif history_filter.timestamp_1:
-                time_float = ChatHistory.timestr_to_timestamp(history_filter.timestamp_1)
-                for history_obj in ChatHistory.backlog[channel]:
-                    if history_obj.utc_time < time_float and len(results) < history_filter.limit:
-                        results.append(history_obj)
-
-            elif history_filter.msgid_1:
-                msgid_found = 0
-                for history_obj in ChatHistory.backlog[channel]:
-                    if history_obj.msgid == history_filter.msgid_1:
-                        msgid_found = 1
-                        continue
-                    if msgid_found and len(results) < history_filter.limit:
-                        results.append(history_obj)
-
-        case ChatHistory.BETWEEN:
-            if history_filter.timestamp_1 and history_filter.timestamp_2:
-                time1_float = ChatHistory.timestr_to_timestamp(history_filter.timestamp_1)
-                time2_float = ChatHistory.timestr_to_timestamp(history_filter.timestamp_2)
-                msg_found = 0
-                for history_obj in ChatHistory.backlog[channel]:
-                    if history_obj.utc_time > time1_float and not msg_found:
-                        msg_found = 1
-                        continue
-                    if history_obj.utc_time >= time2_float or len(results) >= history_filter.limit:
-                        break
-                    if msg_found:
-                        results.append(history_obj)
-            elif history_filter.msgid_1 and history_filter.msgid_2:
-                msg_found = 0
-                for history_obj in ChatHistory.backlog[channel]:
-                    if history_obj.msgid == history_filter.msgid_1 and not msg_found:
-                        msg_found = 1
-                        continue
-                    if history_obj.msgid == history_filter.msgid_2 or len(results) >= history_filter.limit:
-                        break
-                    if msg_found:
-                        results.append(history_obj)
-    return results
+            if not has_ref_1:
+                return buffer.slice(buffer.start, end, limit, latest=1)
+            if (pos := buffer.after(time_1, history_filter.msgid_1)) >= 0:
+                return buffer.slice(pos, end, limit, latest=1)
+
+        case ChatHistory.AROUND if has_ref_1:
+            if (pos := buffer.before(time_1, history_filter.msgid_1)) >= 0:
+                earlier = buffer.slice(buffer.start, pos, limit // 2, latest=1)
+                return earlier + buffer.slice(pos, end, limit - len(earlier))
+
+        case ChatHistory.BETWEEN if has_ref_1 and (history_filter.msgid_2 or history_filter.timestamp_2):
+            ref_1, ref_2 = (time_1, history_filter.msgid_1), (time_2, history_filter.msgid_2)
+            if (t1 := buffer.reference_time(*ref_1)) is None or (t2 := buffer.reference_time(*ref_2)) is None:
+                return []
+            if t1 <= t2:
+                return buffer.slice(buffer.after(*ref_1), buffer.before(*ref_2), limit)
+            return buffer.slice(buffer.after(*ref_2), buffer.before(*ref_1), limit, latest=1)
+
+    return []
+
+
+def get_history_targets(client, time_1: float, time_2: float, limit: int) -> list:
+    """
+    Returns (name, latest_time) of the channels and private conversations of `client`
+    with a latest message between `time_1` and `time_2` (exclusive), ordered by that time.
+    """
+
+    names = {ChatHistory.history_key(channel): channel.name for channel in client.channels if 'H' in channel.modes}
+    if (participant := ChatHistory.participant(client)) and (conversations := ChatHistory.storage.conversations(participant)):
+        # Built once per request, instead of searching all users for every conversation.
+        online = {c.user.account.lower(): c.name for c in IRCD.global_users() if c.user.account != '*'}
+        for key in conversations:
+            names[key] = ChatHistory.dm_peer(key, participant, online)
+
+    low, high = min(time_1, time_2), max(time_1, time_2)
+    targets = sorted((latest, names[key]) for key, latest in ChatHistory.storage.latest_times(names).items() if low < latest < high)
+    if not limit:
+        return []
+    # As with BETWEEN, the limit is applied from the first timestamp onwards.
+    targets = targets[:limit] if time_1 <= time_2 else targets[-limit:]
+    return [(name, latest) for latest, name in targets]
 
 
 def chmode_H_mode(client, channel, modebuf, parambuf):
-    if 'H' in modebuf:
-        if 'H' not in channel.modes:
-            del ChatHistory.backlog[channel]
-        else:
-            ChatHistory.backlog[channel] = []
+    if 'H' not in modebuf:
+        return
+    key = ChatHistory.history_key(channel)
+    if 'H' not in channel.modes:
+        ChatHistory.storage.clear(key)
+        HistoryExpiry.unschedule(key)
+    elif (oldest := ChatHistory.storage.oldest_time(key)) is not None:
+        # The expire time may have changed, or history was restored from persistent storage.
+        HistoryExpiry.schedule(key, oldest)
 
 
 def cmd_history(client, recv):
@@ -266,8 +729,8 @@ def cmd_history(client, recv):
 
     client.local.flood_penalty += 10_000
     history_filter = HistoryFilter(cmd=ChatHistory.LATEST, limit=10)
-    results = get_chathistory(channel, history_filter)
-    send_history(client, channel, results)
+    results = get_chathistory(ChatHistory.history_key(channel), history_filter)
+    send_history(client, channel.name, results)
 
 
 def check_chathistory_conf():
@@ -289,6 +752,18 @@ def check_chathistory_conf():
     if not max_unreg.isdigit() or int(max_reg) <= 0:
         return conf_error("chathistory::max-lines-registered missing must be a positive number")
 
+    storage = block.get_single_value("storage") or "memory"
+    if storage not in ["memory", "sqlite"]:
+        return conf_error(f"chathistory::storage must be either 'memory' or 'sqlite', not '{storage}'")
+
+    private_limit, private_expire = 0, 0
+    if private := block.get_single_value("private-messages"):
+        if len(private.split(':')) != 2 or not all(value.isdigit() for value in private.split(':')):
+            return conf_error("chathistory::private-messages must be in the format <maxlines>:<expire_in_minutes>")
+        private_limit, private_expire = (int(value) for value in private.split(':'))
+        if not private_expire:
+            return conf_error("chathistory::private-messages expire time must be a positive number")
+
     max_reg, max_unreg = int(max_reg), int(max_unreg)
     if max_reg > 10000:
         max_reg = 10000
@@ -298,27 +773,46 @@ def check_chathistory_conf():
 
     ChatHistory.max_reg = max_reg
     ChatHistory.max_unreg = max_unreg
+    ChatHistory.private_limit = min(private_limit, 10000)
+    ChatHistory.private_expire = private_expire
+
+    storage_class = SQLiteStorage if storage == "sqlite" else MemoryStorage
+    if not isinstance(ChatHistory.storage, storage_class):
+        if ChatHistory.storage:
+            ChatHistory.storage.flush()
+        try:
+            ChatHistory.storage = SQLiteStorage("data/chathistory.db") if storage == "sqlite" else MemoryStorage()
+        except sqlite3.Error as ex:
+            logging.exception(ex)
+            ChatHistory.storage = MemoryStorage()
 
 
 def post_load(module):
     check_chathistory_conf()
+    HistoryExpiry.rebuild()
 
 
 def check_expired_backlog():
-    for channel in list(ChatHistory.backlog):
-        if 'H' not in channel.modes:
-            del ChatHistory.backlog[channel]
+    heap = HistoryExpiry.heap
+    utc_time = datetime.now(timezone.utc).timestamp()
+    while heap and heap[0][0] <= utc_time:
+        expire_at, _, key = heapq.heappop(heap)
+        if HistoryExpiry.scheduled.get(key) != expire_at:
+            continue
+        del HistoryExpiry.scheduled[key]
+        if not (expire := ChatHistory.expire_minutes(key)):
             continue
 
-        param = channel.get_param('H')
-        expire = int(param.split(':')[1])
-        utc_time = datetime.now(timezone.utc).timestamp()
-        for history_entry in list(ChatHistory.backlog[channel]):
-            if utc_time - int(history_entry.utc_time) >= (expire * 60):
-                ChatHistory.backlog[channel].remove(history_entry)
+        ChatHistory.storage.expire(key, utc_time - expire * 60)
+        if (oldest := ChatHistory.storage.oldest_time(key)) is not None:
+            HistoryExpiry.schedule(key, oldest)
+
+    ChatHistory.storage.flush_if_due()
 
 
 def init(module):
+    if not ChatHistory.storage:
+        ChatHistory.storage = MemoryStorage()
     Chmode_H = Channelmode()
     Chmode_H.flag = 'H'
     Chmode_H.param_help = "[maxlines:expire_in_minutes]"
@@ -331,9 +825,15 @@ def init(module):
     Command.add(module, cmd_history, "HISTORY", 1)
     Hook.add(Hook.LOCAL_CHANMSG, add_to_historybuf_privmsg)
     Hook.add(Hook.LOCAL_CHANNOTICE, add_to_historybuf_notice)
+    Hook.add(Hook.REMOTE_CHANMSG, add_to_historybuf_privmsg)
+    Hook.add(Hook.REMOTE_CHANNOTICE, add_to_historybuf_notice)
+    Hook.add(Hook.LOCAL_USERMSG, add_to_historybuf_usermsg)
+    Hook.add(Hook.REMOTE_USERMSG, add_to_historybuf_usermsg)
+    Hook.add(Hook.LOCAL_USERNOTICE, add_to_historybuf_usernotice)
+    Hook.add(Hook.REMOTE_USERNOTICE, add_to_historybuf_usernotice)
     Hook.add(Hook.LOCAL_JOIN, show_history_on_join)
-    Hook.add(Hook.CHANNEL_CREATE, create_history_channel_create)
     Hook.add(Hook.CHANNEL_DESTROY, clear_history_channel_destroy)
+    Hook.add(Hook.CHANNEL_RENAME, history_channel_rename)
     Hook.add(Hook.LOCAL_CHANNEL_MODE, chmode_H_mode)
     Hook.add(Hook.REMOTE_CHANNEL_MODE, chmode_H_mode)
     Hook.add(Hook.LOOP, check_expired_backlog)
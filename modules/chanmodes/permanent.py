@@ -2,15 +2,14 @@
 channel mode +P (permanent channel)
 """
 
-from handle.core import IRCD, Channel, Channelmode, Hook
-
-ChannelData = {}
+from handle.core import IRCD, Channel, Channelmode, Hook, DataStore
 
 
 def permanent_channel_destroy(client, channel):
     if 'P' in channel.modes:
         IRCD.channel_count += 1
         Channel.table.append(channel)
+        channel.set_membercount(0)
 
 
 def permanent_channel_join(client, channel):
@@ -19,11 +18,11 @@ def permanent_channel_join(client, channel):
 
 
 def save_channel(client, channel, *args):
-    """ Save channel info to json """
+    """ Save channel info to the data store """
     if 'P' not in channel.modes:
         return
 
-    ChannelData[channel.name] = {
+    DataStore.put("channels", channel.name, {
         "params": {mode: channel.get_param(mode) for mode in channel.modes if channel.get_param(mode)},
         "listmodes": {
             mode: [[le.mask, le.set_by, le.set_time] for le in channel.List[mode]]
@@ -33,14 +32,13 @@ def save_channel(client, channel, *args):
         "topic": (channel.topic, channel.topic_time, channel.topic_author),
         "modes": channel.modes,
         "creation": channel.creationtime
-    }
-
-    IRCD.write_data_file(ChannelData, "channels.db")
+    })
 
 
 def restore_channel():
-    """ Restore channel from json """
-    if ChannelData := IRCD.read_data_file("channels.db"):
+    """ Restore channels from the data store """
+    DataStore.import_data_file("channels", "channels.db")
+    if ChannelData := DataStore.items("channels"):
         for chan, data in ChannelData.items():
             channel = IRCD.create_channel(IRCD.me, chan)
             channel.creationtime = data["creation"]
@@ -58,13 +56,10 @@ def restore_channel():
 
 
 def save_channel_mode(client, channel, modebuf, parambuf):
-    if 'P' in modebuf:
-        ChannelData = IRCD.read_data_file("channels.db")
-        if 'P' not in channel.modes and channel.name in ChannelData:
-            del ChannelData[channel.name]
-            if channel.membercount == 0:
-                IRCD.destroy_channel(IRCD.me, channel)
-            IRCD.write_data_file(ChannelData, "channels.db")
+    if 'P' in modebuf and 'P' not in channel.modes:
+        DataStore.delete("channels", channel.name)
+        if channel.membercount == 0:
+            IRCD.destroy_channel(IRCD.me, channel)
 
     save_channel(client, channel)
 
@@ -1,13 +1,25 @@
 """
-Fetches and saves client geodata from ipapi.co.
-Edit API_URL to change.
+Country and ASN information of connecting clients.
+
+With settings::geoip-country and/or settings::geoip-asn set, lookups are answered from local
+CSV files with one IP range per line: start,end,value[,name]. Start and end can be IP addresses
+or integers, which covers the common free databases (db-ip lite, ip2location lite, ip-location-db).
+Without them, data is fetched from ipapi.co. Edit API_URL to change.
 """
 
-from handle.core import IRCD, Hook, Numeric
-from urllib import request
-import json
+import csv
 import ipaddress
+import json
+import os
+import socket
+from array import array
+from bisect import bisect_right
 from time import time
+from urllib import request
+
+from handle.core import IRCD, Hook, Numeric, DataStore
+from handle.logger import logging
+from handle.validate_conf import conf_error
 
 API_URL = "https://ipapi.co/%ip/json/"
 
@@ -18,6 +30,116 @@ class GeoData:
     process = []
 
 
+def ip_to_int(ip: str) -> tuple:
+    """
+    Returns (family, integer) for an IP address in dotted, colon or integer notation.
+    The family of an integer is 0, because a single number does not tell.
+    """
+    if ip.isdigit():
+        return 0, int(ip)
+    if ':' in ip:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+    return 4, int.from_bytes(socket.inet_aton(ip), "big")
+
+
+class GeoTable:
+    """
+    IP ranges from a CSV file, as sorted start and end arrays per address family.
+    A lookup is a single bisect on the range starts.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        rows = {4: [], 6: []}
+        # Identical values share one tuple, most ranges map to a few hundred countries.
+        values = {}
+        with open(path, newline='', encoding="utf-8", errors="replace") as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[2] in ['', '-']:
+                    continue
+                try:
+                    family, start = ip_to_int(row[0].strip())
+                    end_family, end = ip_to_int(row[1].strip())
+                except (OSError, ValueError):
+                    # Header or comment line.
+                    continue
+                if family != end_family or not start <= end < 1 << 128:
+                    continue
+                value = tuple(v.strip() for v in row[2:4])
+                rows.setdefault(family, []).append((start, end, values.setdefault(value, value)))
+
+        # Databases in integer notation have one file per family. A file with any number over 32 bits is IPv6.
+        if numbers := rows.pop(0, None):
+            rows[6 if any(e[1] > 0xFFFFFFFF for e in numbers) else 4].extend(numbers)
+
+        self.starts, self.ends, self.values = {}, {}, {}
+        for family, entries in rows.items():
+            entries.sort()
+            self.starts[family] = array('L', (e[0] for e in entries)) if family == 4 else [e[0] for e in entries]
+            self.ends[family] = array('L', (e[1] for e in entries)) if family == 4 else [e[1] for e in entries]
+            self.values[family] = [e[2] for e in entries]
+        self.size = len(rows[4]) + len(rows[6])
+
+    def find(self, family: int, number: int):
+        index = bisect_right(self.starts[family], number) - 1
+        if index >= 0 and number <= self.ends[family][index]:
+            return self.values[family][index]
+
+    def lookup(self, ip: str):
+        try:
+            family, number = ip_to_int(ip)
+        except (OSError, ValueError):
+            return None
+        if (value := self.find(family, number)) is None and family == 4:
+            # IPv6 databases may list IPv4 as ::ffff:a.b.c.d
+            value = self.find(6, 0xFFFF00000000 | number)
+        return value
+
+
+class GeoIP:
+    country = None
+    asn = None
+    loading = 0
+
+    @staticmethod
+    def enabled() -> int:
+        return bool(GeoIP.country or GeoIP.asn)
+
+    @staticmethod
+    def lookup(ip: str) -> dict:
+        result = {}
+        if GeoIP.country and (value := GeoIP.country.lookup(ip)):
+            result["country"] = value[0].upper()
+            if len(value) > 1 and value[1]:
+                result["country_name"] = value[1]
+        if GeoIP.asn and (value := GeoIP.asn.lookup(ip)):
+            result["asn"] = value[0] if value[0].upper().startswith("AS") else f"AS{value[0]}"
+            if len(value) > 1 and value[1]:
+                result["org"] = value[1]
+        return result
+
+    @staticmethod
+    def load(paths: dict):
+        """ Loads changed tables and swaps them in at once, so lookups never see a half-loaded table. """
+        tables = {}
+        try:
+            for attribute, path in paths.items():
+                table = getattr(GeoIP, attribute)
+                if not path:
+                    tables[attribute] = None
+                elif not table or table.path != path or table.mtime != os.path.getmtime(path):
+                    start = time()
+                    tables[attribute] = table = GeoTable(path)
+                    logging.info(f"Loaded {table.size} GeoIP ranges from {path} in {time() - start:.2f} seconds")
+            for attribute, table in tables.items():
+                setattr(GeoIP, attribute, table)
+        except (OSError, csv.Error, OverflowError) as ex:
+            logging.exception(ex)
+        finally:
+            GeoIP.loading = 0
+
+
 def api_call(client):
     try:
         response = request.urlopen(API_URL.replace("%ip", client.ip), timeout=10)
@@ -26,7 +148,7 @@ def api_call(client):
         json_response["ircd_time_added"] = int(time())
         GeoData.data.update({client.ip: json_response})
         GeoData.clients[client] = json_response
-        IRCD.write_data_file(GeoData.data, filename="geodata.json")
+        DataStore.put("geodata", client.ip, json_response)
     except:
         pass
     GeoData.process.remove(client.ip)
@@ -34,14 +156,26 @@ def api_call(client):
 
 
 def country_whois(client, whois_client, lines):
-    if whois_client in GeoData.clients and "country_name" in GeoData.clients[whois_client] and 'o' in client.user.modes:
-        line = (Numeric.RPL_WHOISSPECIAL, whois_client.name, f"is connecting from country: {GeoData.clients[whois_client]['country_name']}")
-        lines.append(line)
+    if 'o' not in client.user.modes or not (geodata := GeoData.clients.get(whois_client)):
+        return
+    if country := geodata.get("country_name") or geodata.get("country"):
+        lines.append((Numeric.RPL_WHOISSPECIAL, whois_client.name, f"is connecting from country: {country}"))
+    if asn := geodata.get("asn"):
+        lines.append((Numeric.RPL_WHOISSPECIAL, whois_client.name, f"is connecting from {asn}{' (' + geodata['org'] + ')' if geodata.get('org') else ''}"))
 
 
 def geodata_lookup(client):
     if not ipaddress.ip_address(client.ip).is_global:
         return
+
+    if GeoIP.enabled():
+        # Answered locally before registration, so country masks in allow, ban and require blocks can match.
+        if geodata := GeoIP.lookup(client.ip):
+            GeoData.clients[client] = geodata
+            if country := geodata.get("country"):
+                client.add_md(name="country", value=country, sync=1)
+        return
+
     if client.ip in GeoData.data:
         """ Assign cached data to this client. """
         GeoData.clients[client] = GeoData.data[client.ip]
@@ -56,14 +190,11 @@ def geodata_lookup(client):
 
 
 def geodata_expire():
-    changed = 0
     for entry in list(GeoData.data):
         added = GeoData.data[entry]["ircd_time_added"]
         if int(time() - added >= 2_629_744):
-            changed = 1
             del GeoData.data[entry]
-    if changed:
-        IRCD.write_data_file(GeoData.data, filename="geodata.json")
+            DataStore.delete("geodata", entry)
 
 
 def geodata_remote(client):
@@ -76,10 +207,27 @@ def geodata_quit(client, reason):
         del GeoData.clients[client]
 
 
+def post_load(module):
+    paths = {"country": IRCD.get_setting("geoip-country"), "asn": IRCD.get_setting("geoip-asn")}
+    for setting, path in paths.items():
+        if path and not os.path.isfile(path):
+            return conf_error(f"settings::geoip-{setting} file not found: {path}")
+
+    if not GeoIP.enabled():
+        # First load: block, so the very first connections already get their country.
+        GeoIP.load(paths)
+    elif not GeoIP.loading:
+        # Rehash: reload changed files in the background and keep answering from the old tables meanwhile.
+        GeoIP.loading = 1
+        IRCD.run_parallel_function(target=GeoIP.load, args=(paths,))
+
+
 def init(module):
-    GeoData.data = IRCD.read_data_file("geodata.json")
+    DataStore.import_data_file("geodata", "geodata.json")
+    GeoData.data = DataStore.items("geodata")
     Hook.add(Hook.NEW_CONNECTION, geodata_lookup)
     Hook.add(Hook.REMOTE_CONNECT, geodata_remote)
     Hook.add(Hook.LOCAL_QUIT, geodata_quit)
+    Hook.add(Hook.REMOTE_QUIT, geodata_quit)
     Hook.add(Hook.WHOIS, country_whois)
     Hook.add(Hook.LOOP, geodata_expire)
@@ -2,7 +2,7 @@
 /chgcname command
 """
 
-from handle.core import Command, Capability, IRCD, Flag, Numeric
+from handle.core import Command, Capability, IRCD, Flag, Numeric, Hook
 
 
 # https://ircv3.net/specs/extensions/channel-rename
@@ -50,6 +50,7 @@ def cmd_rename(client, recv):
 
     old_name = channel.name
     channel.name = name
+    IRCD.run_hook(Hook.CHANNEL_RENAME, client, channel, old_name)
 
     for user in [u for u in IRCD.local_users() if channel.find_member(u) and not u.has_capability("draft/channel-rename")]:
         data = f":{user.fullmask} PART {old_name}"
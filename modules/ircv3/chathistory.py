@@ -3,9 +3,9 @@ Provides IRCv3 CHATHISTORY support.
 https://ircv3.net/specs/extensions/chathistory
 """
 
-from handle.core import IRCD, Command, Isupport, Capability, Numeric
-from modules.chanmodes.m_history import HistoryFilter, get_chathistory, send_history, ChatHistory
-from datetime import datetime
+from handle.core import IRCD, Command, Isupport, Capability, Numeric, Batch, MessageTag
+from modules.chanmodes.m_history import HistoryFilter, get_chathistory, get_history_targets, send_history, ChatHistory
+from datetime import datetime, timezone
 
 
 def parse_history_filter(token: str, param: str, history_filter: HistoryFilter, attribute_name: str) -> int:
@@ -24,21 +24,83 @@ def parse_history_filter(token: str, param: str, history_filter: HistoryFilter,
         return 1
 
 
+def resolve_target(client, target: str):
+    """
+    Returns the history key and display name of `target`, which is either a channel or a nickname.
+    For nicknames this is the private conversation between the accounts of `client` and that user.
+    If the other side is offline, `target` is taken as their account name.
+    """
+
+    if target[0] in IRCD.CHANPREFIXES:
+        if not (channel := IRCD.find_channel(target)):
+            client.sendnumeric(Numeric.ERR_NOSUCHCHANNEL, target)
+            return None
+        if not channel.find_member(client) and not client.has_permission("channel:see:history"):
+            client.sendnumeric(Numeric.ERR_NOTONCHANNEL, channel.name)
+            return None
+        return ChatHistory.history_key(channel), channel.name
+
+    user = IRCD.find_user(target)
+    peer = ChatHistory.participant(user) if user and user.user else "a:" + target.lower()
+    if not (participant := ChatHistory.participant(client)) or not peer:
+        client.send([], f"FAIL CHATHISTORY INVALID_TARGET {target} :Private message history is only kept between logged in users")
+        return None
+    return ChatHistory.dm_key(participant, peer), user.name if user and user.user else target
+
+
+def timestamp_param(param: str) -> float | None:
+    history_filter = HistoryFilter()
+    if not parse_history_filter("timestamp", param, history_filter, "timestamp_1"):
+        return None
+    return ChatHistory.timestr_to_timestamp(history_filter.timestamp_1)
+
+
+def send_targets(client, recv):
+    """ CHATHISTORY TARGETS <timestamp> <timestamp> <limit> """
+
+    if len(recv) < 5:
+        return client.send([], "FAIL CHATHISTORY NEED_MORE_PARAMS TARGETS :Insufficient parameters")
+    time_1, time_2 = timestamp_param(recv[2]), timestamp_param(recv[3])
+    for param, timestamp in [(recv[2], time_1), (recv[3], time_2)]:
+        if timestamp is None:
+            return client.send([], f"FAIL CHATHISTORY INVALID_PARAMS {param} :Invalid parameter, must be timestamp=xxx")
+    if not recv[4].isdigit():
+        return IRCD.server_notice(client, "Limit must be a number.")
+
+    batch = None
+    if client.has_capability("batch"):
+        batch = Batch(started_by=IRCD.me)
+        client.send([], f":{IRCD.me.name} BATCH +{batch.label} draft/chathistory-targets")
+    for name, latest in get_history_targets(client, time_1, time_2, int(recv[4])):
+        timestr = datetime.fromtimestamp(latest, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+        batch_tag = f"@{MessageTag.find_tag('batch')(value=batch.label).string} " if batch else ''
+        client.send([], f"{batch_tag}:{IRCD.me.name} CHATHISTORY TARGETS {name} {timestr}")
+    if batch:
+        client.send([], f":{IRCD.me.name} BATCH -{batch.label}")
+
+
 def cmd_chathistory(client, recv):
     if not client.has_capability("draft/chathistory") or not client.has_capability("server-time") or not client.has_capability("message-tags"):
         return
-    target = recv[2]
-    if not (channel := IRCD.find_channel(target)):
-        return client.sendnumeric(Numeric.ERR_NOSUCHCHANNEL, target)
-
-    if channel.find_member(client) and not client.has_permission("channel:see:history"):
-        return client.sendnumeric(Numeric.ERR_NOTONCHANNEL)
 
     cmd = recv[1].lower()
+    if cmd == "targets":
+        return send_targets(client, recv)
+
+    if cmd not in ["before", "after", "around", "between", "latest"]:
+        return client.send([], f"FAIL CHATHISTORY INVALID_PARAMS {recv[1]} :Unknown subcommand")
+
+    if len(recv) < 5:
+        return client.send([], f"FAIL CHATHISTORY NEED_MORE_PARAMS {recv[1]} :Insufficient parameters")
+
+    if not (resolved := resolve_target(client, recv[2])):
+        return
+    key, target = resolved
+
     match cmd:
-        case "before" | "after":
+        case "before" | "after" | "around":
             history_filter = HistoryFilter()
-            history_filter.cmd = ChatHistory.BEFORE if cmd == "before" else ChatHistory.AFTER
+            history_filter.cmd = {"before": ChatHistory.BEFORE, "after": ChatHistory.AFTER, "around": ChatHistory.AROUND}[cmd]
             if not parse_history_filter("timestamp", recv[3], history_filter, "timestamp_1") and not parse_history_filter("msgid", recv[3], history_filter, "msgid_1"):
                 data = f"FAIL CHATHISTORY INVALID_PARAMS {recv[3]} :Invalid parameter, must be timestamp=xxx or msgid=xxx"
                 return client.send([], data)
@@ -46,8 +108,8 @@ def cmd_chathistory(client, recv):
             if not limit.isdigit():
                 return IRCD.server_notice(client, "Limit must be a number.")
             history_filter.limit = int(limit)
-            results = get_chathistory(channel, history_filter)
-            send_history(client, channel, results)
+            results = get_chathistory(key, history_filter)
+            send_history(client, target, results)
             return
 
         case "between":
@@ -67,8 +129,8 @@ def cmd_chathistory(client, recv):
             if not limit.isdigit():
                 return IRCD.server_notice(client, "Limit must be a number.")
             history_filter.limit = int(limit)
-            results = get_chathistory(channel, history_filter)
-            send_history(client, channel, results)
+            results = get_chathistory(key, history_filter)
+            send_history(client, target, results)
 
         case "latest":
             history_filter = HistoryFilter()
@@ -78,14 +140,14 @@ def cmd_chathistory(client, recv):
                 return IRCD.server_notice(client, "Limit must be a number.")
             history_filter.limit = int(limit)
             if recv[3] == '*':
-                results = get_chathistory(channel, history_filter)
-                send_history(client, channel, results)
+                results = get_chathistory(key, history_filter)
+                send_history(client, target, results)
                 return
             if not parse_history_filter("timestamp", recv[3], history_filter, "timestamp_1") and not parse_history_filter("msgid", recv[3], history_filter, "msgid_1"):
                 data = f"FAIL CHATHISTORY INVALID_PARAMS {recv[3]} :Invalid parameter, must be timestamp=xxx or msgid=xxx"
                 return client.send([], data)
-            results = get_chathistory(channel, history_filter)
-            send_history(client, channel, results)
+            results = get_chathistory(key, history_filter)
+            send_history(client, target, results)
 
 
 def init(module):
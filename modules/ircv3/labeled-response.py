@@ -5,7 +5,7 @@ https://ircv3.net/specs/extensions/labeled-response.html
 
 import re
 
-from handle.core import MessageTag, Capability, Hook, IRCD, Batch
+from handle.core import MessageTag, Capability, Hook, IRCD, Batch, ReplyStream
 from handle.logger import logging
 
 
@@ -59,7 +59,10 @@ def ircv3_label_post_command(client, trigger, recv):
             client.mtags[0:0] = [Currentcmd.labeltag]
             # logging.debug(f"Label tag added to beginning of tags for {client.name}")
         batch = None
-        if len(Currentcmd.buffer) == 0:
+        if client.has_capability("batch") and (stream := ReplyStream.find_labeled(client, Currentcmd.label)):
+            # The command is still sending replies from the main loop, the stream ends the batch.
+            stream.take_label(Currentcmd.buffer)
+        elif len(Currentcmd.buffer) == 0:
             data = f":{IRCD.me.name} ACK"
             client.send([Currentcmd.labeltag], data)
         else:
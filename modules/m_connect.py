@@ -28,7 +28,7 @@ def connect_to(client, link, auto_connect=0):
         if client.user:
             msg = f"*** {client.name} ({client.user.username}@{client.user.realhost}) has opened a{' secure' if is_tls else 'n insecure'} link channel to {link.name}..."
             IRCD.log(client, "info", "link", "LINK_CONNECTING", msg)
-        if not IRCD.find_server(link.name) and not IRCD.current_link_sync:
+        if not IRCD.find_server(link.name):
             IRCD.run_parallel_function(target=start_outgoing_link, args=(link, is_tls, auto_connect))
 
     except Exception as ex:
@@ -49,11 +49,6 @@ def cmd_connect(client, recv):
     if "HTTP/" in recv:
         return client.exit("Illegal command")
 
-    if IRCD.current_link_sync:
-        client.local.flood_penalty += 100_000
-        logging.debug(f"Current link sync: {IRCD.current_link_sync}")
-        return IRCD.server_notice(client, f"A link sync is already in process, try again in a few seconds.")
-
     name = recv[1].strip()
     if name.lower() == IRCD.me.name.lower():
         return IRCD.server_notice(client, "*** Cannot link to own local server.")
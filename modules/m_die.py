@@ -2,7 +2,7 @@
 /die command
 """
 
-from handle.core import IRCD, Command, Numeric, Flag
+from handle.core import IRCD, Command, Numeric, Flag, DataStore
 
 
 def cmd_die(client, recv):
@@ -28,6 +28,7 @@ def cmd_die(client, recv):
         user.exit("Server is shutting down")
 
     IRCD.running = 0
+    DataStore.flush()
     exit()
 
 
@@ -7,9 +7,6 @@ from handle.logger import logging
 
 
 def cmd_eos(client, recv):
-    if IRCD.current_link_sync in [client, client.uplink, client.direction]:
-        IRCD.current_link_sync = None
-        # logging.debug(f"current_link_sync for {client.name} unset.")
     if client.server.synced:
         return
 
@@ -24,17 +21,6 @@ def cmd_eos(client, recv):
     #     server_client.add_flag(Flag.CLIENT_REGISTERED)
     #     IRCD.run_hook(Hook.SERVER_SYNCED, server_client)
 
-    """ We can now process other servers' recv buffer """
-    IRCD.do_delayed_process()
-
-    """ Send held back data for this client """
-    if client in IRCD.send_after_eos:
-        logging.debug(f"Now sending previously held back server data to {client.name}")
-        for mtags, data in IRCD.send_after_eos[client]:
-            # logging.debug(f"Delayed data: {data.rstrip()}")
-            IRCD.send_to_one_server(client, mtags, data)
-        del IRCD.send_after_eos[client]
-
     for batch in Batch.pool:
         started_by = client if client.local else client.uplink
         if batch.started_by in [started_by, started_by.direction] and batch.batch_type == "netjoin":
@@ -30,7 +30,7 @@ def do_kick(client, channel, target_client, reason):
     if (client.user and client.local and client.registered) or (not client.local and client.uplink.server.synced) and not client.ulined:
         event = "LOCAL_KICK" if client.local else "REMOTE_KICK"
         msg = f"*** {client.name} ({client.user.username}@{client.user.realhost}) has kicked {target_client.name} off channel {channel.name}: {reason}"
-        IRCD.log(client, "info", "kick", event, msg, sync=0)
+        IRCD.log(client, "info", "kick", event, msg, sync=0, channel=channel.name, target=target_client.name, reason=reason)
 
 
 def cmd_kick(client, recv):
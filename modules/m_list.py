@@ -2,12 +2,131 @@
 /list command
 """
 
+import re
+from bisect import bisect_left, insort
+from functools import partial
 from time import time
 
-from handle.core import IRCD, Command, Isupport, Numeric
-from handle.functions import is_match
+from handle.core import IRCD, Command, Isupport, Numeric, Hook, Channel, ReplyStream
+from handle.functions import glob_to_regex
 
-LIST_PROCESS = []
+LIST_PROCESS = set()
+
+
+class ChannelNames:
+    """
+    Sorted lowercase channel names, so a LIST mask with a literal prefix
+    only looks at the channels that start with that prefix.
+    """
+
+    names = []
+    by_name = {}
+
+    @staticmethod
+    def add(channel):
+        name = channel.name.lower()
+        if name not in ChannelNames.by_name:
+            insort(ChannelNames.names, name)
+        ChannelNames.by_name[name] = channel
+
+    @staticmethod
+    def remove(name: str):
+        if ChannelNames.by_name.pop(name, None):
+            del ChannelNames.names[bisect_left(ChannelNames.names, name)]
+
+    @staticmethod
+    def with_prefix(prefix: str):
+        names = ChannelNames.names
+        pos = end = bisect_left(names, prefix)
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        # Copy the range, so channels can be created or destroyed while the reply is paused.
+        return [ChannelNames.by_name[name] for name in names[pos:end]]
+
+
+def list_channel_create(client, channel):
+    ChannelNames.add(channel)
+
+
+def list_channel_destroy(client, channel):
+    # Permanent channels are kept when they become empty.
+    if 'P' not in channel.modes:
+        ChannelNames.remove(channel.name.lower())
+
+
+def list_channel_rename(client, channel, old_name):
+    ChannelNames.remove(old_name.lower())
+    ChannelNames.add(channel)
+
+
+class ListQuery:
+    def __init__(self, options: list):
+        self.minusers = self.maxusers = None
+        self.created_after = self.created_before = self.topic_after = self.topic_before = None
+        self.mask = None
+        self.negate = 0
+        self.prefix = ''
+
+        for opt in options:
+            if opt[:1] in "><" and opt[1:].isdigit():
+                setattr(self, "minusers" if opt[0] == '>' else "maxusers", int(opt[1:]))
+            elif opt[:2] in ["C>", "C<", "T>", "T<"] and opt[2:].isdigit():
+                attribute = {"C>": "created_after", "C<": "created_before", "T>": "topic_after", "T<": "topic_before"}[opt[:2]]
+                setattr(self, attribute, int(opt[2:]))
+            elif opt and (opt[0] in "*?!" or opt[0] in IRCD.CHANPREFIXES):
+                self.negate = opt[0] == '!'
+                mask = opt.lower().removeprefix('!')
+                self.mask = re.compile(glob_to_regex(mask))
+                if not self.negate:
+                    self.prefix = re.split(r"[*?]", mask, maxsplit=1)[0]
+
+    def candidates(self):
+        """ Returns the channels to check, from the most selective index that applies. """
+        if self.prefix:
+            return ChannelNames.with_prefix(self.prefix)
+        if self.minusers is not None or self.maxusers is not None:
+            sizes = [size for size in Channel.by_membercount
+                     if (self.minusers is None or size > self.minusers) and (self.maxusers is None or size < self.maxusers)]
+            return [channel for size in sorted(sizes, reverse=True) for channel in Channel.by_membercount[size]]
+        return list(IRCD.get_channels())
+
+    def matches(self, channel, now: int) -> int:
+        if (self.maxusers is not None and channel.membercount >= self.maxusers) or (self.minusers is not None and channel.membercount <= self.minusers):
+            return 0
+
+        # ELIST C and T conditions are in minutes.
+        created_minutes = (now - channel.creationtime) // 60
+        if (self.created_before is not None and created_minutes > self.created_before) or (self.created_after is not None and created_minutes < self.created_after):
+            return 0
+        if channel.topic_time:
+            topic_minutes = (now - channel.topic_time) // 60
+            if (self.topic_before is not None and topic_minutes > self.topic_before) or (self.topic_after is not None and topic_minutes < self.topic_after):
+                return 0
+
+        if self.mask and bool(self.mask.fullmatch(channel.name.lower())) == self.negate:
+            return 0
+        return 1
+
+
+def list_replies(client, query):
+    """ Generator for ReplyStream: sends one reply per iteration. """
+    now = int(time())
+    for channel in query.candidates():
+        if ChannelNames.by_name.get(channel.name.lower()) is not channel or not query.matches(channel, now):
+            continue
+
+        if ('s' in channel.modes or 'p' in channel.modes) and (not channel.find_member(client) and 'o' not in client.user.modes):
+            if 'p' in channel.modes:
+                client.sendnumeric(Numeric.RPL_LIST, '*', channel.membercount, '', '')
+                yield
+            continue
+
+        client.add_flood_penalty(100)
+        list_modes = f"[+{channel.modes}]" if channel.modes else ''
+        client.sendnumeric(Numeric.RPL_LIST, channel.name, channel.membercount, list_modes, channel.topic)
+        yield
+
+    client.sendnumeric(Numeric.RPL_LISTEND)
 
 
 def cmd_list(client, recv):
@@ -21,59 +140,29 @@ def cmd_list(client, recv):
     A few examples:
     LIST >100               Will only show channels with more than 100 users.
     -                       Use < to negate this condition.
-    LIST C<`timestamp`      Show channels that have been created before `timestamp`.
-    -                       Note that `timestamp` must be a UNIX timestamp.
-    LIST T<`timestamp`      Show channels that had their topic set before `timestamp`.
+    LIST C<`minutes`        Show channels that have been created less than `minutes` ago.
+    LIST T<`minutes`        Show channels that had their topic set less than `minutes` ago.
+    LIST #prefix*           Show channels matching a mask. Use !mask to exclude them instead.
     """
 
     if client in LIST_PROCESS:
         return IRCD.server_notice(client, "*** A /LIST command is already in progress, please wait.")
 
-    LIST_PROCESS.append(client)
+    LIST_PROCESS.add(client)
     client.add_flood_penalty(10_000)
     client.sendnumeric(Numeric.RPL_LISTSTART)
 
-    options = recv[1].split(',') if len(recv) >= 2 else []
-    minusers = next((opt[1:] for opt in options if opt.startswith(">") and opt[1:].isdigit()), None)
-    maxusers = next((opt[1:] for opt in options if opt.startswith("<") and opt[1:].isdigit()), None)
-    created_after = next((opt[2:] for opt in options if opt.startswith("C>")), None)
-    created_before = next((opt[2:] for opt in options if opt.startswith("C<")), None)
-    topic_after = next((opt[2:] for opt in options if opt.startswith("T>")), None)
-    topic_before = next((opt[2:] for opt in options if opt.startswith("T<")), None)
-    searchmask = next((opt for opt in options if opt[0] in "*!"), None)
-
-    for channel in IRCD.get_channels():
-        channel_open_minutes = int(time()) - channel.creationtime
-        topic_minutes = int(time()) - channel.topic_time if channel.topic_time else None
-
-        if ((maxusers and channel.membercount >= int(maxusers)) or
-                (minusers and channel.membercount <= int(minusers)) or
-                (created_before and channel_open_minutes > int(created_before)) or
-                (created_after and channel_open_minutes < int(created_after)) or
-                (topic_before and topic_minutes and topic_minutes > int(topic_before)) or
-                (topic_after and topic_minutes and topic_minutes < int(topic_after))):
-            continue
-
-        if searchmask:
-            searchmask = searchmask.lower().lstrip('!')
-            if (searchmask[0] == '!' and is_match(searchmask, channel.name.lower())) or (
-                    searchmask[0] != '!' and not is_match(searchmask, channel.name.lower())):
-                continue
-
-        if ('s' in channel.modes or 'p' in channel.modes) and (not channel.find_member(client) and 'o' not in client.user.modes):
-            if 'p' in channel.modes:
-                client.sendnumeric(Numeric.RPL_LIST, '*', len(channel.users))
-            continue
-
-        client.add_flood_penalty(100)
-        list_modes = f"[+{channel.modes}]" if channel.modes else ''
-        client.sendnumeric(Numeric.RPL_LIST, channel.name, channel.membercount, list_modes, channel.topic)
-
-    client.sendnumeric(Numeric.RPL_LISTEND)
-    LIST_PROCESS.remove(client)
+    query = ListQuery(recv[1].split(',') if len(recv) >= 2 else [])
+    # Replies are sent from the main loop, paced by the sendq of the client.
+    ReplyStream.start(client, list_replies(client, query), on_close=partial(LIST_PROCESS.discard, client))
 
 
 def init(module):
+    for channel in IRCD.get_channels():
+        ChannelNames.add(channel)
+    Hook.add(Hook.CHANNEL_CREATE, list_channel_create)
+    Hook.add(Hook.CHANNEL_DESTROY, list_channel_destroy)
+    Hook.add(Hook.CHANNEL_RENAME, list_channel_rename)
     Command.add(module, cmd_list, "LIST")
     Isupport.add("SAFELIST")
     Isupport.add("ELIST", "CMNTU")
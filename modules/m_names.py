@@ -2,7 +2,74 @@
 /names command
 """
 
-from handle.core import Numeric, Command, IRCD, Capability, Isupport
+from handle.core import Numeric, Command, IRCD, Capability, Isupport, Hook
+
+NAMES_PER_LINE = 24
+
+
+class NamesCache:
+    """
+    Cached NAMES fragments ("@+nick!user@host") per channel and capability profile.
+
+    The member list of a profile is rebuilt when Channel.names_version changes.
+    Fragments of individual members are kept as long as their nick, host and prefixes stay the same,
+    so a join into a big channel only formats the new member.
+    Visibility is checked per request, on top of the cached fragments.
+    """
+
+    channels = {}
+
+    def __init__(self):
+        self.version = -1
+        # Profile -> [(client, fragment), ...] in member order.
+        self.entries = {}
+        # Profile -> complete reply lines, used when every member is visible.
+        self.lines = {}
+        # Client -> ((identity_version, member modes), {profile: fragment})
+        self.fragments = {}
+
+    @staticmethod
+    def get(channel):
+        if not (cache := NamesCache.channels.get(channel)):
+            cache = NamesCache.channels[channel] = NamesCache()
+        if cache.version != channel.names_version:
+            cache.version = channel.names_version
+            cache.entries, cache.lines = {}, {}
+        return cache
+
+    def fragment(self, channel, names_client, member, profile) -> str:
+        stamp = names_client.identity_version, member.modes
+        if (cached := self.fragments.get(names_client)) is None or cached[0] != stamp:
+            cached = self.fragments[names_client] = stamp, {}
+        if (fragment := cached[1].get(profile)) is None:
+            multi_prefix, userhost = profile
+            prefix = channel.get_prefix_sorted_str(names_client)
+            if not multi_prefix:
+                prefix = prefix[:1]
+            fragment = prefix + names_client.name
+            if userhost:
+                fragment += f"!{names_client.user.username}@{names_client.user.cloakhost}"
+            cached[1][profile] = fragment
+        return fragment
+
+    def members(self, channel, profile) -> list:
+        if (entries := self.entries.get(profile)) is None:
+            self.fragments = {c: f for c, f in self.fragments.items() if c in channel.member_by_client}
+            entries = self.entries[profile] = [(c, self.fragment(channel, c, member, profile)) for c, member in channel.member_by_client.items()]
+        return entries
+
+    def all_lines(self, profile) -> list:
+        if (lines := self.lines.get(profile)) is None:
+            lines = self.lines[profile] = make_lines([fragment for _, fragment in self.entries[profile]])
+        return lines
+
+
+def make_lines(fragments: list) -> list:
+    return [' '.join(fragments[i:i + NAMES_PER_LINE]) for i in range(0, len(fragments), NAMES_PER_LINE)]
+
+
+def names_channel_destroy(client, channel):
+    NamesCache.channels.pop(channel, None)
 
 
 def cmd_names(client, recv):
@@ -12,35 +79,21 @@ def cmd_names(client, recv):
     if 's' in channel.modes and (not channel.find_member(client) and not client.has_permission("channel:see:names:secret")):
         return client.sendnumeric(Numeric.RPL_ENDOFNAMES, recv[1])
 
-    users = []
-    for names_client in channel.member_by_client:
-        if 'i' in names_client.user.modes and (not channel.find_member(client) and not client.has_permission("channel:see:names:invisible")):
-            continue
+    profile = bool(client.has_capability("multi-prefix")), bool(client.has_capability("userhost-in-names"))
+    cache = NamesCache.get(channel)
+    entries = cache.members(channel, profile)
 
-        if not channel.user_can_see_member(client, names_client):
-            continue
+    see_invisible = channel.find_member(client) or client.has_permission("channel:see:names:invisible")
+    visible = [(c, fragment) for c, fragment in entries
+               if ('i' not in c.user.modes or see_invisible) and channel.user_can_see_member(client, c)]
 
-        if names_client not in channel.seen_dict[client]:
-            channel.seen_dict[client].append(names_client)
+    if (seen := channel.seen_dict.get(client)) is not None:
+        seen_set = set(seen)
+        seen.extend(c for c, _ in visible if c not in seen_set)
 
-        prefix = channel.get_prefix_sorted_str(names_client)
-        if not client.has_capability("multi-prefix") and prefix:
-            prefix = prefix[0]
-
-        string = prefix + names_client.name
-
-        if client.has_capability("userhost-in-names"):
-            string += f"!{names_client.user.username}@{names_client.user.cloakhost}"
-
-        users.append(string)
-
-        if len(users) >= 24:
-            client.sendnumeric(Numeric.RPL_NAMEREPLY, channel.name, ' '.join(users))
-            users = []
-            continue
-
-    if users:
-        client.sendnumeric(Numeric.RPL_NAMEREPLY, channel.name, ' '.join(users))
+    lines = cache.all_lines(profile) if len(visible) == len(entries) else make_lines([fragment for _, fragment in visible])
+    for line in lines:
+        client.sendnumeric(Numeric.RPL_NAMEREPLY, channel.name, line)
 
     client.sendnumeric(Numeric.RPL_ENDOFNAMES, channel.name)
 
@@ -49,5 +102,6 @@ def init(module):
     Capability.add("userhost-in-names")
     Capability.add("multi-prefix")
     Command.add(module, cmd_names, "NAMES", 1)
+    Hook.add(Hook.CHANNEL_DESTROY, names_channel_destroy)
     Isupport.add("NAMESX")
     Isupport.add("UHNAMES")
@@ -87,13 +87,14 @@ def cmd_nick_local(client, recv):
         Nick.flood[client][time.time()] = True
         if client.local and Flag.CLIENT_USER_SANICK not in client.flags:
             msg = f"*** {client.name} ({client.user.username}@{client.user.realhost}) has changed their nickname to {newnick}"
-            IRCD.log(client, "info", "nick", "LOCAL_NICK_CHANGE", msg, sync=0)
+            IRCD.log(client, "info", "nick", "LOCAL_NICK_CHANGE", msg, sync=0, newnick=newnick)
 
         IRCD.new_message(client)
         broadcast_nickchange(client, newnick)
         IRCD.run_hook(Hook.LOCAL_NICKCHANGE, client, newnick)
 
     client.name = newnick
+    client.identity_changed()
 
 
 def cmd_nick(client, recv):
@@ -118,8 +119,9 @@ def cmd_nick_remote(client, recv):
     IRCD.run_hook(Hook.REMOTE_NICKCHANGE, client, newnick)
     broadcast_nickchange(client, newnick)
     msg = f"*** {client.name} ({client.user.username}@{client.user.realhost}) has changed their nickname to {newnick}"
-    IRCD.log(client, "info", "nick", "REMOTE_NICK_CHANGE", msg)
+    IRCD.log(client, "info", "nick", "REMOTE_NICK_CHANGE", msg, newnick=newnick)
     client.name = newnick
+    client.identity_changed()
 
 
 def create_user_from_uid(client, info: list):
@@ -129,7 +131,7 @@ def create_user_from_uid(client, info: list):
     signon = info[3]
     if not signon.isdigit():
         return Error.USER_UID_SIGNON_NO_DIGIT
-    if existing := IRCD.find_user(info[6]):
+    if IRCD.find_uid(info[6]):
         return Error.USER_UID_ALREADY_IN_USE
 
     new_client = make_client(direction=client.direction, uplink=client)
@@ -139,6 +141,8 @@ def create_user_from_uid(client, info: list):
     new_client.user.username = info[4]
     new_client.user.realhost = info[5]
     new_client.id = info[6]
+    IRCD.uid_table[new_client.id] = new_client
+    IRCD.server_users.setdefault(client, {})[new_client] = None
     # logging.debug(F"Remote client {new_client.name} UID set: {new_client.id}")
 
     new_client.user.account = info[7]
@@ -74,6 +74,7 @@ def do_oper_up(client, oper):
 
     client.user.operlogin = oper.name
     client.user.operclass = oper.operclass
+    client.identity_changed()
     client.user.oper = oper
     client.backbuffer = []
 
@@ -95,7 +96,7 @@ def do_oper_up(client, oper):
                 IRCD.send_to_servers(client, [], data)
 
     msg = f"*** {client.name} ({client.user.username}@{client.user.realhost}) [block: {client.user.operlogin}, operclass: {client.user.operclass.name}] is now an IRC Operator"
-    IRCD.log(client, "info", "oper", "OPER_UP", msg)
+    IRCD.log(client, "info", "oper", "OPER_UP", msg, operlogin=client.user.operlogin, operclass=client.user.operclass.name)
 
     if client.user.snomask:
         client.sendnumeric(Numeric.RPL_SNOMASK, client.user.snomask)
@@ -121,7 +122,7 @@ def oper_fail(client, opername, reason):
     client.local.flood_penalty += 350_000
     client.sendnumeric(Numeric.ERR_NOOPERHOST)
     msg = f"Failed oper attempt by {client.name} [{opername}] ({client.user.username}@{client.user.realhost}): {reason}"
-    IRCD.log(client, "warn", "oper", "OPER_FAILED", msg)
+    IRCD.log(client, "warn", "oper", "OPER_FAILED", msg, operlogin=opername, reason=reason)
 
 
 def cmd_oper(client, recv):
@@ -167,6 +168,7 @@ def watch_deoper(client, target, current_modes, new_modes, param):
         IRCD.send_to_local_common_chans(client, [], client_cap="oper-notify", data=data)
         restore_class(target)
         target.user.operclass = None
+        target.identity_changed()
         target.user.operlogin = None
         target.user.oper = None
 
@@ -19,7 +19,6 @@ def cmd_rehash(client, recv):
         return
 
     IRCD.rehashing = 1
-    IRCD.current_link_sync = None
     if client.is_local_user:
         client.local.flood_penalty += 500_000
     if client.user:
@@ -117,6 +117,7 @@ def cmd_svslogin(client, recv):
         curr_account = auth_client.user.account
         auth_client.user.account = account
         if account != curr_account:
+            auth_client.identity_changed()
             IRCD.run_hook(Hook.ACCOUNT_LOGIN, auth_client)
 
     data = f":{client.id} {' '.join(recv)}"
@@ -6,96 +6,104 @@ import time
 
 from handle.core import IRCD, Command, Flag, Isupport, Extban, Batch, Hook
 from handle.logger import logging
-import re
 
 
-def get_users_from_memberlist(memberlist: list) -> list:
-    users = []
-    user_prefixes = [m.sjoin_prefix for m in IRCD.channel_modes() if m.type == m.MEMBER]
-    list_prefixes = [m.sjoin_prefix for m in IRCD.channel_modes() if m.type == m.LISTMODE]
+def parse_memberlist(remote_server, memberlist: list) -> (list, list):
+    """
+    Parses the memberlist of an SJOIN in a single pass.
+    Returns [(user, membermodes), ...] and [(listmode, timestamp, setter, mask), ...].
+    """
+    member_prefixes = {m.sjoin_prefix: m.flag for m in IRCD.channel_modes() if m.sjoin_prefix and m.type == m.MEMBER}
+    list_prefixes = {m.sjoin_prefix: m.flag for m in IRCD.channel_modes() if m.sjoin_prefix and m.type == m.LISTMODE}
+    members, list_entries = [], []
+
     for entry in memberlist:
+        if not entry:
+            continue
+        timestamp, setter = int(time.time()), remote_server.name
         if entry[0] == '<':
-            if not (match := re.match(r"<(.*),(.*)>(.*)", entry)):
-                continue
-            entry = match.groups()[2]
-        user_uid = ''
-        for char in entry:
-            if char in list_prefixes:
-                # Not interested in those.
-                break
-            if char in user_prefixes:
-                # Skip prefixes.
+            # SJSBY: <timestamp,setter>entry
+            sjsby, found, rest = entry[1:].partition('>')
+            sjsby_time, _, sjsby_setter = sjsby.partition(',')
+            if not found or not sjsby_time.isdigit() or not sjsby_setter or not rest:
+                logging.error(f"Malformed SJSBY format received: {entry} -- skipping entry.")
+                IRCD.send_snomask(remote_server, 's', f"ERROR: Malformed SJSBY format received: {entry} -- some channel modes may not have been synced correctly!")
                 continue
-            user_uid += char
-        if user_uid and (user := IRCD.find_user(user_uid)):
-            users.append(user)
-    return users
-
+            timestamp, setter, entry = int(sjsby_time), sjsby_setter, rest
 
-def get_usermodes_from_memberlist(remote_server, memberlist: list) -> list:
-    usermodes = []
-    known_user_prefixes = [m.sjoin_prefix for m in IRCD.channel_modes() if m.sjoin_prefix and m.type == m.MEMBER]
-    for entry in memberlist:
-        try:
-            if entry[0] == '<':
-                continue
-        except IndexError:
-            logging.error(f"[get_usermodes_from_memberlist()] IndexError on entry: {entry}")
+        if entry[0] in list_prefixes:
+            mask = entry[1:]
+            if mask.startswith(Extban.symbol):
+                mask = Extban.convert_param(mask, convert_to_name=1)
+            list_entries.append((list_prefixes[entry[0]], timestamp, setter, mask))
             continue
-        modes = ''
-        user_uid = ''
-        for char in entry:
-            if char in known_user_prefixes:
-                if cmode := next((cm for cm in IRCD.channel_modes() if cm.sjoin_prefix == char), 0):
-                    modes += cmode.flag
-                continue
-            else:
-                user_uid += char
 
-        if user_uid:
-            if not (user := IRCD.find_user(user_uid)):
-                continue
-            if user.name == '*':
-                # How the fuck...?
-                logging.error(f"Found remote user without nickname. UID command without nickname received?")
-                continue
-            usermodes.append((user, modes))
-    return usermodes
+        pos = 0
+        while pos < len(entry) and entry[pos] in member_prefixes:
+            pos += 1
+        if not (user := IRCD.find_user(entry[pos:])):
+            continue
+        if user.name == '*':
+            logging.error(f"Found remote user without nickname. UID command without nickname received?")
+            continue
+        members.append((user, ''.join(member_prefixes[char] for char in entry[:pos])))
 
+    return members, list_entries
 
-def get_listmodes_from_memberlist(remote_server, memberlist: list) -> (list, list):
-    known_list_prefixes = [m.sjoin_prefix for m in IRCD.channel_modes() if m.sjoin_prefix and m.type == m.LISTMODE]
-    listmodes_modebuf = []
-    listmodes_parambuf = []
-    timestamp = int(time.time())
-    setter = remote_server.name
 
-    for entry in memberlist:
-        if entry[0] == '<':
-            if not (match := re.match(r"<(.*),(.*)>(.*)", entry)):
-                logging.error(f"Malformed SJSBY format received: {entry} -- skipping entry.")
-                IRCD.send_snomask(remote_server, 's', f"ERROR: Malformed SJSBY format received: {entry} -- some channel modes may not have been synced correctly!")
-                continue
-            timestamp, setter, entry = match.groups()
-        for char in entry:
-            if char in known_list_prefixes:
-                if cmode := next((cm for cm in IRCD.channel_modes() if cm.sjoin_prefix == char), 0):
-                    listmodes_modebuf.append(cmode.flag)
-                    listmodes_parambuf.append((timestamp, setter, entry[1:]))
-    return listmodes_modebuf, listmodes_parambuf
-
-
-def do_normal_join(server_client, channel_object, memberlist: list) -> None:
-    """ Join all remote members from memberlist to local channel. """
-    for user in [c for c in get_users_from_memberlist(memberlist)]:  # if not channel_object.find_member(c)]:
+def do_bulk_join(server_client, channel_object, members: list, modebuf: list = None, parambuf: list = None) -> None:
+    """
+    Join all remote `members` to local channel at once.
+    Member modes are only given when `modebuf` is passed, and are added to `modebuf` and `parambuf`.
+    """
+    joined = []
+    for user, modes in members:
+        if not channel_object.create_member(user):
+            logging.debug(f"[do_bulk_join()] Attempted to join {user.name} to {channel_object.name} but it already exists.")
+            continue
+        channel_object.set_membercount(channel_object.membercount + 1)
+        if invite := channel_object.get_invite(user):
+            channel_object.del_invite(invite)
+        if modebuf is not None and modes:
+            channel_object.member_give_modes(user, modes)
+            modebuf.extend(modes)
+            parambuf.extend([user.name] * len(modes))
+        joined.append(user)
+
+    if not joined:
+        return
+
+    synced = server_client.server.synced
+    local_members = [c for c in channel_object.member_by_client if c.local]
+    for user in joined:
         IRCD.new_message(user)
-        mtags = server_client.recv_mtags if server_client.server.synced else user.mtags
         # Remove msgid tag because it won't be the same across the network.
-        if not server_client.server.synced:
-            mtags = [t for t in mtags if t.name != "msgid"]
-        channel_object.do_join(mtags, user)
+        mtags = server_client.recv_mtags if synced else [t for t in user.mtags if t.name != "msgid"]
+        for member_client in local_members:
+            if channel_object.user_can_see_member(member_client, user):
+                channel_object.show_join_message(mtags, member_client, user)
+
+        if user.uplink.server.synced and not user.ulined:
+            msg = f"*** {user.name} ({user.user.username}@{user.user.realhost}) has joined channel {channel_object.name}"
+            IRCD.log(user, "info", "join", "REMOTE_JOIN", msg, sync=0, channel=channel_object.name)
         user.mtags = []
 
+    if channel_object.name[0] == '&' or not IRCD.local_servers():
+        return
+
+    # Pass the new members on to the other servers, as many per SJOIN line as fit.
+    mtags = server_client.recv_mtags if synced else []
+    prefix = f":{server_client.id} SJOIN {channel_object.creationtime} {channel_object.name} :"
+    line, count = prefix, 0
+    for user in joined:
+        entry = channel_object.get_sjoin_prefix_sorted_str(user) + user.id
+        if count and len(line) + len(entry) + 1 > 510:
+            IRCD.send_to_servers(server_client, mtags, line)
+            line, count = prefix, 0
+        line += (' ' if count else '') + entry
+        count += 1
+    IRCD.send_to_servers(server_client, mtags, line)
+
 
 def send_modelines(server, channel_object, modebuf: list, parambuf: list, action: str) -> None:
     maxmodes = Isupport.get("MODES").value if Isupport.get("MODES") else 8
@@ -185,32 +193,16 @@ def handle_modes(channel_object, remote_modes: str, remote_params: list, action:
     return modebuf, parambuf
 
 
-def set_remote_modes(remote_server, channel_object, remote_modes: str, remote_params: list, memberlist: list) -> None:
+def set_remote_modes(remote_server, channel_object, remote_modes: str, remote_params: list, members: list, list_entries: list) -> None:
     remote_modes = remote_modes.replace('+', '')
     modebuf_give, parambuf_give = handle_modes(channel_object, remote_modes, remote_params, action='+')
     channel_object.modes = remote_modes
 
-    # +vhoaq etc.
-    usermodes = get_usermodes_from_memberlist(remote_server, memberlist)
-    for entry in usermodes:
-        client, modes = entry
-        if channel_object.create_member(client):
-            channel_object.member_give_modes(client, modes)
-            for mode in modes:
-                modebuf_give.append(mode)
-                parambuf_give.append(client.name)
-        else:
-            logging.error(f"[set_remote_modes()] Attempted to join {client.name} to {channel_object.name} but it already exists.")
-
-    # Join remote users to channel.
-    do_normal_join(remote_server, channel_object, memberlist)
+    # Join remote users to channel, with their +vhoaq etc.
+    do_bulk_join(remote_server, channel_object, members, modebuf_give, parambuf_give)
 
     # Now merge/update listmodes.
-    listmodes_modebuf, listmodes_parambuf = get_listmodes_from_memberlist(remote_server, memberlist)
-    for listmode, listparam in zip(listmodes_modebuf, listmodes_parambuf):
-        timestamp, setter, mask = listparam
-        if mask.startswith(Extban.symbol):
-            mask = Extban.convert_param(mask, convert_to_name=1)
+    for listmode, timestamp, setter, mask in list_entries:
         channel_object.add_to_list(remote_server, mask=mask, _list=channel_object.List[listmode], setter=setter, timestamp=timestamp)
         modebuf_give.append(listmode)
         parambuf_give.append(mask)
@@ -218,7 +210,7 @@ def set_remote_modes(remote_server, channel_object, remote_modes: str, remote_pa
     send_modelines(remote_server, channel_object, modebuf_give, parambuf_give, action='+')
 
 
-def remote_wins(remote_server, channel_object, remote_modes: str, remote_params: list, memberlist: list, remote_channel_creation: int) -> None:
+def remote_wins(remote_server, channel_object, remote_modes: str, remote_params: list, members: list, list_entries: list, remote_channel_creation: int) -> None:
     common_modes = set(channel_object.modes) & set(remote_modes)
     modebuf_remove, parambuf_remove = handle_modes(channel_object, channel_object.modes, remote_params, action='-', common_modes=common_modes)
 
@@ -241,34 +233,21 @@ def remote_wins(remote_server, channel_object, remote_modes: str, remote_params:
     send_modelines(remote_server, channel_object, modebuf_remove, parambuf_remove, action='-')
 
     # Now give remote modes to local channel.
-    set_remote_modes(remote_server, channel_object, remote_modes, remote_params, memberlist)
+    set_remote_modes(remote_server, channel_object, remote_modes, remote_params, members, list_entries)
 
 
-def merge_modes(remote_server, channel_object, remote_modes: str, remote_params: list, memberlist: list) -> None:
+def merge_modes(remote_server, channel_object, remote_modes: str, remote_params: list, members: list, list_entries: list) -> None:
     merge_modebuf, merge_parambuf = handle_modes(channel_object, remote_modes, remote_params, action='+')
 
-    # +vhoaq etc.
-    for client, modes in get_usermodes_from_memberlist(remote_server, memberlist):
-        if channel_object.create_member(client):
-            channel_object.member_give_modes(client, modes)
-            for mode in modes:
-                merge_modebuf += mode
-                merge_parambuf.append(client.name)
-        else:
-            logging.error(f"[merge_modes()] Attempted to join {client.name} to {channel_object.name} but it already exists.")
-
-    # Join remote users to channel.
-    do_normal_join(remote_server, channel_object, memberlist)
+    # Join remote users to channel, with their +vhoaq etc.
+    do_bulk_join(remote_server, channel_object, members, merge_modebuf, merge_parambuf)
 
     # Merge/update listmodes.
-    listmodes_modebuf, listmodes_parambuf = get_listmodes_from_memberlist(remote_server, memberlist)
-    for listmode, listparam in zip(listmodes_modebuf, listmodes_parambuf):
-        timestamp, setter, mask = listparam
-        timestamp = int(timestamp)
+    for listmode, timestamp, setter, mask in list_entries:
         found = next((e for e in channel_object.List[listmode] if e.mask == mask), None)
         if found:
             if found.set_time > timestamp:
-                found.set_time, found.setter = timestamp, setter
+                found.set_time, found.set_by = timestamp, setter
         else:
             channel_object.add_to_list(remote_server, mask, channel_object.List[listmode], setter, timestamp)
             merge_modebuf += listmode
@@ -313,6 +292,8 @@ def cmd_sjoin(client, recv: list) -> None:
             channel_modes_params.append(param)
         idx += 1
 
+    members, list_entries = parse_memberlist(client, memberlist)
+
     # Start our netjoin batch, if one doesn't already exist.
     if not client.server.synced and not Batch.find_batch_by(client.direction):
         Batch.create_new(started_by=client.direction, batch_type="netjoin", additional_data=client.name + ' ' + client.uplink.name)
@@ -326,18 +307,18 @@ def cmd_sjoin(client, recv: list) -> None:
         # Remote channel is dominant. Replacing modes with remote channel. Clear the local modes.
         # logging.debug(f"Remote channel {channel_name} is dominant, clearing local channel modes and setting theirs.")
         channel_object.name = channel_name
-        remote_wins(client, channel_object, channel_modes, channel_modes_params, memberlist, remote_channel_creation)
+        remote_wins(client, channel_object, channel_modes, channel_modes_params, members, list_entries, remote_channel_creation)
 
     elif remote_channel_creation > channel_object.creationtime:
         # Do nothing, our channel state will remain untouched.
         # logging.debug(f"Local channel {channel_name} is dominant. Not processing remote modes. Joining users.")
-        do_normal_join(client, channel_object, memberlist)
+        do_bulk_join(client, channel_object, members)
 
     elif remote_channel_creation == channel_object.creationtime:
         if not client.server.synced:
             """ Don't spam this debug message on every remote join. """
             logging.debug(f"Equal timestamps for remote channel {channel_object.name} -- merging modes.")
-        merge_modes(client, channel_object, channel_modes, channel_modes_params, memberlist)
+        merge_modes(client, channel_object, channel_modes, channel_modes_params, members, list_entries)
 
     if not client.registered:
         IRCD.run_hook(Hook.SERVER_SJOIN_IN, client, recv)
@@ -3,11 +3,18 @@ provides spamfilter capabilities
 """
 
 import logging
+import multiprocessing
 import re
-from time import time
+from collections import deque
+from time import time, perf_counter
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
 
 from handle.core import IRCD, Command, Numeric, Flag, Hook, Tkl, Stat
-from handle.functions import valid_expire, is_match
+from handle.functions import valid_expire, is_match, compile_globs
 from handle.validate_conf import Spamfilter
 
 
@@ -18,9 +25,336 @@ def is_valid_regex(pattern):
         return 0
 
 
+def regex_cost(pattern: str) -> str:
+    """
+    Static analysis of a regex pattern.
+    Returns the reason why it may backtrack catastrophically, or an empty string if it looks safe.
+    """
+
+    try:
+        tree = sre_parse.parse(pattern)
+    except Exception:
+        return ''
+
+    def walk(items, in_repeat):
+        for op, av in items:
+            match str(op):
+                case "MAX_REPEAT" | "MIN_REPEAT":
+                    low, high, sub = av
+                    unbounded = high > 100
+                    if unbounded and in_repeat:
+                        return "nested quantifier"
+                    if unbounded and any(str(sub_op) == "BRANCH" for sub_op, _ in walk_groups(sub)):
+                        return "quantified alternation"
+                    if reason := walk(sub, in_repeat or high > 1):
+                        return reason
+                case "SUBPATTERN":
+                    if reason := walk(av[-1], in_repeat):
+                        return reason
+                case "BRANCH":
+                    for branch in av[1]:
+                        if reason := walk(branch, in_repeat):
+                            return reason
+                case "ASSERT" | "ASSERT_NOT":
+                    if reason := walk(av[1], in_repeat):
+                        return reason
+                case "GROUPREF" | "GROUPREF_EXISTS":
+                    return "backreference"
+        return ''
+
+    def walk_groups(items):
+        """ Yields items, looking through (non-)capturing groups. """
+        for op, av in items:
+            if str(op) == "SUBPATTERN":
+                yield from walk_groups(av[-1])
+            else:
+                yield op, av
+
+    return walk(tree, in_repeat=0)
+
+
+def regex_search(pattern: str, text: str) -> int:
+    """ Runs inside a RegexGuard worker process. """
+    return 1 if re.search(pattern, text) else 0
+
+
+class RegexGuard:
+    """
+    Evaluates risky regex spamfilters in a worker process with a time budget,
+    so that a pattern with catastrophic backtracking cannot freeze the main loop.
+    All guarded rules of one message share a single budget, rules that do not fit in it are skipped.
+    A worker that exceeds the budget cannot be interrupted, so the pool is replaced in the background,
+    and guarded rules are skipped until the new worker is up.
+    Workers are spawned as fresh interpreters, so they inherit no sockets, threads or locks from the server.
+    The pool is kept in IRCD.regex_pool, so reloading this module does not start another one.
+    """
+    starting = 0
+    # Guarded evaluations that were skipped, because the budget was used up or no worker was available.
+    skipped = 0
+
+    @staticmethod
+    def budget() -> float:
+        """ Time budget in seconds per message, from the `spamfilter-regex-timeout` setting in milliseconds. """
+        return int(IRCD.get_setting("spamfilter-regex-timeout") or 100) / 1000
+
+    @staticmethod
+    def start():
+        if IRCD.regex_pool or RegexGuard.starting:
+            return
+        RegexGuard.starting = 1
+        try:
+            pool = multiprocessing.get_context("spawn").Pool(processes=1)
+            # Make sure the worker is up, so its startup time is not counted against the first evaluation.
+            pool.apply(regex_search, ('', ''))
+            IRCD.regex_pool = pool
+        finally:
+            RegexGuard.starting = 0
+
+    @staticmethod
+    def replace(old_pool):
+        """ Runs in a pool thread, so the main loop never waits for a worker to stop or start. """
+        old_pool.terminate()
+        RegexGuard.start()
+
+    @staticmethod
+    def search(pattern: str, text: str, timeout: float):
+        """ Returns 1 on match, 0 on no match, -1 if the evaluation exceeded `timeout`, or None if no worker is available. """
+        if not (pool := IRCD.regex_pool):
+            return None
+        try:
+            return pool.apply_async(regex_search, (pattern, text)).get(timeout=timeout)
+        except multiprocessing.TimeoutError:
+            IRCD.regex_pool = None
+            IRCD.run_parallel_function(RegexGuard.replace, args=(pool,))
+            return -1
+
+
+def spamfilter_disable(spamfilter, reason):
+    spamfilter.disabled = 1
+    Spamfilter.generation += 1
+    msg = f"Spamfilter {spamfilter.match} has been disabled: {reason}"
+    IRCD.log(IRCD.me, "warn", "spamfilter", "SPAMFILTER_DISABLED", msg, sync=0)
+
+
+class AhoCorasick:
+    """ Finds all keywords occurring in a text in a single pass over that text. """
+
+    def __init__(self, keywords):
+        """
+        :param keywords:    Iterable of (keyword, value) tuples.
+                            search() returns the values of all keywords found.
+        """
+
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for keyword, value in keywords:
+            node = 0
+            for char in keyword:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append(value)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text: str) -> set:
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+
+class SpamfilterMatcher:
+    """
+    All spamfilters of a single target, compiled into one matcher.
+    Simple filters are found through an Aho-Corasick automaton over their longest literal part,
+    regex filters through a single union pattern. Candidates are then confirmed against the full rule,
+    so the cost per message does not grow with the amount of spamfilters that do not match.
+    Regexes that fail regex_cost() are never run on the main loop, but through RegexGuard.
+    """
+
+    def __init__(self, spamfilters: list):
+        self.spamfilters = spamfilters
+        self.globs = {}
+        self.regexes = {}
+        # Simple filters without any literal part, and regexes that cannot be part of the union.
+        self.always = []
+        self.separate = []
+        self.guarded = []
+
+        keywords = []
+        for num, spamfilter in enumerate(spamfilters):
+            if spamfilter.match_type == "simple":
+                glob = spamfilter.match.lower()
+                self.globs[num] = compile_globs([glob])
+                if core := max(re.split(r"[*?]", glob), key=len):
+                    keywords.append((core, num))
+                else:
+                    self.always.append(num)
+
+            elif spamfilter.match_type == "regex" and (pattern := is_valid_regex(spamfilter.match)):
+                if regex_cost(spamfilter.match):
+                    self.guarded.append(num)
+                else:
+                    self.regexes[num] = pattern
+
+        self.automaton = AhoCorasick(keywords)
+
+        union = []
+        for num, pattern in self.regexes.items():
+            # Group references would point to the wrong group inside the union,
+            # and global flags are only allowed at the very start of a pattern.
+            if re.search(r"\\[1-9]|\(\?P=|\(\?\(", pattern.pattern) or not is_valid_regex(f"(?:{pattern.pattern})"):
+                self.separate.append(num)
+            else:
+                union.append(num)
+
+        self.union_members = union
+        self.union = None
+        if union:
+            try:
+                self.union = re.compile('|'.join(f"(?:{self.regexes[num].pattern})" for num in union))
+            except re.error:
+                self.separate += union
+                self.union_members = []
+
+    def evaluate(self, num: int, test, *args):
+        """ Runs a single rule and records its evaluation time on the spamfilter. """
+        start = perf_counter()
+        result = test(*args)
+        self.spamfilters[num].record_evaluation(perf_counter() - start)
+        return result
+
+    def matches(self, text: str) -> list:
+        """
+        Returns all spamfilters matching `text`, in the order they were added.
+        Time spent in the automaton and union prefilters is not attributed to any rule,
+        only to the totals of the target.
+        """
+
+        lowered = text.lower()
+        candidates = self.automaton.search(lowered)
+        candidates.update(self.always)
+        hits = [num for num in candidates if self.evaluate(num, self.globs[num].fullmatch, lowered)]
+
+        if self.union and self.union.search(text):
+            hits += [num for num in self.union_members if self.evaluate(num, self.regexes[num].search, text)]
+        hits += [num for num in self.separate if self.evaluate(num, self.regexes[num].search, text)]
+
+        deadline = perf_counter() + RegexGuard.budget()
+        for num in self.guarded:
+            if (remaining := deadline - perf_counter()) <= 0 or not IRCD.regex_pool:
+                RegexGuard.skipped += 1
+                continue
+            match self.evaluate(num, RegexGuard.search, self.spamfilters[num].match, text, remaining):
+                case 1:
+                    hits.append(num)
+                case -1:
+                    budget = int(RegexGuard.budget() * 1000)
+                    spamfilter_disable(self.spamfilters[num], f"evaluation exceeded the time budget of {budget}ms")
+                case None:
+                    RegexGuard.skipped += 1
+
+        return [self.spamfilters[num] for num in sorted(hits)]
+
+
+class SpamfilterEngine:
+    """ Keeps one SpamfilterMatcher per target, rebuilt whenever the spamfilter list changes. """
+    source = None
+    generation = -1
+    matchers = {}
+
+    @staticmethod
+    def get(target: str):
+        if SpamfilterEngine.source is not IRCD.configuration.spamfilters or SpamfilterEngine.generation != Spamfilter.generation:
+            SpamfilterEngine.build()
+        return SpamfilterEngine.matchers.get(target)
+
+    @staticmethod
+    def build():
+        SpamfilterEngine.source = IRCD.configuration.spamfilters
+        SpamfilterEngine.generation = Spamfilter.generation
+        SpamfilterEngine.matchers = {}
+        for target in "pcnNat":
+            if spamfilters := [s for s in IRCD.configuration.spamfilters if target in s.target and not s.disabled]:
+                SpamfilterEngine.matchers[target] = SpamfilterMatcher(spamfilters)
+
+
+class SpamfilterStats:
+    """ Totals per spamfilter target, and the last time they were exported to the log. """
+    targets = {target: {"checks": 0, "hits": 0, "time": 0.0, "max": 0.0} for target in "pcnNat"}
+    last_export = int(time())
+
+    @staticmethod
+    def record(target: str, elapsed: float, hits: int):
+        totals = SpamfilterStats.targets[target]
+        totals["checks"] += 1
+        totals["hits"] += hits
+        totals["time"] += elapsed
+        totals["max"] = max(totals["max"], elapsed)
+
+    @staticmethod
+    def by_cost():
+        return sorted(IRCD.configuration.spamfilters, key=lambda s: s.eval_time, reverse=True)
+
+
+def format_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.3f}ms"
+
+
+def spamfilter_rule_stats(spamfilter) -> str:
+    avg = spamfilter.eval_time / spamfilter.evaluations if spamfilter.evaluations else 0
+    last_hit = f"{int(time()) - spamfilter.last_hit}s ago" if spamfilter.last_hit else "never"
+    return f"[{spamfilter.entry_num}] {spamfilter.match_type} {spamfilter.target}{' (disabled)' if spamfilter.disabled else ''}: {spamfilter.match} -- " \
+           f"evaluations: {spamfilter.evaluations}, hits: {spamfilter.hits}, actions: {spamfilter.actions}, last hit: {last_hit}, " \
+           f"time: {format_ms(spamfilter.eval_time)} (avg {format_ms(avg)}, max {format_ms(spamfilter.max_eval_time)})"
+
+
+def spamfilter_target_stats(target: str) -> str:
+    totals = SpamfilterStats.targets[target]
+    avg = totals["time"] / totals["checks"] if totals["checks"] else 0
+    return f"Target {target}: checks: {totals['checks']}, hits: {totals['hits']}, " \
+           f"time: {format_ms(totals['time'])} (avg {format_ms(avg)}, max {format_ms(totals['max'])})"
+
+
+def spamfilter_export_stats():
+    if not (interval := IRCD.get_setting("spamfilter-stats-interval")):
+        return
+    if int(time()) - SpamfilterStats.last_export < int(interval):
+        return
+    SpamfilterStats.last_export = int(time())
+
+    for target in [t for t in SpamfilterStats.targets if SpamfilterStats.targets[t]["checks"]]:
+        IRCD.log(IRCD.me, "info", "spamfilter", "SPAMFILTER_STATS", spamfilter_target_stats(target), sync=0)
+    for spamfilter in SpamfilterStats.by_cost()[:5]:
+        if spamfilter.evaluations:
+            IRCD.log(IRCD.me, "info", "spamfilter", "SPAMFILTER_STATS", spamfilter_rule_stats(spamfilter), sync=0)
+
+
 def spamfilter_match(client, spamfilter, target_cause):  # filtertarget, to_target, target_cause):
     msg = f"Spamfilter match by {client.name} ({client.user.username}@{client.user.realhost}) matching {spamfilter.match} [{target_cause}] (action: {spamfilter.action})"
-    IRCD.log(client, "warn", "spamfilter", "SPAMFILTER_MATCH", msg, sync=1)
+    IRCD.log(client, "warn", "spamfilter", "SPAMFILTER_MATCH", msg, sync=1, match=spamfilter.match, target=target_cause, action=spamfilter.action)
+    spamfilter.actions += 1
     reason = spamfilter.reason.replace('_', ' ')
     if spamfilter.action == "warn":
         client.sendnumeric(Numeric.ERR_CANNOTSENDTOCHAN, client.name, f"[WARNING] Spamfilter match: {reason}")
@@ -44,21 +378,25 @@ def spamfilter_match(client, spamfilter, target_cause):  # filtertarget, to_targ
 def spamfilter_check(client, target, to_target, target_cause):
     if client.has_permission("immune:spamfilter") or IRCD.is_except_client("spamfilter", client):
         return Hook.ALLOW
+    if not (matcher := SpamfilterEngine.get(target)):
+        return Hook.ALLOW
+
+    start = perf_counter()
+    matches = matcher.matches(target_cause)
+    SpamfilterStats.record(target, perf_counter() - start, len(matches))
+
     allow = 1
-    for spamfilter in [s for s in IRCD.configuration.spamfilters if target in s.target]:
-        _filter = spamfilter.match
-        if (spamfilter.match_type == "simple" and is_match(_filter.lower(), target_cause.lower())) or \
-                (spamfilter.match_type == "regex" and re.search(_filter, target_cause)):
-
-            for e in [e for e in IRCD.configuration.excepts if e.name == "spamfilter"]:
-                for e_mask in e.mask.mask:
-                    if e_mask[0][0] in IRCD.CHANPREFIXES and to_target[0] in IRCD.CHANPREFIXES:
-                        # Channel exception.
-                        if is_match(e_mask[0].lower(), to_target.lower()):
-                            logging.debug(f"Spamfilter match from {client.name} ignored: exception found on channel: {e_mask[0]}")
-                            logging.debug(f"Match: {_filter}")
-                            return Hook.ALLOW
-            allow = spamfilter_match(client, spamfilter, target_cause)
+    for spamfilter in matches:
+        spamfilter.record_hit()
+        for e in [e for e in IRCD.configuration.excepts if e.name == "spamfilter"]:
+            for e_mask in e.mask.mask:
+                if e_mask[0][0] in IRCD.CHANPREFIXES and to_target[0] in IRCD.CHANPREFIXES:
+                    # Channel exception.
+                    if is_match(e_mask[0].lower(), to_target.lower()):
+                        logging.debug(f"Spamfilter match from {client.name} ignored: exception found on channel: {e_mask[0]}")
+                        logging.debug(f"Match: {spamfilter.match}")
+                        return Hook.ALLOW
+        allow = spamfilter_match(client, spamfilter, target_cause)
 
     return Hook.ALLOW if allow else Hook.DENY
     # return target_cause if allow and target in ["a", "c", "p", "n", "t", "N"] else Hook.DENY
@@ -110,6 +448,7 @@ def cmd_spamfilter(client, recv):
     When specifying the <reason>, replace spaces with underscores (_).
 -
     To view the spamfilter list, use /SPAMFILTER without any arguments.
+    To view hit and evaluation time statistics, sorted by cost, use /SPAMFILTER stats
     """
 
     targets = "pcnNat"
@@ -123,6 +462,15 @@ def cmd_spamfilter(client, recv):
             IRCD.server_notice(client, f"To view info about removing spamfilter entries, use: /SPAMFILTER del")
         return
 
+    if recv[1] == "stats":
+        if not client.has_permission("server:spamfilter:view"):
+            return client.sendnumeric(Numeric.ERR_NOPRIVILEGES)
+        for target in SpamfilterStats.targets:
+            client.sendnumeric(Numeric.RPL_TEXT, spamfilter_target_stats(target))
+        for spamfilter in SpamfilterStats.by_cost():
+            client.sendnumeric(Numeric.RPL_TEXT, spamfilter_rule_stats(spamfilter))
+        return
+
     if recv[1] not in ["add", "del", '+', '-']:
         return IRCD.server_notice(client, "Syntax: SPAMFILTER <add|+|del|-> <simple|regex> <target(s)> <action> <duration> <reason> <match> [id]")
 
@@ -183,6 +531,11 @@ def cmd_spamfilter(client, recv):
         if match_type == "regex" and not is_valid_regex(match):
             return IRCD.server_notice(client, f"Invalid regex pattern: {match}")
 
+        if match_type == "regex" and (cost := regex_cost(match)):
+            budget = int(RegexGuard.budget() * 1000)
+            IRCD.server_notice(client, f"Regex pattern may backtrack heavily ({cost}). "
+                                       f"It will be evaluated in a worker process and disabled when it takes longer than {budget}ms.")
+
         reason = reason.replace('_', ' ')
         s = Spamfilter(match_type, action, duration, match, targets, reason, conf_file=None, conf=0)
         s.set_by = client.fullrealhost
@@ -210,6 +563,7 @@ def cmd_spamfilter(client, recv):
         for obj in list(IRCD.configuration.spamfilters):
             if obj.entry_num == int(recv[2]) and not obj.conf:
                 IRCD.configuration.spamfilters.remove(obj)
+                Spamfilter.generation += 1
                 reason = obj.reason.replace('_', ' ')
                 msg = f"Spamfilter entry removed by {client.name} ({client.user.username}@{client.user.realhost}): [{obj.match_type}, {obj.action}, {''.join(obj.target)}: {obj.match}]. Reason: {reason}"
                 IRCD.log(client, "info", "spamfilter", "SPAMFILTER_DEL", msg, sync=1)
@@ -225,6 +579,8 @@ def spamfilter_stats(client):
         if not t.set_by:
             t.set_by = IRCD.me.name
         client.sendnumeric(Numeric.RPL_STATSSPAMF, t.match_type, t.target, t.action, t.duration, t.active_time(), t.set_time, t.set_by, t.reason, t.match)
+    if RegexGuard.skipped:
+        IRCD.server_notice(client, f"Guarded regex evaluations skipped because of the time budget: {RegexGuard.skipped}")
 
 
 def spamfilter_partcheck(client, channel, reason):
@@ -240,6 +596,12 @@ def init(module):
     Hook.add(Hook.PRE_AWAY, spamfilter_awaycheck)
     Hook.add(Hook.PRE_LOCAL_TOPIC, spamfilter_topiccheck)
     Hook.add(Hook.PRE_LOCAL_PART, spamfilter_partcheck)
+    Hook.add(Hook.LOOP, spamfilter_export_stats)
+    # Started once the server runs, so the pool is not left behind when the server forks to the background.
+    if IRCD.running:
+        IRCD.run_parallel_function(RegexGuard.start)
+    else:
+        Hook.add(Hook.BOOT, RegexGuard.start)
     # Hook.add(Hook.CAN_KICK, spamfilter_kickreason_check)
     Command.add(module, cmd_spamfilter, "SPAMFILTER", 0, Flag.CMD_OPER)
     Stat.add(module, spamfilter_stats, 'F', "View spamfilter entries")
@@ -7,7 +7,8 @@ import os
 import sys
 import time
 
-from handle.core import IRCD, Command, Stat, Numeric, Flag, Tkl
+from handle.core import IRCD, Command, Stat, Numeric, Flag, Tkl, HostCache
+from handle.resolver import Resolver
 
 try:
     import psutil
@@ -115,6 +116,25 @@ def stats_debug(client):
         client.sendnumeric(Numeric.RPL_STATSDEBUG, f"Services: {services}")
 
 
+def stats_audit(client):
+    if not (audit := IRCD.client_audit):
+        return IRCD.server_notice(client, "* STATS -- No client index audit has run yet.")
+    IRCD.server_notice(client, f"Last client index audit: {int(time.time()) - audit['time']} seconds ago, {audit['checked']} remote users checked")
+    IRCD.server_notice(client, f"    Ghost users removed: {audit['ghosts']}, missing from index: {audit['unindexed']}, stale servers: {audit['stale']}")
+    for server, users in IRCD.server_users.items():
+        IRCD.server_notice(client, f"    {server.name}: {len(users)} users")
+
+
+def stats_resolver(client):
+    stats = HostCache.stats
+    finished = stats["confirmed"] + stats["failed"]
+    latency = f"{stats['latency'] / finished * 1000:.0f}ms" if finished else "n/a"
+    IRCD.server_notice(client, f"Hostname lookups: {stats['lookups']}, confirmed: {stats['confirmed']}, failed or unconfirmed: {stats['failed']}, "
+                               f"cache hits: {stats['cache_hits']}, average latency: {latency}")
+    IRCD.server_notice(client, f"    Host cache: {len(HostCache.entries)}/{HostCache.max_size} entries, {len(HostCache.pending)} lookups pending")
+    IRCD.server_notice(client, f"    DNS: {len(Resolver.inflight)} queries in flight, {len(Resolver.waiting)} queued, {len(Resolver.cache)} cached answers")
+
+
 def stats_ports(client):
     for listen in IRCD.configuration.listen:
         port_clients = [client for client in IRCD.local_clients() if
@@ -153,5 +173,7 @@ def init(module):
     Stat.add(module, stats_links_all, 'L', "View link all information, including unlinked")
     Stat.add(module, stats_opers, 'O', "View oper blocks")
     Stat.add(module, stats_uptime, 'u', "View uptime information")
+    Stat.add(module, stats_audit, 'A', "View the last client index audit")
+    Stat.add(module, stats_resolver, 'R', "View hostname resolver statistics")
     Stat.add(module, stats_ports, 'P', "View all open ports and their type")
     Stat.add(module, stats_debug, 'C', "View raw client data")
@@ -38,6 +38,7 @@ def cmd_svsmode(client, recv):
                     curr_account = target.user.account
                     target.user.account = account if account != '0' else '*'
                     if curr_account != account:
+                        target.identity_changed()
                         IRCD.run_hook(Hook.ACCOUNT_LOGIN, target)
                     continue
                 elif m not in IRCD.get_umodes_str():
@@ -30,12 +30,6 @@ def tkl_to_json():
     return result
 
 
-def sync_tkl(server):
-    for tkl in [tkl for tkl in Tkl.table if tkl.type in Tkl.global_flags()]:
-        data = f":{IRCD.me.id} TKL + {tkl.type} {tkl.ident} {tkl.host} {tkl.set_by} {tkl.expire} {tkl.set_time} {tkl.bantypes}:{tkl.reason}"
-        server.send([], data)
-
-
 def make_real_mask(data):
     if "@" not in data:
         return f"*@{data}"
@@ -271,7 +265,10 @@ def cmd_line(client, recv):
                 ipmask = mask.split('@')[1]
             ipmask = ipmask.replace('*', '0')
             try:
-                ipaddress.ip_address(ipmask)
+                if '/' in ipmask:
+                    ipaddress.ip_network(ipmask, strict=False)
+                else:
+                    ipaddress.ip_address(ipmask)
             except ValueError:
                 return IRCD.server_notice(client, f"Invalid IP address for {cmd_tkl.name}: {mask}")
 
@@ -393,7 +390,6 @@ def init(module):
     Hook.add(Hook.PRE_LOCAL_NICKCHANGE, sqline_check_pre_nick)
     Hook.add(Hook.LOOP, remove_expired_tkl)
     Hook.add(Hook.ACCOUNT_LOGIN, check_bans)
-    Hook.add(Hook.SERVER_SYNC, sync_tkl)
     Hook.add(Hook.WHOIS, shun_whois)
     Stat.add(module, global_tkl_stats, 'G', "View the all active TKLs")
     Stat.add(module, local_tkl_stats, 'g', "View only local active TKLs")
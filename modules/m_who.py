@@ -2,9 +2,14 @@
 /who command
 """
 
-from handle.core import IRCD, Command, Isupport, Numeric
-from handle.functions import is_match
-from handle.logger import logging
+import re
+from time import time
+
+from handle.core import IRCD, Command, Isupport, Numeric, Hook, Client, ReplyStream
+from handle.functions import glob_to_regex
+
+# WHOX fields in reply order.
+WHOX_FIELDS = "tcuihsnfdlaor"
 
 
 def get_who_status(client, user_client, channel=None):
@@ -29,54 +34,62 @@ def get_who_status(client, user_client, channel=None):
     return who_status
 
 
-class WhoData:
-    replies = []
-
-    def __init__(self, who_client):
-        self.who_client = who_client
-        self.username = ''
-        self.cloakhost = ''
-        self.server_name = ''
-        self.name = ''
-        self.status = ''
-        self.hopcount = 0
-        self.user_info = ''
-        self.fields = []
-        self.channel = None
-        if who_client.channels:
-            self.channel = who_client.channels[0]
-        self.flags = ''
-        self.fields = ['', '', '', '', '', '', '', '', '', '', '', '', '']
-        if self not in WhoData.replies:
-            WhoData.replies.append(self)
-
-    def make(self, client):
-        self.username = self.who_client.user.username
-        self.cloakhost = self.who_client.user.cloakhost
-        # self.server_name = self.who_client.user.server.name
-        self.server_name = self.who_client.uplink.name
-        self.name = self.who_client.name
-        self.hopcount = self.who_client.hopcount
-        self.user_info = self.who_client.info
-        self.status = get_who_status(client, self.who_client, self.channel)
-        if self.channel and not self.channel.user_can_see_member(client, self.who_client):
-            self.channel = None
-            for chan in self.who_client.channels:
-                if chan.user_can_see_member(client, self.who_client):
-                    self.channel = chan
-                    break
-
-    def who_reply(self):
-        # Invalid: *  9b798cb3.20126204.b5c219d3.IP dev.provisionweb.org * H :0
-        # mask, user_client.user.username, user_client.user.cloakhost, client.user.server.name, user_client.name, status, user_client.hopcount, user_client.info
-        return '*' if not self.channel else self.channel.name, self.username, self.cloakhost, self.server_name, self.name, self.status, self.hopcount, self.user_info
-
-
-def get_who_reply(who_client):
-    for reply in WhoData.replies:
-        if reply.who_client == who_client:
-            return reply
-    return WhoData(who_client)
+class WhoIndex:
+    """
+    Lowercase nickname, cloaked host and IP -> users, so WHO on an exact mask does not scan every user.
+    Kept up to date from the connect, quit, nick change and host change hooks.
+    Candidates are checked against the user on lookup, so a stale entry never shows a wrong user.
+    """
+
+    nick = {}
+    host = {}
+    ip = {}
+
+    @staticmethod
+    def add(client):
+        WhoIndex.nick[client.name.lower()] = client
+        WhoIndex.host.setdefault(client.user.cloakhost.lower(), set()).add(client)
+        WhoIndex.ip.setdefault(client.ip, set()).add(client)
+
+    @staticmethod
+    def remove(client):
+        if WhoIndex.nick.get(client.name.lower()) == client:
+            del WhoIndex.nick[client.name.lower()]
+        for index, key in [(WhoIndex.host, client.user.cloakhost.lower()), (WhoIndex.ip, client.ip)]:
+            if clients := index.get(key):
+                clients.discard(client)
+                if not clients:
+                    del index[key]
+
+    @staticmethod
+    def lookup(client, mask: str) -> list:
+        """ Returns the users whose nickname, host or IP is exactly `mask`. IP addresses are only matched for IRC operators. """
+        mask = mask.lower()
+        candidates = {WhoIndex.nick.get(mask)} | WhoIndex.host.get(mask, set())
+        if 'o' in client.user.modes:
+            candidates |= WhoIndex.ip.get(mask, set())
+        return [c for c in candidates if c and c.registered and not c.exitted
+                and mask in [c.name.lower(), c.user.cloakhost.lower()] + ([c.ip] if 'o' in client.user.modes else [])]
+
+
+def who_index_connect(client):
+    WhoIndex.add(client)
+
+
+def who_index_quit(client, reason):
+    WhoIndex.remove(client)
+
+
+def who_index_nickchange(client, newnick):
+    if WhoIndex.nick.get(client.name.lower()) == client:
+        del WhoIndex.nick[client.name.lower()]
+    WhoIndex.nick[newnick.lower()] = client
+
+
+def who_index_hostchange(client, ident, host):
+    if clients := WhoIndex.host.get(client.user.cloakhost.lower()):
+        clients.discard(client)
+    WhoIndex.host.setdefault(host.lower(), set()).add(client)
 
 
 def who_can_see_channel(client, channel, who_target):
@@ -89,37 +102,176 @@ def who_can_see_channel(client, channel, who_target):
     return 1
 
 
-def send_who_reply(client, mask: str):
-    if chan := IRCD.find_channel(mask):
-        mask = chan.name
-
-    for reply in WhoData.replies:
-        # if 'i' in reply.who_client.user.modes:
-        #     if not client.has_permission("channel:see:who:invisible") and not IRCD.common_channels(client, reply.who_client) and reply.who_client != client:
-        #         continue
-
-        if reply.fields != [''] * 13:
-            # reply_string = mask + ' ' + ' '.join(reply.fields)
-            reply_string = ' '.join(str(field) for field in reply.fields if field)
-            client.sendnumeric(Numeric.RPL_WHOSPCRPL, reply_string)
-        else:
-            if 'I' in reply.flags and 'o' in client.user.modes:
-                reply.cloakhost = reply.who_client.ip
-
-            elif 'R' in reply.flags and 'o' in client.user.modes:
-                reply.cloakhost = reply.who_client.user.realhost
-
-            if reply.channel:
-                for channel in reply.who_client.channels:
-                    if who_can_see_channel(client, channel, reply.who_client):
-                        reply.channel = channel
-                        break
-                    reply.channel = None
-
-            client.add_flood_penalty(100)
-            client.sendnumeric(Numeric.RPL_WHOREPLY, *reply.who_reply())
-
-    client.sendnumeric(Numeric.RPL_ENDOFWHO, mask)
+def who_can_see_user(client, who_client):
+    return ('i' not in who_client.user.modes or who_client == client or client.has_permission("channel:see:who:invisible")
+            or IRCD.common_channels(client, who_client))
+
+
+class WhoQuery:
+    """ A parsed WHO request. Only the fields that were asked for are computed for each reply. """
+
+    def __init__(self, client, flags: str, flag_matches: list):
+        self.client = client
+        self.flags = flags
+        self.whox = ''
+        self.token = ''
+        # Legacy filter flags, as (flag, param) pairs.
+        self.filters = []
+        self.negate = 0
+
+        if flags.startswith(('+', '-')):
+            self.negate = flags[0] == '-'
+            flags = flags[1:]
+        if '%' in flags:
+            flags, whox = flags.split('%', 1)
+            whox, _, self.token = whox.partition(',')
+            # Keep the fields in reply order, whatever order they were requested in.
+            self.whox = ''.join(f for f in WHOX_FIELDS if f in whox)
+        params = iter(flag_matches)
+        for char in flags:
+            if char in "nuhisradm":
+                self.filters.append((char, next(params, '')))
+            elif char == 'o':
+                self.filters.append((char, ''))
+
+    def passes_filters(self, who_client) -> int:
+        client = self.client
+        for char, param in self.filters:
+            if char in "hism" and 'o' not in client.user.modes:
+                return 0
+            match char:
+                case 'n':
+                    result = is_glob_match(param, who_client.name)
+                case 'u':
+                    result = is_glob_match(param, who_client.user.username)
+                case 'h':
+                    result = is_glob_match(param, who_client.user.realhost)
+                case 'i':
+                    result = is_glob_match(param, who_client.ip)
+                case 's':
+                    result = is_glob_match(param, who_client.uplink.name)
+                case 'r':
+                    result = is_glob_match(param, who_client.info)
+                case 'a':
+                    result = is_glob_match(param, who_client.user.account)
+                case 'm':
+                    result = all(mode in who_client.user.modes for mode in param.removeprefix('+'))
+                case 'd':
+                    result = param.isdigit() and who_client.hopcount == int(param)
+                case 'o':
+                    result = 'o' in who_client.user.modes
+                case _:
+                    result = 1
+            if not result ^ self.negate:
+                return 0
+        return 1
+
+    def reply_channel(self, who_client, channel):
+        if channel:
+            return channel
+        return next((c for c in who_client.channels if who_can_see_channel(self.client, c, who_client)), None)
+
+    def send_reply(self, who_client, channel=None):
+        client = self.client
+        client.add_flood_penalty(100)
+        if self.whox:
+            fields = []
+            for char in self.whox:
+                match char:
+                    case 't':
+                        fields.append(self.token or '0')
+                    case 'c':
+                        fields.append(chan.name if (chan := self.reply_channel(who_client, channel)) else '*')
+                    case 'u':
+                        fields.append(who_client.user.username)
+                    case 'i':
+                        fields.append(who_client.ip if 'o' in client.user.modes else "255.255.255.255")
+                    case 'h':
+                        fields.append(who_client.user.cloakhost)
+                    case 's':
+                        fields.append(who_client.uplink.name)
+                    case 'n':
+                        fields.append(who_client.name)
+                    case 'f':
+                        fields.append(get_who_status(client, who_client, self.reply_channel(who_client, channel)))
+                    case 'd':
+                        fields.append(str(who_client.hopcount))
+                    case 'l':
+                        fields.append(str(int(time()) - who_client.idle_since) if who_client.local else '0')
+                    case 'a':
+                        fields.append(who_client.user.account if who_client.user.account != '*' else '0')
+                    case 'o':
+                        status = ''
+                        if channel:
+                            status = ''.join(cmode.prefix for cmode in channel.get_membermodes_sorted() if channel.client_has_membermodes(who_client, cmode.flag))
+                        fields.append(status or "n/a")
+                    case 'r':
+                        fields.append(':' + who_client.info)
+            return client.sendnumeric(Numeric.RPL_WHOSPCRPL, ' '.join(fields))
+
+        host = who_client.user.cloakhost
+        if 'o' in client.user.modes:
+            if 'I' in self.flags:
+                host = who_client.ip
+            elif 'R' in self.flags:
+                host = who_client.user.realhost
+        channel = self.reply_channel(who_client, channel)
+        client.sendnumeric(Numeric.RPL_WHOREPLY, channel.name if channel else '*', who_client.user.username, host,
+                           who_client.uplink.name, who_client.name, get_who_status(client, who_client, channel),
+                           who_client.hopcount, who_client.info)
+
+
+def is_glob_match(mask: str, value: str) -> int:
+    return 1 if re.fullmatch(glob_to_regex(mask.lower()), value.lower()) else 0
+
+
+def who_targets(query, mask: str):
+    """ Yields (user, channel) for every user matching `mask`, resolved from the smallest index that applies. """
+    client = query.client
+    if mask[0] in IRCD.CHANPREFIXES:
+        if not (channel := IRCD.find_channel(mask)):
+            return
+        if 's' in channel.modes and (not channel.find_member(client) and not client.has_permission("channel:see:who:secret")):
+            return
+        see_invisible = channel.find_member(client) or client.has_permission("channel:see:who:invisible")
+        for who_client in list(channel.member_by_client):
+            if who_client.user and channel.user_can_see_member(client, who_client) and ('i' not in who_client.user.modes or see_invisible):
+                yield who_client, channel
+        return
+
+    # Walked lazily, so a paused reply never holds a copy of the user list.
+    # Clients that quit meanwhile are skipped by the exitted check in who_replies().
+    all_users = (c for c in Client.table if c.user and c.registered)
+    if mask in ['*', '0']:
+        candidates, pattern = all_users, None
+    elif '*' not in mask and '?' not in mask:
+        if (user := WhoIndex.nick.get(mask.lower())) and user.registered and user.name.lower() == mask.lower():
+            yield user, None
+            return
+        candidates, pattern = WhoIndex.lookup(client, mask), None
+    else:
+        candidates, pattern = all_users, re.compile(glob_to_regex(mask.lower()))
+
+    for who_client in candidates:
+        if pattern and not (pattern.fullmatch(who_client.name.lower()) or pattern.fullmatch(who_client.user.cloakhost.lower())
+                            or ('o' in client.user.modes and (pattern.fullmatch(who_client.ip) or pattern.fullmatch(who_client.user.realhost.lower())))):
+            continue
+        if who_can_see_user(client, who_client):
+            yield who_client, None
+
+
+def who_replies(query, masks: list):
+    """ Generator for ReplyStream: sends one reply per iteration. """
+    for mask in masks:
+        for who_client, channel in who_targets(query, mask):
+            if who_client.exitted:
+                continue
+            if query.filters and not query.passes_filters(who_client):
+                continue
+            query.send_reply(who_client, channel)
+            yield
+        query.client.sendnumeric(Numeric.RPL_ENDOFWHO, chan.name if (chan := IRCD.find_channel(mask)) else mask)
+        yield
 
 
 def cmd_who(client, recv):
@@ -142,202 +294,23 @@ def cmd_who(client, recv):
     """
 
     client.add_flood_penalty(10_000)
-    WhoData.replies = []
-
-    if len(recv) == 1 or recv[1] == '*':
-        who_mask = '*'  # Match all.
-    else:
-        who_mask = recv[1]
-
-    token = ''
-    flags = ''
-    flag_match = ''
-    flag_matches = []
-    flag_true = 0
-    whox = 0
-    flag_match_increment = -1
-    if len(recv) > 2:
-        if recv[2][0] in "+-":
-            flag_true = 1 if recv[2][0] == '+' else 0
-            flags = recv[2][1:]
-        else:
-            flag_true = 1
-            flags = recv[2]
-        if flags.startswith('%'):
-            if len(flags.split(',')) > 1:
-                token = flags.split(',')[1]
-
-    if len(recv) > 3:
-        flag_matches = recv[3:]
-
-    for mask in who_mask.split(','):
-        who_matches = []
-        if who_channel := IRCD.find_channel(mask):
-            if 's' in who_channel.modes and (not who_channel.find_member(client) and not client.has_permission("channel:see:who:secret")):
-                return client.sendnumeric(Numeric.RPL_ENDOFWHO, mask)
-
-            who_matches = [c for c in who_channel.clients()
-                           if who_channel.user_can_see_member(client, c)
-                           and ('i' not in c.user.modes or who_channel.find_member(client) or client.has_permission("channel:see:who:invisible"))]
-
-        elif (user := IRCD.find_user(mask)) and user.registered:
-            who_matches.append(user)
-        else:
-            who_matches = [c for c in IRCD.global_registered_users() if is_match(mask, c.ip)
-                           and ('i' not in c.user.modes or IRCD.common_channels(client, c)
-                                or client.has_permission("channel:see:who:invisible") or c == client)]
-
-        for char in flags:
-            flag_match_increment += 1
-            if flag_matches and flag_match_increment <= len(flag_matches):
-                flag_match = flag_matches[flag_match_increment]
-
-            if char == '%':
-                whox = 1
-            if not whox:
-                if char == 'n':
-                    who_matches = []
-                    for find_client in [c for c in IRCD.global_registered_clients() if is_match(flag_match.lower(), c.name.lower())]:
-                        if find_client not in who_matches and flag_true:
-                            who_matches.append(find_client)
-
-                if char == 'u':
-                    who_matches = []
-                    for find_client in [c for c in IRCD.global_registered_clients() if is_match(flag_match.lower(), c.user.username.lower())]:
-                        if find_client not in who_matches and flag_true:
-                            who_matches.append(find_client)
-
-                if char == 'h':
-                    who_matches = []
-                    if 'o' not in client.user.modes:
-                        continue
-                    for find_client in [c for c in IRCD.global_registered_clients() if is_match(flag_match.lower(), c.user.realhost.lower())]:
-                        if find_client not in who_matches and flag_true:
-                            who_matches.append(find_client)
-
-                if char == 'i':
-                    who_matches = []
-                    if 'o' not in client.user.modes:
-                        continue
-                    for find_client in [c for c in IRCD.global_registered_clients() if is_match(flag_match, c.ip)]:
-                        if find_client not in who_matches and flag_true:
-                            who_matches.append(find_client)
-
-                if char == 's':
-                    who_matches = []
-                    if 'o' not in client.user.modes:
-                        continue
-                    for find_client in [c for c in IRCD.global_registered_clients() if is_match(flag_match.lower(), c.uplink.name.lower())]:
-                        if find_client not in who_matches and flag_true:
-                            who_matches.append(find_client)
-
-                if char == 'r':
-                    who_matches = []
-                    for find_client in [c for c in IRCD.global_registered_clients() if is_match(flag_match.lower(), c.info.lower())]:
-                        if find_client not in who_matches and flag_true:
-                            who_matches.append(find_client)
-
-                if char == 'a':
-                    who_matches = []
-                    for find_client in [c for c in IRCD.global_registered_clients() if is_match(flag_match.lower(), c.user.account.lower())]:
-                        if find_client not in who_matches and flag_true:
-                            who_matches.append(find_client)
-
-                if char == 'm':
-                    who_matches = []
-                    if 'o' not in client.user.modes:
-                        continue
-                    if mask.startswith('-'):
-                        condition = '-'
-                        mode_mask = mask[1:]
-                    else:
-                        mode_mask = mask
-                        condition = '+'
-                    for mode in mode_mask:
-                        for find_client in IRCD.global_registered_users():
-                            if condition == '+' and mode not in find_client.user.modes:
-                                continue
-                            if condition == '-' and mode in find_client.user.modes:
-                                continue
-                            if find_client not in who_matches:
-                                who_matches.append(find_client)
-
-                if char == 'd':
-                    who_matches = []
-                    if not mask.isdigit():
-                        continue
-                    for find_client in [c for c in IRCD.global_registered_clients() if c.hopcount == int(mask)]:
-                        if find_client not in who_matches:
-                            who_matches.append(find_client)
-
-            else:
-                for who_client in who_matches:
-                    who_reply = get_who_reply(who_client)
-                    if char == 't' and token:
-                        who_reply.fields[0] = token
-
-                    if char == 'c':
-                        if who_client.channels:
-                            chan = who_client.channels[0].name
-                        else:
-                            chan = '*'
-                        who_reply.fields[1] = chan
-
-                    if char == 'u':
-                        who_reply.fields[2] = who_client.user.username
-
-                    if char == 'i':
-                        if 'o' in client.user.modes:
-                            ip = who_client.ip
-                        else:
-                            ip = "255.255.255.255"
-                        who_reply.fields[3] = ip
-
-                    if char == 'h':
-                        who_reply.fields[4] = who_client.user.cloakhost
-
-                    if char == 's':
-                        # who_reply.fields[5] = who_client.user.server.name
-                        who_reply.fields[5] = who_client.uplink.name
-
-                    if char == 'n':
-                        who_reply.fields[6] = who_client.name
-
-                    if char == 'f':
-                        who_channel = next((c for c in IRCD.get_channels() if IRCD.common_channels(who_client, client)), 0)
-                        who_status = get_who_status(client, who_client, who_channel)
-                        who_reply.fields[7] = who_status
-
-                    if char == 'd':
-                        who_reply.fields[8] = str(who_client.hopcount)
-
-                    if char == 'l':
-                        who_reply.fields[9] = str(who_client.idle_since)
-
-                    if char == 'a':
-                        if (account := who_client.user.account) != '*':
-                            who_reply.fields[10] = account
-                        else:
-                            who_reply.fields[10] = '0'
-
-                    if char == 'o':
-                        status = ''
-                        if who_channel := IRCD.find_channel(mask):
-                            for cmode in [cmode for cmode in who_channel.get_membermodes_sorted() if who_channel.client_has_membermodes(who_client, cmode.flag)]:
-                                status += cmode.prefix
-                        who_reply.fields[11] = status
-
-                    if 'r' in flags:
-                        who_reply.fields[12] = ':' + who_client.info
-
-        for who_client in who_matches:
-            who_reply = get_who_reply(who_client)
-            who_reply.flags = flags
-            who_reply.make(client)
+    who_mask = '*' if len(recv) == 1 else recv[1]
+    flags = recv[2] if len(recv) > 2 else ''
+    query = WhoQuery(client, flags, recv[3:])
 
-        send_who_reply(client, mask)
+    # Replies are sent from the main loop, paced by the sendq of the client.
+    ReplyStream.start(client, who_replies(query, [mask for mask in who_mask.split(',') if mask]))
 
 
 def init(module):
+    for client in IRCD.global_registered_users():
+        WhoIndex.add(client)
+    Hook.add(Hook.LOCAL_CONNECT, who_index_connect)
+    Hook.add(Hook.REMOTE_CONNECT, who_index_connect)
+    Hook.add(Hook.LOCAL_QUIT, who_index_quit)
+    Hook.add(Hook.REMOTE_QUIT, who_index_quit)
+    Hook.add(Hook.LOCAL_NICKCHANGE, who_index_nickchange)
+    Hook.add(Hook.REMOTE_NICKCHANGE, who_index_nickchange)
+    Hook.add(Hook.USERHOST_CHANGE, who_index_hostchange)
     Isupport.add("WHOX")
     Command.add(module, cmd_who, "WHO")
@@ -0,0 +1,15 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def core(tmp_path, monkeypatch):
+    """handle.core opens its log files under logs/ of the working directory on first import."""
+    pytest.importorskip("OpenSSL")
+    monkeypatch.chdir(tmp_path)
+    return importlib.import_module("handle.core")
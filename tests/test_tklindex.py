@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def TklIndex(core):
+    return core.TklIndex
+
+
+def make_tkl(TklIndex, ident, host):
+    return SimpleNamespace(ident=ident, host=host, network=TklIndex.host_to_network(host.lower()), is_extended=lambda: 0)
+
+
+def make_client(ip, username="user", realhost="host.example.org"):
+    user = SimpleNamespace(username=username, realhost=realhost, account='*')
+    return SimpleNamespace(ip=ip, name="nick", user=user, get_md_value=lambda name: None)
+
+
+def test_bare_wildcard_host_is_not_a_network(TklIndex):
+    assert TklIndex.host_to_network('*') is None
+    assert str(TklIndex.host_to_network("10.1.*")) == "10.1.0.0/16"
+
+
+@pytest.mark.parametrize("ident, host", [('*', '*'), ("user", '*')])
+def test_wildcard_host_matches_ipv6_client(TklIndex, ident, host):
+    index = TklIndex('k')
+    tkl = make_tkl(TklIndex, ident, host)
+    index.add(tkl)
+    assert index.find(make_client("2001:db8::1")) is tkl
+    assert index.find(make_client("192.0.2.1")) is tkl
+
+
+def test_wildcard_host_checks_ident(TklIndex):
+    index = TklIndex('k')
+    index.add(make_tkl(TklIndex, "user", '*'))
+    assert index.find(make_client("2001:db8::1", username="other")) is None